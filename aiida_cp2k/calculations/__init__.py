@@ -7,6 +7,8 @@
 """AiiDA-CP2K input plugin."""
 
 import json
+import math
+from copy import deepcopy
 from operator import add
 
 import numpy as np
@@ -16,7 +18,7 @@ from aiida.orm import Dict, RemoteData, SinglefileData
 from aiida.plugins import DataFactory
 from upf_to_json import upf_to_json
 
-from ..utils import Cp2kInput
+from ..utils import Cp2kInput, StageProfiler, get_walltime_seconds, merge_dict
 from ..utils.datatype_helpers import (
     validate_basissets,
     validate_basissets_namespace,
@@ -25,7 +27,12 @@ from ..utils.datatype_helpers import (
     write_basissets,
     write_pseudos,
 )
+from ..utils.parser import (
+    validate_advanced_parser_fields,
+    validate_tools_stream_options,
+)
 
+ArrayData = DataFactory("core.array")
 BandsData = DataFactory("core.array.bands")
 StructureData = DataFactory("core.structure")
 TrajectoryData = DataFactory("core.array.trajectory")
@@ -54,6 +61,16 @@ class Cp2kCalculation(CalcJob):
     _DEFAULT_INPUT_CELL_FILE_NAME = _DEFAULT_PROJECT_NAME + "-reftraj.cell"
     _DEFAULT_PARSER = "cp2k_base_parser"
 
+    # Settings that are not used to prepare the calculation, but are read by the parsers.
+    _PARSER_SETTINGS = (
+        "parser_output_arrays",
+        "parser_eigen_blocks",
+        "parser_fields",
+        "parser_tools_blocks",
+        "parser_tools_history",
+        "parser_timing",
+    )
+
     @classmethod
     def define(cls, spec):
         super().define(spec)
@@ -66,6 +83,24 @@ class Cp2kCalculation(CalcJob):
             required=False,
             help="The main input structure.",
         )
+        spec.input_namespace(
+            "structures",
+            valid_type=StructureData,
+            dynamic=True,
+            required=False,
+            help=(
+                "Independent structures computed in the same job with the shared input parameters, one after the"
+                " other. Their outputs are stored in the `structures` output namespace, under the same keys."
+                " With the `farming_groups` setting, they are run concurrently by the FARMING run type of CP2K."
+            ),
+        )
+        spec.input_namespace(
+            "structure_parameters",
+            valid_type=Dict,
+            dynamic=True,
+            required=False,
+            help="Input parameters of the `structures`, under the same keys, merged into the shared `parameters`.",
+        )
         spec.input(
             "trajectory",
             valid_type=TrajectoryData,
@@ -257,6 +292,36 @@ class Cp2kCalculation(CalcJob):
             required=False,
             help="Computed electronic band structure.",
         )
+        spec.output(
+            "output_md_state",
+            valid_type=ArrayData,
+            required=False,
+            help="Velocities and thermostat/barostat state from the restart file (MD runs).",
+        )
+        spec.output(
+            "output_scf_history",
+            valid_type=ArrayData,
+            required=False,
+            help="Per-iteration SCF history (one row per SCF iteration).",
+        )
+        spec.output(
+            "output_arrays",
+            valid_type=ArrayData,
+            required=False,
+            help="Per-step data moved out of `output_parameters` (`parser_output_arrays` setting).",
+        )
+        spec.output(
+            "output_timing",
+            valid_type=ArrayData,
+            required=False,
+            help="Per-subroutine timing report of CP2K (`parser_timing` setting).",
+        )
+        spec.output_namespace(
+            "structures",
+            dynamic=True,
+            required=False,
+            help="Outputs of the calculations of the `structures` input, by structure key.",
+        )
         spec.default_output_node = "output_parameters"
 
         spec.outputs.dynamic = True
@@ -268,23 +333,184 @@ class Cp2kCalculation(CalcJob):
         :return: `aiida.common.datastructures.CalcInfo` instance
         """
 
+        settings = self.inputs.settings.get_dict() if "settings" in self.inputs else {}
+
+        # Timing and memory of the preparation stages, stored as extra of the calculation.
+        profiler = StageProfiler(settings.pop("profile", False))
+
+        # The packed structures are run one after the other, or concurrently in the groups of a FARMING run.
+        farming_groups = settings.pop("farming_groups", None)
+        if farming_groups is not None:
+            if "structures" not in self.inputs:
+                raise InputValidationError(
+                    "The `farming_groups` setting requires the `structures` input."
+                )
+            if (
+                not isinstance(farming_groups, int)
+                or isinstance(farming_groups, bool)
+                or not 0 < farming_groups <= len(self.inputs.structures)
+            ):
+                raise InputValidationError(
+                    "The `farming_groups` setting must be a positive integer not larger than the number of "
+                    f"`structures` ({len(self.inputs.structures)}), got {farming_groups!r}."
+                )
+
+        # Independent calculations packed in the same job, their files are prefixed with their key.
+        parameters = self.inputs.parameters.get_dict()
+        structure_parameters = self.inputs.get("structure_parameters", {})
+        if "structures" in self.inputs:
+            if "structure" in self.inputs:
+                raise InputValidationError(
+                    "The `structure` and `structures` inputs can not be specified together."
+                )
+            unknown = set(structure_parameters) - set(self.inputs.structures)
+            if unknown:
+                raise InputValidationError(
+                    f"The `structure_parameters` {', '.join(sorted(unknown))} have no matching `structures`."
+                )
+            jobs = {}
+            for key, structure in sorted(self.inputs.structures.items()):
+                job_parameters = deepcopy(parameters)
+                if key in structure_parameters:
+                    merge_dict(job_parameters, structure_parameters[key].get_dict())
+                jobs[self._get_job_prefix(key)] = (structure, job_parameters)
+
+            # Each job has its share of the wall time of the jobs run one after the other (in the same group).
+            sequential_jobs = math.ceil(len(jobs) / (farming_groups or 1))
+            for _, job_parameters in jobs.values():
+                walltime = get_walltime_seconds(job_parameters)
+                if walltime is not None:
+                    job_parameters["GLOBAL"]["WALLTIME"] = int(
+                        walltime / sequential_jobs
+                    )
+        else:
+            if structure_parameters:
+                raise InputValidationError(
+                    "The `structure_parameters` input requires the `structures` input."
+                )
+            structure = self.inputs.structure if "structure" in self.inputs else None
+            jobs = {"": (structure, parameters)}
+
+        # Create input trajectory files
+        if "trajectory" in self.inputs:
+            with profiler.stage("write_trajectory"):
+                self._write_trajectories(
+                    self.inputs.trajectory,
+                    folder,
+                    self._DEFAULT_INPUT_TRAJECT_XYZ_FILE_NAME,
+                    self._DEFAULT_INPUT_CELL_FILE_NAME,
+                )
+
+        # Create the cp2k input files.
+        for prefix, (structure, job_parameters) in jobs.items():
+            self._write_input(folder, prefix, structure, job_parameters, profiler)
+
+        # The inputs are run one after the other, or all of them by the input of the FARMING run.
+        runs = list(jobs)
+        if farming_groups is not None:
+            self._write_farming_input(folder, runs, farming_groups, parameters)
+            runs = [""]
+
+        # Create code infos.
+        cmdline = settings.pop("cmdline", [])
+        codes_info = []
+        for prefix in runs:
+            codeinfo = CodeInfo()
+            codeinfo.cmdline_params = cmdline + [
+                "-i",
+                prefix + self._DEFAULT_INPUT_FILE,
+            ]
+            codeinfo.stdout_name = prefix + self._DEFAULT_OUTPUT_FILE
+            codeinfo.join_files = True
+            codeinfo.code_uuid = self.inputs.code.uuid
+            codes_info.append(codeinfo)
+
+        # Create calc info.
+        calcinfo = CalcInfo()
+        calcinfo.uuid = self.uuid
+        calcinfo.cmdline_params = codes_info[0].cmdline_params
+        calcinfo.stdin_name = self._DEFAULT_INPUT_FILE
+        calcinfo.stdout_name = self._DEFAULT_OUTPUT_FILE
+        calcinfo.codes_info = codes_info
+
+        # Files or additional structures.
+        if "file" in self.inputs:
+            calcinfo.local_copy_list = []
+            for name, obj in self.inputs.file.items():
+                if isinstance(obj, SinglefileData):
+                    calcinfo.local_copy_list.append(
+                        (obj.uuid, obj.filename, obj.filename)
+                    )
+                elif isinstance(obj, StructureData):
+                    self._write_structure(obj, folder, name + ".xyz")
+
+        calcinfo.retrieve_list = [
+            prefix + name
+            for prefix in jobs
+            for name in (
+                self._DEFAULT_OUTPUT_FILE,
+                self._DEFAULT_RESTART_FILE_NAME,
+                self._DEFAULT_TRAJECT_FILE_NAME,
+                self._DEFAULT_TRAJECT_XYZ_FILE_NAME,
+                self._DEFAULT_TRAJECT_FORCES_FILE_NAME,
+                self._DEFAULT_TRAJECT_CELL_FILE_NAME,
+            )
+        ]
+        if farming_groups is not None:
+            calcinfo.retrieve_list.append(self._DEFAULT_OUTPUT_FILE)
+        calcinfo.retrieve_list += settings.pop("additional_retrieve_list", [])
+
+        # Settings for the parsers, checked now rather than when parsing the outputs of the finished job.
+        self._validate_parser_settings(settings)
+        for key in self._PARSER_SETTINGS:
+            settings.pop(key, None)
+
+        # Symlinks.
+        calcinfo.remote_symlink_list = []
+        calcinfo.remote_copy_list = []
+        if "parent_calc_folder" in self.inputs:
+            comp_uuid = self.inputs.parent_calc_folder.computer.uuid
+            remote_path = self.inputs.parent_calc_folder.get_remote_path()
+            copy_info = (comp_uuid, remote_path, self._DEFAULT_PARENT_CALC_FLDR_NAME)
+
+            # If running on the same computer - make a symlink.
+            if self.inputs.code.computer.uuid == comp_uuid:
+                calcinfo.remote_symlink_list.append(copy_info)
+            # If not - copy the folder.
+            else:
+                calcinfo.remote_copy_list.append(copy_info)
+
+        # Check for left over settings.
+        if settings:
+            raise InputValidationError(
+                f"The following keys have been found in the settings input node {self.pk}, but were not understood: "
+                + ",".join(settings.keys())
+            )
+
+        profiler.report(self.node, "cp2k_prepare_profile", self.logger)
+        return calcinfo
+
+    def _write_input(self, folder, prefix, structure, parameters, profiler):
+        """Write the cp2k input file and the coordinates of `structure`, with their names prefixed by `prefix`."""
+
         # Create cp2k input file.
-        inp = Cp2kInput(self.inputs.parameters.get_dict())
-        inp.add_keyword("GLOBAL/PROJECT", self._DEFAULT_PROJECT_NAME)
+        inp = Cp2kInput(parameters)
+        inp.add_keyword("GLOBAL/PROJECT", prefix + self._DEFAULT_PROJECT_NAME)
 
         # Create input structure(s).
-        if "structure" in self.inputs:
+        if structure is not None:
             # As far as I understand self.inputs.structure can't deal with tags
             # self.inputs.structure.export(folder.get_abs_path(self._DEFAULT_COORDS_FILE_NAME), fileformat="xyz")
-            self._write_structure(
-                self.inputs.structure, folder, self._DEFAULT_COORDS_FILE_NAME
-            )
+            with profiler.stage("write_structure"):
+                self._write_structure(
+                    structure, folder, prefix + self._DEFAULT_COORDS_FILE_NAME
+                )
 
             # modify the input dictionary accordingly
             for i, letter in enumerate("ABC"):
                 inp.add_keyword(
                     "FORCE_EVAL/SUBSYS/CELL/" + letter,
-                    "{:<15} {:<15} {:<15}".format(*self.inputs.structure.cell[i]),
+                    "{:<15} {:<15} {:<15}".format(*structure.cell[i]),
                     override=False,
                     conflicting_keys=["ABC", "ALPHA_BETA_GAMMA", "CELL_FILE_NAME"],
                 )
@@ -292,7 +518,7 @@ class Cp2kCalculation(CalcJob):
             topo = "FORCE_EVAL/SUBSYS/TOPOLOGY"
             inp.add_keyword(
                 topo + "/COORD_FILE_NAME",
-                self._DEFAULT_COORDS_FILE_NAME,
+                prefix + self._DEFAULT_COORDS_FILE_NAME,
                 override=False,
             )
             inp.add_keyword(
@@ -302,30 +528,23 @@ class Cp2kCalculation(CalcJob):
                 conflicting_keys=["COORDINATE"],
             )
 
-        # Create input trajectory files
-        if "trajectory" in self.inputs:
-            self._write_trajectories(
-                self.inputs.trajectory,
-                folder,
-                self._DEFAULT_INPUT_TRAJECT_XYZ_FILE_NAME,
-                self._DEFAULT_INPUT_CELL_FILE_NAME,
-            )
-
         if "basissets" in self.inputs:
-            validate_basissets(
-                inp,
-                self.inputs.basissets,
-                self.inputs.structure if "structure" in self.inputs else None,
-            )
-            write_basissets(inp, self.inputs.basissets, folder)
+            with profiler.stage("write_basissets"):
+                validate_basissets(
+                    inp,
+                    self.inputs.basissets,
+                    structure,
+                )
+                write_basissets(inp, self.inputs.basissets, folder)
 
         if "pseudos" in self.inputs:
-            validate_pseudos(
-                inp,
-                self.inputs.pseudos,
-                self.inputs.structure if "structure" in self.inputs else None,
-            )
-            write_pseudos(inp, self.inputs.pseudos, folder)
+            with profiler.stage("write_pseudos"):
+                validate_pseudos(
+                    inp,
+                    self.inputs.pseudos,
+                    structure,
+                )
+                write_pseudos(inp, self.inputs.pseudos, folder)
 
         if "pseudos_upf" in self.inputs:
             for atom_kind, pseudo in self.inputs.pseudos_upf.items():
@@ -352,80 +571,71 @@ class Cp2kCalculation(CalcJob):
                 },
             )
 
+        with profiler.stage("write_input") as record:
+            with open(
+                folder.get_abs_path(prefix + self._DEFAULT_INPUT_FILE),
+                mode="w",
+                encoding="utf-8",
+            ) as fobj:
+                try:
+                    content = inp.render()
+                except ValueError as exc:
+                    raise InputValidationError(
+                        "Invalid keys or values in input parameters found"
+                    ) from exc
+                fobj.write(content)
+                profiler.count_content(record, content)
+
+    def _write_farming_input(self, folder, prefixes, groups, parameters):
+        """Write the input of the FARMING run of the packed jobs with the file `prefixes` in `groups` groups."""
+        farming = {
+            "GLOBAL": {
+                "PROJECT": self._DEFAULT_PROJECT_NAME,
+                "RUN_TYPE": "FARMING",
+            },
+            "FARMING": {
+                "NGROUPS": groups,
+                "JOB": [
+                    {
+                        "DIRECTORY": ".",
+                        "INPUT_FILE_NAME": prefix + self._DEFAULT_INPUT_FILE,
+                        "OUTPUT_FILE_NAME": prefix + self._DEFAULT_OUTPUT_FILE,
+                        "JOB_ID": job_id,
+                    }
+                    for job_id, prefix in enumerate(prefixes, start=1)
+                ],
+            },
+        }
+
+        # The whole run has to stop in time, not only the jobs.
+        if "WALLTIME" in parameters.get("GLOBAL", {}):
+            farming["GLOBAL"]["WALLTIME"] = parameters["GLOBAL"]["WALLTIME"]
+
         with open(
             folder.get_abs_path(self._DEFAULT_INPUT_FILE), mode="w", encoding="utf-8"
         ) as fobj:
-            try:
-                fobj.write(inp.render())
-            except ValueError as exc:
-                raise InputValidationError(
-                    "Invalid keys or values in input parameters found"
-                ) from exc
-
-        settings = self.inputs.settings.get_dict() if "settings" in self.inputs else {}
-
-        # Create code info.
-        codeinfo = CodeInfo()
-        codeinfo.cmdline_params = settings.pop("cmdline", []) + [
-            "-i",
-            self._DEFAULT_INPUT_FILE,
-        ]
-        codeinfo.stdout_name = self._DEFAULT_OUTPUT_FILE
-        codeinfo.join_files = True
-        codeinfo.code_uuid = self.inputs.code.uuid
+            fobj.write(Cp2kInput(farming).render())
 
-        # Create calc info.
-        calcinfo = CalcInfo()
-        calcinfo.uuid = self.uuid
-        calcinfo.cmdline_params = codeinfo.cmdline_params
-        calcinfo.stdin_name = self._DEFAULT_INPUT_FILE
-        calcinfo.stdout_name = self._DEFAULT_OUTPUT_FILE
-        calcinfo.codes_info = [codeinfo]
-
-        # Files or additional structures.
-        if "file" in self.inputs:
-            calcinfo.local_copy_list = []
-            for name, obj in self.inputs.file.items():
-                if isinstance(obj, SinglefileData):
-                    calcinfo.local_copy_list.append(
-                        (obj.uuid, obj.filename, obj.filename)
-                    )
-                elif isinstance(obj, StructureData):
-                    self._write_structure(obj, folder, name + ".xyz")
-
-        calcinfo.retrieve_list = [
-            self._DEFAULT_OUTPUT_FILE,
-            self._DEFAULT_RESTART_FILE_NAME,
-            self._DEFAULT_TRAJECT_FILE_NAME,
-            self._DEFAULT_TRAJECT_XYZ_FILE_NAME,
-            self._DEFAULT_TRAJECT_FORCES_FILE_NAME,
-            self._DEFAULT_TRAJECT_CELL_FILE_NAME,
-        ]
-        calcinfo.retrieve_list += settings.pop("additional_retrieve_list", [])
-
-        # Symlinks.
-        calcinfo.remote_symlink_list = []
-        calcinfo.remote_copy_list = []
-        if "parent_calc_folder" in self.inputs:
-            comp_uuid = self.inputs.parent_calc_folder.computer.uuid
-            remote_path = self.inputs.parent_calc_folder.get_remote_path()
-            copy_info = (comp_uuid, remote_path, self._DEFAULT_PARENT_CALC_FLDR_NAME)
-
-            # If running on the same computer - make a symlink.
-            if self.inputs.code.computer.uuid == comp_uuid:
-                calcinfo.remote_symlink_list.append(copy_info)
-            # If not - copy the folder.
-            else:
-                calcinfo.remote_copy_list.append(copy_info)
-
-        # Check for left over settings.
-        if settings:
+    @staticmethod
+    def _validate_parser_settings(settings):
+        """Raise an InputValidationError if the settings for the parsers are not valid."""
+        try:
+            if settings.get("parser_fields") is not None:
+                validate_advanced_parser_fields(settings["parser_fields"])
+            if "parser_tools_blocks" in settings or "parser_tools_history" in settings:
+                validate_tools_stream_options(
+                    settings.get("parser_tools_blocks"),
+                    settings.get("parser_tools_history", 1),
+                )
+        except ValueError as exception:
             raise InputValidationError(
-                f"The following keys have been found in the settings input node {self.pk}, but were not understood: "
-                + ",".join(settings.keys())
-            )
+                f"Invalid settings for the parser: {exception}"
+            ) from exception
 
-        return calcinfo
+    @staticmethod
+    def _get_job_prefix(key):
+        """Return the prefix of the files of the calculation of the packed structure `key`."""
+        return f"{key}_"
 
     @staticmethod
     def _write_structure(structure, folder, name):
@@ -0,0 +1,114 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Monitors for running CP2K calculations."""
+
+from pathlib import PurePosixPath
+
+from aiida.common.escaping import escape_for_bash
+
+from ..utils.parser import ScfTableTracker
+
+# Extra of the calculation node holding the offset in the output file and the state of the monitor.
+MONITOR_STATE_EXTRA = "cp2k_monitor_state"
+
+
+def _initial_monitor_state():
+    return {
+        "offset": 0,
+        "scf_outer_step": -1,
+        "in_scf_table": False,
+        "last_scf_convergence": None,
+        "unconverged_scf": 0,
+        "lowest_energy": None,
+        "steps_without_lower_energy": 0,
+    }
+
+
+def _update_monitor_state(state, lines):
+    """Update the monitor state with new (complete) lines of the CP2K output."""
+    scf_table = ScfTableTracker(state.get("scf_outer_step", -1), state["in_scf_table"])
+    for line in lines:
+        row = scf_table.update(line)
+        if row is not None and row[4] is not None:
+            state["last_scf_convergence"] = float(row[4])
+
+        if "SCF run NOT converged" in line:
+            state["unconverged_scf"] += 1
+        elif "SCF run converged" in line:
+            state["unconverged_scf"] = 0
+
+        if line.startswith(" ENERGY| "):
+            energy = float(line.split()[8])
+            if state["lowest_energy"] is None or energy < state["lowest_energy"]:
+                state["lowest_energy"] = energy
+                state["steps_without_lower_energy"] = 0
+            else:
+                state["steps_without_lower_energy"] += 1
+
+    state["scf_outer_step"] = scf_table.outer_step
+    state["in_scf_table"] = scf_table.in_table
+
+
+def monitor_output(
+    node,
+    transport,
+    scf_convergence_limit=None,
+    max_unconverged_scf=None,
+    max_steps_without_lower_energy=None,
+    max_lines_per_poll=1000000,
+):
+    """Follow the output of a running CP2K calculation and kill it once it went astray.
+
+    Only the part of the output written since the previous poll is fetched from the remote computer.
+    The offset and the parsing state are kept in the `cp2k_monitor_state` extra of the calculation.
+
+    :param scf_convergence_limit: kill if the convergence of an SCF iteration exceeds this value (diverging SCF).
+    :param max_unconverged_scf: kill after this number of consecutive SCF runs that did not converge.
+    :param max_steps_without_lower_energy: kill if the energy did not reach a new minimum for this number of
+        energy evaluations (stuck geometry or cell optimization).
+    :param max_lines_per_poll: maximum number of lines fetched per poll, the rest is read at the following ones.
+    :returns: a message if the calculation should be killed, None otherwise.
+    """
+    workdir = node.get_remote_workdir()
+    if workdir is None:
+        return None
+
+    state = node.base.extras.get(MONITOR_STATE_EXTRA, None) or _initial_monitor_state()
+    path = PurePosixPath(workdir) / node.base.attributes.get("output_filename")
+    retval, stdout, _ = transport.exec_command_wait_bytes(
+        f"tail -c +{state['offset'] + 1} {escape_for_bash(str(path))} | head -n {int(max_lines_per_poll)}"
+    )
+    if retval != 0:
+        return None
+
+    # The last line may not be complete yet, it is read again at the next poll. The offset is counted in
+    # bytes of the file, as the decoded text may not encode back to the same number of bytes.
+    complete = stdout[: stdout.rfind(b"\n") + 1]
+    state["offset"] += len(complete)
+    _update_monitor_state(state, complete.decode(errors="replace").splitlines())
+    node.base.extras.set(MONITOR_STATE_EXTRA, state)
+
+    if (
+        scf_convergence_limit is not None
+        and state["last_scf_convergence"] is not None
+        and state["last_scf_convergence"] > scf_convergence_limit
+    ):
+        return f"The SCF is diverging: convergence {state['last_scf_convergence']} > {scf_convergence_limit}."
+    if (
+        max_unconverged_scf is not None
+        and state["unconverged_scf"] >= max_unconverged_scf
+    ):
+        return f"{state['unconverged_scf']} consecutive SCF runs did not converge."
+    if (
+        max_steps_without_lower_energy is not None
+        and state["steps_without_lower_energy"] >= max_steps_without_lower_energy
+    ):
+        return (
+            f"The energy did not decrease below {state['lowest_energy']} a.u. "
+            f"for {state['steps_without_lower_energy']} steps."
+        )
+    return None
@@ -6,6 +6,7 @@
 ###############################################################################
 """AiiDA-CP2K output parser."""
 
+import concurrent.futures
 import re
 
 import ase
@@ -13,14 +14,60 @@ import numpy as np
 from aiida import common, engine, orm, parsers, plugins
 
 from .. import utils
-
+from .cache import (
+    DiskParseResultCache,
+    ParseResultCache,
+    cached_parse,
+    get_parse_cache,
+    set_parse_cache,
+)
+
+ArrayData = plugins.DataFactory("core.array")
 StructureData = plugins.DataFactory("core.structure")
 BandsData = plugins.DataFactory("core.array.bands")
 
 
+def _get_future(function, *args, **kwargs):
+    """Call `function` and return a completed future holding its result, or the exception it raised.
+
+    The exception is only raised when the result is taken, so that a file that can not be parsed only fails the
+    outputs that need it.
+    """
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(function(*args, **kwargs))
+    except Exception as exception:
+        future.set_exception(exception)
+    return future
+
+
+def _parse_restart(content):
+    """Parse the final structure and the MD state from the content of the CP2K restart file."""
+    structure_dict = utils.parse_cp2k_trajectory(content, velocities=True)
+    md_state = utils.parse_cp2k_md_state(content)
+    if "velocities" in structure_dict:
+        md_state["velocities"] = structure_dict.pop("velocities")
+    return structure_dict, md_state
+
+
+__all__ = [
+    "Cp2kAdvancedParser",
+    "Cp2kBaseParser",
+    "Cp2kToolsParser",
+    "DiskParseResultCache",
+    "ParseResultCache",
+    "get_parse_cache",
+    "set_parse_cache",
+]
+
+
 class Cp2kBaseParser(parsers.Parser):
     """Basic AiiDA parser for the output of CP2K."""
 
+    # Prefix of the file names and output namespace of the packed structure being parsed.
+    _job_prefix = ""
+    _output_namespace = ""
+
     def parse(self, **kwargs):
         """Receives in input a dictionary of retrieved nodes. Does all the logic here."""
 
@@ -33,12 +80,32 @@ class Cp2kBaseParser(parsers.Parser):
         except common.NotExistent:
             return self.exit_codes.ERROR_NO_RETRIEVED_FOLDER
 
-        exit_code = self._parse_stdout()
+        # Timing and memory of the parsing stages, stored as extra of the calculation.
+        self._profiler = utils.StageProfiler(self._get_settings().get("profile", False))
+
+        # Structures packed in the same job are parsed into their own output namespace.
+        if "structures" in self.node.inputs:
+            exit_code = self._parse_packed_jobs()
+        else:
+            exit_code = self._parse_job(self._parse_files())
+
+        self._profiler.report(self.node, "cp2k_parser_profile", self.logger)
+        return exit_code
+
+    def _parse_job(self, parsed_files):
+        """Parse the output files of a single CP2K run, whose restart and trajectory files are in `parsed_files`."""
+        with self._profiler.stage("stdout"):
+            exit_code = self._parse_stdout(parsed_files)
+
+        if self._get_settings().get("parser_timing", False):
+            with self._profiler.stage("timing"):
+                self._parse_timing()
 
         # Even though the simpulation might have failed, we still want to parse the output structure.
         last_structure = None
         try:
-            last_structure = self._parse_final_structure()
+            with self._profiler.stage("final_structure"):
+                last_structure = self._parse_final_structure(parsed_files)
             if isinstance(last_structure, StructureData):
                 self.out("output_structure", last_structure)
         except common.NotExistent:
@@ -47,7 +114,8 @@ class Cp2kBaseParser(parsers.Parser):
         trajectory = None
         try:
             if last_structure is not None:
-                trajectory = self._parse_trajectory(last_structure)
+                with self._profiler.stage("trajectory"):
+                    trajectory = self._parse_trajectory(last_structure, parsed_files)
                 if isinstance(trajectory, orm.TrajectoryData):
                     self.out("output_trajectory", trajectory)
         except common.NotExistent:
@@ -62,11 +130,131 @@ class Cp2kBaseParser(parsers.Parser):
 
         return engine.ExitCode(0)
 
-    def _parse_stdout(self):
+    def _parse_packed_jobs(self):
+        """Parse the outputs of the structures packed in the same job into the `structures` output namespace.
+
+        The `output_parameters` summarize the energy and the exit status of each structure. The exit code is
+        the one of the FARMING run if it failed (e.g., out of wall time), otherwise the one of the first structure
+        that failed.
+        """
+        process_class = self.node.process_class
+        keys = sorted(self.node.inputs.structures)
+
+        # The output of the FARMING run tells whether the whole run stopped early.
+        exit_code = engine.ExitCode(0)
+        if "farming_groups" in self._get_settings():
+            farming_exit_code, output_string = self._read_stdout()
+            if not farming_exit_code:
+                farming_exit_code = self._check_stdout_for_errors(output_string)
+            if farming_exit_code:
+                self.logger.warning(
+                    f"The FARMING run failed: {farming_exit_code.message}"
+                )
+                exit_code = farming_exit_code
+
+        summary = {}
+        for key in keys:
+            self._job_prefix = process_class._get_job_prefix(key)
+            self._output_namespace = f"structures.{key}."
+            job_exit_code = self._parse_job(self._parse_files(stdout=True))
+            self._output_namespace = ""
+
+            output_parameters = self.outputs.get(f"structures.{key}.output_parameters")
+            summary[key] = {
+                "energy": (
+                    output_parameters.get("energy") if output_parameters else None
+                ),
+                "exit_status": job_exit_code.status,
+            }
+            if exit_code.status == 0:
+                exit_code = job_exit_code
+
+        self.out("output_parameters", orm.Dict({"structures": summary}))
+        return exit_code
+
+    def out(self, link_label, node):
+        """Attach an output, in the namespace of the packed structure being parsed if any."""
+        super().out(self._output_namespace + link_label, node)
+
+    def _get_job_file_name(self, name):
+        """Return the name of the retrieved file `name` of the CP2K run being parsed."""
+        return self._job_prefix + name
+
+    def _parse_files(self, stdout=False):
+        """Read and parse the restart and trajectory files, and the standard output as `output` if `stdout` is True.
+
+        Returns a dictionary of completed futures for the files that were retrieved. If a file could not be read
+        or parsed, its future holds the exception. The content of the standard output is kept as `stdout`, so that
+        it is read only once.
+        """
+        process_class = self.node.process_class
+        file_parsers = {
+            "restart": (process_class._DEFAULT_RESTART_FILE_NAME, _parse_restart, {}),
+            "positions": (
+                process_class._DEFAULT_TRAJECT_XYZ_FILE_NAME,
+                utils.parse_cp2k_xyz_trajectory,
+                {},
+            ),
+            "forces": (
+                process_class._DEFAULT_TRAJECT_FORCES_FILE_NAME,
+                utils.parse_cp2k_xyz_trajectory,
+                {"frame_info": False},
+            ),
+            "cells": (
+                process_class._DEFAULT_TRAJECT_CELL_FILE_NAME,
+                utils.parse_cp2k_cell_trajectory,
+                {},
+            ),
+        }
+        stdout_parser = self._get_stdout_parser() if stdout else None
+        if stdout_parser is not None:
+            file_parsers["output"] = (
+                self.node.base.attributes.get("output_filename"),
+                *stdout_parser,
+            )
+
+        retrieved_names = self.retrieved.base.repository.list_object_names()
+        parsed_files = {}
+        for key, (fname, function, kwargs) in file_parsers.items():
+            fname = self._get_job_file_name(fname)
+            if fname not in retrieved_names:
+                continue
+            try:
+                with self._profiler.stage(f"read_{key}") as record:
+                    content = self.retrieved.base.repository.get_object_content(fname)
+                    self._profiler.count_content(record, content)
+            except OSError as exception:
+                for name in (key, "stdout") if key == "output" else (key,):
+                    parsed_files[name] = concurrent.futures.Future()
+                    parsed_files[name].set_exception(exception)
+                continue
+            if key == "output":
+                parsed_files["stdout"] = concurrent.futures.Future()
+                parsed_files["stdout"].set_result(content)
+            parsed_files[key] = _get_future(
+                self._profiler.wrap(f"parse_{key}", cached_parse),
+                function,
+                content,
+                **kwargs,
+            )
+        return parsed_files
+
+    def _get_stdout_parser(self):
+        """Return the function parsing the standard output and its keyword arguments."""
+        return utils.parse_cp2k_output, {}
+
+    def _get_parsed_stdout(self, parsed_files, output_string):
+        """Return the parsed standard output, taken from `parsed_files` if it was parsed there."""
+        if "output" in parsed_files:
+            return parsed_files["output"].result()
+        function, kwargs = self._get_stdout_parser()
+        return cached_parse(function, output_string, **kwargs)
+
+    def _parse_stdout(self, parsed_files):
         """Basic CP2K output file parser."""
 
         # Read the standard output of CP2K.
-        exit_code, output_string = self._read_stdout()
+        exit_code, output_string = self._read_stdout(parsed_files)
         if exit_code:
             return exit_code
 
@@ -78,29 +266,57 @@ class Cp2kBaseParser(parsers.Parser):
             return exit_code
 
         # Parse the standard output.
-        result_dict = utils.parse_cp2k_output(output_string)
+        with self._profiler.stage("parse_stdout"):
+            result_dict = self._get_parsed_stdout(parsed_files, output_string)
         self.out("output_parameters", orm.Dict(dict=result_dict))
         return exit_code
 
-    def _parse_final_structure(self):
+    def _parse_timing(self):
+        """Store the timing report at the end of the CP2K output as `output_timing`."""
+        fname = self._get_job_file_name(
+            self.node.base.attributes.get("output_filename")
+        )
+        if fname not in self.retrieved.base.repository.list_object_names():
+            return
+        with self.retrieved.base.repository.open(fname) as handle:
+            timing = utils.parse_cp2k_timing_report(handle)
+        if timing:
+            self.out("output_timing", self._to_array_data(timing))
+
+    def _parse_final_structure(self, parsed_files):
         """CP2K trajectory parser."""
-        fname = self.node.process_class._DEFAULT_RESTART_FILE_NAME
 
         # Check if the restart file is present.
-        if fname not in self.retrieved.base.repository.list_object_names():
+        if "restart" not in parsed_files:
             raise common.NotExistent(
                 "No restart file available, so the output trajectory can't be extracted"
             )
 
         # Read the restart file.
         try:
-            output_string = self.retrieved.base.repository.get_object_content(fname)
+            structure_dict, md_state = parsed_files["restart"].result()
         except OSError:
             return self.exit_codes.ERROR_OUTPUT_STDOUT_READ
 
-        return StructureData(
-            ase=ase.Atoms(**utils.parse_cp2k_trajectory(output_string))
-        )
+        # Store the MD state, so that MD can be continued without the restart file.
+        if md_state:
+            self.out("output_md_state", self._to_array_data(md_state))
+
+        return StructureData(ase=ase.Atoms(**structure_dict))
+
+    def _get_settings(self):
+        """Return the settings of the calculation as a dictionary."""
+        if "settings" in self.node.inputs:
+            return self.node.inputs.settings.get_dict()
+        return {}
+
+    @staticmethod
+    def _to_array_data(arrays):
+        """Create an `ArrayData` node from a dictionary of numpy arrays."""
+        array_data = ArrayData()
+        for name, array in arrays.items():
+            array_data.set_array(name, array)
+        return array_data
 
     def _check_stdout_for_errors(self, output_string):
         """This function checks the CP2K output file for some basic errors."""
@@ -124,93 +340,65 @@ class Cp2kBaseParser(parsers.Parser):
 
         return None
 
-    def _read_stdout(self):
-        """Read the standard output file. If impossible, return a non-zero exit code."""
+    def _read_stdout(self, parsed_files=None):
+        """Read the standard output file. If impossible, return a non-zero exit code.
+
+        The content already read by `_parse_files` is taken (once) from `parsed_files`.
+        """
+        if parsed_files is not None and "stdout" in parsed_files:
+            try:
+                return None, parsed_files.pop("stdout").result()
+            except OSError:
+                return self.exit_codes.ERROR_OUTPUT_READ, None
 
-        fname = self.node.base.attributes.get("output_filename")
+        fname = self._get_job_file_name(
+            self.node.base.attributes.get("output_filename")
+        )
 
         if fname not in self.retrieved.base.repository.list_object_names():
             return self.exit_codes.ERROR_OUTPUT_STDOUT_MISSING, None
         try:
-            output_string = self.retrieved.base.repository.get_object_content(fname)
+            with self._profiler.stage("read_stdout") as record:
+                output_string = self.retrieved.base.repository.get_object_content(fname)
+                self._profiler.count_content(record, output_string)
         except OSError:
             return self.exit_codes.ERROR_OUTPUT_READ, None
 
         return None, output_string
 
-    def _parse_trajectory(self, structure):
+    def _parse_trajectory(self, structure, parsed_files):
         """CP2K trajectory parser."""
 
         symbols = [re.sub(r"\d+", "", str(site.kind_name)) for site in structure.sites]
 
         # Handle the positions trajectory
-        xyz_traj_fname = self.node.process_class._DEFAULT_TRAJECT_XYZ_FILE_NAME
-
-        # Read the trajectory file.
         try:
-            output_xyz_pos = self.retrieved.base.repository.get_object_content(
-                xyz_traj_fname
-            )
-        except OSError:
+            positions_traj = parsed_files["positions"].result()
+        except (KeyError, OSError):
             return self.exit_codes.ERROR_COORDINATES_TRAJECTORY_READ
 
-        from cp2k_output_tools.trajectories.xyz import parse
-
-        positions_traj = []
-        stepids_traj = []
-        energies_traj = []
-        for frame in parse(output_xyz_pos):
-            _, positions = zip(*frame["atoms"])
-            positions_traj.append(positions)
-            comment_split = frame["comment"].split(",")
-            stepids_traj.append(int(comment_split[0].split()[-1]))
-            energy_index = next(
-                (i for i, s in enumerate(comment_split) if "E =" in s), None
-            )
-            energies_traj.append(float(comment_split[energy_index].split()[-1]))
-        positions_traj = np.array(positions_traj)
-        stepids_traj = np.array(stepids_traj)
-        energies_traj = np.array(energies_traj)
-
         cell_traj = None
-        cell_traj_fname = self.node.process_class._DEFAULT_TRAJECT_CELL_FILE_NAME
         try:
-            if cell_traj_fname in self.retrieved.base.repository.list_object_names():
-                output_cell_pos = self.retrieved.base.repository.get_object_content(
-                    cell_traj_fname
-                )
-                cell_traj = np.array(
-                    [
-                        np.fromstring(line, sep=" ")[2:-1].reshape(3, 3)
-                        for line in output_cell_pos.splitlines()[1:]
-                    ]
-                )
+            if "cells" in parsed_files:
+                cell_traj = parsed_files["cells"].result()
         except OSError:
             return self.exit_codes.ERROR_CELLS_TRAJECTORY_READ
 
         forces_traj = None
-        forces_traj_fname = self.node.process_class._DEFAULT_TRAJECT_FORCES_FILE_NAME
         try:
-            if forces_traj_fname in self.retrieved.base.repository.list_object_names():
-                output_forces = self.retrieved.base.repository.get_object_content(
-                    forces_traj_fname
-                )
-                forces_traj = []
-                for frame in parse(output_forces):
-                    _, forces = zip(*frame["atoms"])
-                    forces_traj.append(forces)
-                forces_traj = np.array(forces_traj)
+            if "forces" in parsed_files:
+                forces_traj = parsed_files["forces"].result()["coords"]
         except OSError:
             return self.exit_codes.ERROR_FORCES_TRAJECTORY_READ
 
         trajectory = orm.TrajectoryData()
         trajectory.set_trajectory(
-            stepids=stepids_traj,
+            stepids=positions_traj["stepids"],
             cells=cell_traj,
             symbols=symbols,
-            positions=positions_traj,
+            positions=positions_traj["coords"],
         )
-        trajectory.set_array("energies", energies_traj)
+        trajectory.set_array("energies", positions_traj["energies"])
         if forces_traj is not None:
             trajectory.set_array("forces", forces_traj)
 
@@ -220,11 +408,18 @@ class Cp2kBaseParser(parsers.Parser):
 class Cp2kAdvancedParser(Cp2kBaseParser):
     """Advanced AiiDA parser class for the output of CP2K."""
 
-    def _parse_stdout(self):
+    def _get_stdout_parser(self):
+        settings = self._get_settings()
+        return utils.parse_cp2k_output_advanced, {
+            "eigen_blocks": settings.get("parser_eigen_blocks", 1),
+            "fields": settings.get("parser_fields"),
+        }
+
+    def _parse_stdout(self, parsed_files):
         """Advanced CP2K output file parser."""
 
         # Read the standard output of CP2K.
-        exit_code, output_string = self._read_stdout()
+        exit_code, output_string = self._read_stdout(parsed_files)
         if exit_code:
             return exit_code
 
@@ -236,27 +431,30 @@ class Cp2kAdvancedParser(Cp2kBaseParser):
             return exit_code
 
         # Parse the standard output.
-        result_dict = utils.parse_cp2k_output_advanced(output_string)
+        settings = self._get_settings()
+        with self._profiler.stage("parse_stdout"):
+            result_dict = self._get_parsed_stdout(parsed_files, output_string)
 
         # Compute the bandgap for Spin1 and Spin2 if eigen was parsed (works also with smearing!)
         if "eigen_spin1_au" in result_dict:
             if result_dict["dft_type"] == "RKS":
                 result_dict["eigen_spin2_au"] = result_dict["eigen_spin1_au"]
 
-            lumo_spin1_idx = result_dict["init_nel_spin1"]
-            lumo_spin2_idx = result_dict["init_nel_spin2"]
-            if (lumo_spin1_idx > len(result_dict["eigen_spin1_au"]) - 1) or (
-                lumo_spin2_idx > len(result_dict["eigen_spin2_au"]) - 1
-            ):
+            eigens = [
+                np.asarray(result_dict["eigen_spin1_au"]),
+                np.asarray(result_dict["eigen_spin2_au"]),
+            ]
+            lumo_idx = np.array(
+                [result_dict["init_nel_spin1"], result_dict["init_nel_spin2"]]
+            )
+            last_idx = np.array([len(eigen) for eigen in eigens]) - 1
+            if (lumo_idx > last_idx).any():
                 # electrons jumped from spin1 to spin2 (or opposite): assume last eigen is lumo
-                lumo_spin1_idx = len(result_dict["eigen_spin1_au"]) - 1
-                lumo_spin2_idx = len(result_dict["eigen_spin2_au"]) - 1
-            homo_spin1 = result_dict["eigen_spin1_au"][lumo_spin1_idx - 1]
-            homo_spin2 = result_dict["eigen_spin2_au"][lumo_spin2_idx - 1]
-            lumo_spin1 = result_dict["eigen_spin1_au"][lumo_spin1_idx]
-            lumo_spin2 = result_dict["eigen_spin2_au"][lumo_spin2_idx]
-            result_dict["bandgap_spin1_au"] = lumo_spin1 - homo_spin1
-            result_dict["bandgap_spin2_au"] = lumo_spin2 - homo_spin2
+                lumo_idx = last_idx
+            for spin, (eigen, lumo) in enumerate(zip(eigens, lumo_idx), start=1):
+                result_dict[f"bandgap_spin{spin}_au"] = float(
+                    eigen[lumo] - eigen[lumo - 1]
+                )
 
         kpoint_data = result_dict.pop("kpoint_data", None)
         if kpoint_data:
@@ -269,6 +467,23 @@ class Cp2kAdvancedParser(Cp2kBaseParser):
             )
             self.out("output_bands", bnds)
 
+        scf_history = result_dict.pop("scf_history", None)
+        if scf_history:
+            self.out("output_scf_history", self._to_array_data(scf_history))
+
+        # Move the per-step data to the file repository, only scalars remain in the Dict.
+        # The retained eigenvalue blocks are numpy arrays and always go there.
+        if settings.get("parser_output_arrays", False):
+            per_step_arrays = utils.pop_per_step_arrays(result_dict)
+        else:
+            per_step_arrays = {
+                key: result_dict.pop(key)
+                for key in ("eigen_spin1_blocks_au", "eigen_spin2_blocks_au")
+                if key in result_dict
+            }
+        if per_step_arrays:
+            self.out("output_arrays", self._to_array_data(per_step_arrays))
+
         self.out("output_parameters", orm.Dict(dict=result_dict))
         return exit_code
 
@@ -276,13 +491,29 @@ class Cp2kAdvancedParser(Cp2kBaseParser):
 class Cp2kToolsParser(Cp2kBaseParser):
     """AiiDA parser class for the output of CP2K based on the cp2k-output-tools project."""
 
-    def _parse_stdout(self):
+    # Substrings of the lines needed by `_check_stdout_for_errors`.
+    _STDOUT_ERROR_MARKERS = (
+        "ABORT",
+        "SCF run NOT converged. To continue the calculation regardless",
+        "exceeded requested execution time",
+        "PROGRAM STOPPED IN",
+        "MAXIMUM NUMBER OF OPTIMIZATION STEPS REACHED",
+    )
+
+    def _get_stdout_parser(self):
+        if "parser_tools_blocks" in self._get_settings():
+            return None  # The standard output is streamed by `_parse_stdout_stream`.
+        return utils.parse_cp2k_output_tools, {}
+
+    def _parse_stdout(self, parsed_files):
         """Very advanced CP2K output file parser."""
 
-        from cp2k_output_tools import parse_iter
+        settings = self._get_settings()
+        if "parser_tools_blocks" in settings:
+            return self._parse_stdout_stream(settings)
 
         # Read the standard output of CP2K.
-        exit_code, output_string = self._read_stdout()
+        exit_code, output_string = self._read_stdout(parsed_files)
         if exit_code:
             return exit_code
 
@@ -294,21 +525,48 @@ class Cp2kToolsParser(Cp2kBaseParser):
             return exit_code
 
         # Parse the standard output.
+        with self._profiler.stage("parse_stdout"):
+            result_dict = self._get_parsed_stdout(parsed_files, output_string)
+        self.out("output_parameters", orm.Dict(dict=result_dict))
+        return exit_code
+
+    def _parse_stdout_stream(self, settings):
+        """Parse the standard output line by line, keeping only the requested blocks.
+
+        The output is never held in memory as a whole, which bounds the memory use for long MD runs.
+        """
+        fname = self._get_job_file_name(
+            self.node.base.attributes.get("output_filename")
+        )
+        if fname not in self.retrieved.base.repository.list_object_names():
+            return self.exit_codes.ERROR_OUTPUT_STDOUT_MISSING
 
-        result_dict = {}
+        # Only the lines relevant for the error checks are kept.
+        error_lines = []
 
-        # the CP2K output parser is a block-based parser return blocks of data, each under a block key
-        # merge them into one dict
-        for match in parse_iter(output_string, key_mangling=True):
-            result_dict.update(match)
+        def check_lines(handle):
+            for line in handle:
+                if any(marker in line for marker in self._STDOUT_ERROR_MARKERS):
+                    error_lines.append(line)
+                yield line
 
         try:
-            # the cp2k-output-tools parser is more hierarchical, be compatible with
-            # the basic parser here and provide the total force eval energy as energy
-            result_dict["energy"] = result_dict["energies"]["total_force_eval"]
-            result_dict["energy_units"] = "a.u."
-        except KeyError:
-            pass
+            with self._profiler.stage("parse_stdout"):
+                with self.retrieved.base.repository.open(fname) as handle:
+                    result_dict = utils.parse_cp2k_output_tools_stream(
+                        check_lines(handle),
+                        blocks=settings["parser_tools_blocks"],
+                        history=settings.get("parser_tools_history", 1),
+                    )
+        except OSError:
+            return self.exit_codes.ERROR_OUTPUT_READ
+
+        # Check the standard output for errors.
+        exit_code = self._check_stdout_for_errors("".join(error_lines))
+
+        # Return the error code if an error was severe enough to stop the parsing.
+        if exit_code in self.SEVERE_ERRORS:
+            return exit_code
 
         self.out("output_parameters", orm.Dict(dict=result_dict))
         return exit_code
@@ -0,0 +1,180 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Persistent cache for the results of the CP2K output parsers."""
+
+import abc
+import functools
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+from pathlib import Path
+
+from aiida.common.log import AIIDA_LOGGER
+
+from .. import __version__
+
+LOGGER = AIIDA_LOGGER.getChild("cp2k.parse_cache")
+
+_PARSE_CACHE = None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_module_digest(module_name):
+    """Return the hash of the source file of a module, empty if it cannot be read."""
+    try:
+        return hashlib.sha256(
+            Path(sys.modules[module_name].__file__).read_bytes()
+        ).hexdigest()
+    except (KeyError, AttributeError, TypeError, OSError):
+        return ""
+
+
+class ParseResultCache(abc.ABC):
+    """Base class for the parse-result caches, subclasses implement `get` and `set`."""
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Return the result stored under `key`, or None if it is not cached."""
+
+    @abc.abstractmethod
+    def set(self, key, result):
+        """Store the result under `key`."""
+
+    @staticmethod
+    def make_key(function, content, **kwargs):
+        """Build the key from the plugin version, the parse function, its options and the content hash.
+
+        The hash of the module defining the parse function is included too, so that the results of a modified
+        parser are not served by a development install whose version did not change.
+        """
+        digest = hashlib.sha256()
+        digest.update(
+            f"{__version__}:{_get_module_digest(function.__module__)}:"
+            f"{function.__module__}.{function.__qualname__}:{sorted(kwargs.items())!r}".encode()
+        )
+        digest.update(content.encode() if isinstance(content, str) else content)
+        return digest.hexdigest()
+
+
+class DiskParseResultCache(ParseResultCache):
+    """Parse-result cache storing one pickle file per result in a directory.
+
+    The least recently used entries are evicted once the directory exceeds `max_bytes`.
+    The directory must be trusted: unpickling an entry can execute arbitrary code, so only point it to a
+    directory that is not writable by others (not a shared scratch directory).
+    Entries that cannot be unpickled, e.g., written by another version of the plugin, are cache misses.
+    """
+
+    def __init__(self, directory, max_bytes=1024**3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return self.directory / f"{key}.pickle"
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with path.open("rb") as fobj:
+                result = pickle.load(fobj)
+            os.utime(path)  # Mark the entry as recently used.
+        except (
+            OSError,
+            EOFError,
+            pickle.UnpicklingError,
+            AttributeError,
+            ImportError,
+            IndexError,
+            TypeError,
+            ValueError,
+        ):
+            return None
+        return result
+
+    def set(self, key, result):
+        # Write to a temporary file first, so that concurrent readers never see partial entries.
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as fobj:
+                pickle.dump(result, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits in `max_bytes`."""
+        entries = []
+        for path in self.directory.glob("*.pickle"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+
+def set_parse_cache(cache):
+    """Set the parse-result cache used by the parsers (None disables caching)."""
+    global _PARSE_CACHE
+    _PARSE_CACHE = cache
+
+
+def get_parse_cache():
+    """Return the parse-result cache used by the parsers.
+
+    If none was set, a `DiskParseResultCache` is created in the directory given by the
+    `AIIDA_CP2K_PARSE_CACHE_DIR` environment variable (with the size limit in bytes given by
+    `AIIDA_CP2K_PARSE_CACHE_MAX_BYTES`). Without it, caching is disabled.
+    """
+    global _PARSE_CACHE
+    if _PARSE_CACHE is None and os.environ.get("AIIDA_CP2K_PARSE_CACHE_DIR"):
+        _PARSE_CACHE = DiskParseResultCache(
+            os.environ["AIIDA_CP2K_PARSE_CACHE_DIR"],
+            int(os.environ.get("AIIDA_CP2K_PARSE_CACHE_MAX_BYTES", 1024**3)),
+        )
+    return _PARSE_CACHE
+
+
+def cached_parse(function, content, **kwargs):
+    """Call `function(content, **kwargs)`, returning the cached result if the content was already parsed.
+
+    The cache never fails the parse: if an entry can not be read or stored, e.g. on a full disk or a read-only
+    directory, or if the result can not be pickled, a warning is logged and the content is parsed.
+    """
+    cache = get_parse_cache()
+    if cache is None:
+        return function(content, **kwargs)
+
+    key = cache.make_key(function, content, **kwargs)
+    try:
+        result = cache.get(key)
+    except Exception as exception:
+        LOGGER.warning(f"Could not read the parse-result cache: {exception}")
+        result = None
+    if result is None:
+        result = function(content, **kwargs)
+        try:
+            cache.set(key, result)
+        except Exception as exception:
+            LOGGER.warning(
+                f"Could not store the result in the parse-result cache: {exception}"
+            )
+    return result
@@ -7,18 +7,51 @@
 """AiiDA-CP2K utils"""
 
 from .datatype_helpers import (
+    get_motion_step_arrays,
+    merge_motion_step_info,
     merge_trajectory_data_non_unique,
     merge_trajectory_data_unique,
 )
+from .fingerprint import (
+    FINGERPRINT_EXTRA,
+    SIMILARITY_DESCRIPTOR_EXTRA,
+    SIMILARITY_EXTRA,
+    find_calculation_by_fingerprint,
+    get_inputs_fingerprint,
+    get_kinds_fingerprint,
+    get_parameters_fingerprint,
+    get_positions_descriptor,
+    get_similarity_fingerprint,
+    get_structure_fingerprint,
+    index_calculations,
+)
 from .input_generator import (
     Cp2kInput,
     add_ext_restart_section,
     add_first_snapshot_in_reftraj_section,
     add_ignore_convergence_failure,
+    add_md_state_section,
+    add_walltime_section,
     add_wfn_restart_section,
+    get_walltime_seconds,
     increase_geo_opt_max_iter_by_factor,
+    set_grid_cutoffs,
+)
+from .parser import (
+    Cp2kOutputParser,
+    parse_cp2k_cell_trajectory,
+    parse_cp2k_md_state,
+    parse_cp2k_output,
+    parse_cp2k_output_advanced,
+    parse_cp2k_output_tools,
+    parse_cp2k_output_tools_stream,
+    parse_cp2k_timing_report,
+    parse_cp2k_trajectory,
+    parse_cp2k_xyz_trajectory,
+    pop_per_step_arrays,
 )
-from .parser import parse_cp2k_output, parse_cp2k_output_advanced, parse_cp2k_trajectory
+from .profiling import StageProfiler, aggregate_timing_reports
+from .similarity import find_similar_calculation, get_positions_rmsd
 from .workchains import (
     HARTREE2EV,
     HARTREE2KJMOL,
@@ -26,32 +59,69 @@ from .workchains import (
     get_input_multiplicity,
     get_kinds_section,
     get_last_convergence_value,
+    get_layout_calibration,
+    has_remote_file,
     merge_dict,
     merge_Dict,
     ot_has_small_bandgap,
+    propose_parallel_layout,
     resize_unit_cell,
+    scale_resources,
 )
 
 __all__ = [
     "Cp2kInput",
+    "Cp2kOutputParser",
     "add_ext_restart_section",
     "add_ignore_convergence_failure",
     "add_first_snapshot_in_reftraj_section",
+    "add_md_state_section",
+    "add_walltime_section",
     "add_wfn_restart_section",
     "check_resize_unit_cell",
+    "find_calculation_by_fingerprint",
+    "find_similar_calculation",
+    "FINGERPRINT_EXTRA",
     "get_input_multiplicity",
+    "get_inputs_fingerprint",
+    "get_kinds_fingerprint",
     "get_kinds_section",
     "get_last_convergence_value",
+    "get_layout_calibration",
+    "get_motion_step_arrays",
+    "get_parameters_fingerprint",
+    "get_positions_descriptor",
+    "get_positions_rmsd",
+    "get_similarity_fingerprint",
+    "get_structure_fingerprint",
+    "get_walltime_seconds",
+    "has_remote_file",
     "HARTREE2EV",
     "HARTREE2KJMOL",
     "increase_geo_opt_max_iter_by_factor",
+    "index_calculations",
     "merge_dict",
     "merge_Dict",
+    "merge_motion_step_info",
     "merge_trajectory_data_unique",
     "merge_trajectory_data_non_unique",
     "ot_has_small_bandgap",
+    "parse_cp2k_cell_trajectory",
+    "parse_cp2k_md_state",
     "parse_cp2k_output",
     "parse_cp2k_output_advanced",
+    "parse_cp2k_output_tools",
+    "parse_cp2k_output_tools_stream",
+    "parse_cp2k_timing_report",
     "parse_cp2k_trajectory",
+    "parse_cp2k_xyz_trajectory",
+    "pop_per_step_arrays",
+    "propose_parallel_layout",
     "resize_unit_cell",
+    "scale_resources",
+    "set_grid_cutoffs",
+    "SIMILARITY_DESCRIPTOR_EXTRA",
+    "SIMILARITY_EXTRA",
+    "StageProfiler",
+    "aggregate_timing_reports",
 ]
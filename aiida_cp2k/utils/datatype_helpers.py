@@ -12,6 +12,8 @@ from collections.abc import Sequence
 import numpy as np
 from aiida import common, engine, orm, plugins
 
+from .parser import MOTION_STEP_INFO_KEYS, pop_per_step_arrays
+
 
 def _unpack(adict):
     """Unpack any lists as values into single elements for the key"""
@@ -473,3 +475,63 @@ def merge_trajectory_data_non_unique(*trajectories):
         *trajectories, unique_stepids=False
     )
     return _dictionary_to_trajectory(trajectory_dict, trajectories[0].symbols)
+
+
+def get_motion_step_arrays(node):
+    """Return the `motion_step_info` arrays of a calculation output.
+
+    The node is either the `output_arrays` ArrayData or the `output_parameters` Dict.
+    """
+    if isinstance(node, orm.ArrayData):
+        return {
+            name: node.get_array(name)
+            for name in MOTION_STEP_INFO_KEYS
+            if name in node.get_arraynames()
+        }
+    return pop_per_step_arrays({"motion_step_info": node.get("motion_step_info", {})})
+
+
+def _merge_motion_step_arrays(merged, arrays):
+    """Append the steps of `arrays` to `merged`.
+
+    The steps are identified by their number. A restarted CP2K run continues the numbering of its parent and
+    repeats its last steps: these are replaced by those of the restarted run, which are the more recent ones.
+    A run that starts its numbering over, e.g. an ENERGY run or a restart from scratch, is appended as is.
+    """
+    if not merged or not len(merged["step"]):
+        return dict(arrays)
+    if not arrays or not len(arrays["step"]):
+        return merged
+    if set(arrays) != set(merged):
+        raise ValueError(
+            "The motion step info of the calculations have different arrays."
+        )
+    steps = merged["step"]
+    first_step = arrays["step"][0]
+    # The steps of the last run start after the last time the numbering did not increase.
+    starts = np.flatnonzero(np.diff(steps) <= 0) + 1
+    last_run = starts[-1] if len(starts) else 0
+    keep = np.ones(len(steps), dtype=bool)
+    if first_step > steps[last_run]:
+        keep[last_run:] = steps[last_run:] < first_step
+    return {
+        name: np.concatenate([array[keep], arrays[name]], axis=0)
+        for name, array in merged.items()
+    }
+
+
+@engine.calcfunction
+def merge_motion_step_info(*nodes):
+    """Merge the `motion_step_info` of consecutive calculations into one ArrayData without repeated steps.
+
+    The nodes are the `output_arrays` (ArrayData) or `output_parameters` (Dict) of the calculations, in order.
+    A ValueError is raised if they do not have the same arrays.
+    """
+    merged = {}
+    for node in nodes:
+        merged = _merge_motion_step_arrays(merged, get_motion_step_arrays(node))
+
+    array_data = orm.ArrayData()
+    for name, array in merged.items():
+        array_data.set_array(name, array)
+    return array_data
@@ -0,0 +1,353 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""AiiDA-CP2K fingerprints of the calculation inputs, to find identical finished calculations."""
+
+import hashlib
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+from .input_generator import Cp2kInput
+
+FINGERPRINT_EXTRA = "cp2k_fingerprint"
+SIMILARITY_EXTRA = "cp2k_similarity_fingerprint"
+SIMILARITY_DESCRIPTOR_EXTRA = "cp2k_similarity_descriptor"
+
+# Keywords that do not change the results of a calculation.
+_IGNORED_KEYWORDS = ("GLOBAL/PROJECT", "GLOBAL/PROJECT_NAME", "GLOBAL/WALLTIME")
+
+# Sections and keywords of the geometry and of the initial guess, which differ between similar calculations.
+_GEOMETRY_KEYWORDS = (
+    "EXT_RESTART",
+    "FORCE_EVAL/DFT/RESTART_FILE_NAME",
+    "FORCE_EVAL/DFT/WFN_RESTART_FILE_NAME",
+    "FORCE_EVAL/DFT/SCF/SCF_GUESS",
+    "FORCE_EVAL/SUBSYS/CELL",
+    "FORCE_EVAL/SUBSYS/COORD",
+    "FORCE_EVAL/SUBSYS/TOPOLOGY",
+    "FORCE_EVAL/SUBSYS/VELOCITY",
+)
+
+# Inputs that do not change the results of a calculation.
+_IGNORED_INPUTS = ("metadata", "settings")
+
+
+def _get_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def _get_canonical_sites(kind_indices, fractional, pbc, decimals):
+    """Return the sites as integer rows (kind, x, y, z), independent of their order and of the origin.
+
+    Every atom of the kind with the fewest atoms is tried as origin: the positions are shifted, wrapped along
+    the periodic directions, rounded and sorted, and the smallest of the resulting arrays is kept.
+    """
+    scale = 10**decimals
+    counts = np.bincount(kind_indices)
+    origin_kind = np.argmin(np.where(counts > 0, counts, len(kind_indices) + 1))
+    periodic = np.asarray(pbc, dtype=bool)
+
+    best = None
+    for origin in np.flatnonzero(kind_indices == origin_kind):
+        positions = np.rint((fractional - fractional[origin]) * scale).astype(np.int64)
+        positions[:, periodic] %= scale
+        sites = np.column_stack((kind_indices, positions))
+        sites = sites[np.lexsort(sites.T[::-1])]
+        if best is None or tuple(sites.ravel()) < tuple(best.ravel()):
+            best = sites
+    return best
+
+
+def get_structure_fingerprint(structure, decimals=4):
+    """Return a hash of the structure that does not depend on the order of the atoms and on the origin.
+
+    The cell is described by its lengths and angles, so that rotated cells give the same hash, and the atoms by
+    their kinds and their fractional positions rounded to `decimals` digits.
+    """
+    cell = np.array(structure.cell)
+    lengths = np.linalg.norm(cell, axis=1)
+    angles = [
+        np.degrees(np.arccos(np.dot(cell[i], cell[j]) / (lengths[i] * lengths[j])))
+        for i, j in ((1, 2), (0, 2), (0, 1))
+    ]
+
+    kinds = sorted(structure.kinds, key=lambda kind: kind.name)
+    kind_names = [kind.name for kind in kinds]
+    kind_indices = np.array(
+        [kind_names.index(site.kind_name) for site in structure.sites], dtype=np.int64
+    )
+    positions = np.array([site.position for site in structure.sites])
+
+    sites = _get_canonical_sites(
+        kind_indices, positions @ np.linalg.inv(cell), structure.pbc, decimals
+    )
+    return _get_hash(
+        {
+            "cell": np.round(np.concatenate((lengths, angles)), decimals).tolist(),
+            "pbc": list(structure.pbc),
+            "kinds": [
+                [
+                    kind.name,
+                    list(kind.symbols),
+                    np.round(kind.weights, decimals).tolist(),
+                    round(kind.mass, decimals),
+                ]
+                for kind in kinds
+            ],
+            "sites": sites.tolist(),
+        }
+    )
+
+
+def _upper_keys(params):
+    """Return a copy of the parameters with all the section and keyword names in upper case."""
+    if isinstance(params, Mapping):
+        return {key.upper(): _upper_keys(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [_upper_keys(value) for value in params]
+    return params
+
+
+def get_parameters_fingerprint(parameters, geometry=True):
+    """Return a hash of the CP2K input rendered from the `parameters` dictionary.
+
+    Sections and keywords are compared in upper case with normalized whitespace, and the keywords in
+    `_IGNORED_KEYWORDS` (e.g., the walltime) are left out. If `geometry` is False, the sections and keywords of the
+    cell, the coordinates and the initial guess (`_GEOMETRY_KEYWORDS`) are left out as well.
+    """
+    ignored = _IGNORED_KEYWORDS if geometry else _IGNORED_KEYWORDS + _GEOMETRY_KEYWORDS
+
+    def is_ignored(name):
+        return any(name == key or name.startswith(key + "/") for key in ignored)
+
+    lines = []
+    path = []
+    # Index of the first line of the open sections and whether some of their content was left out.
+    openings = []
+    for line in Cp2kInput(_upper_keys(parameters)).render().splitlines():
+        words = line.split()
+        if not words or words[0].startswith("!"):
+            continue
+        if words[0] == "&END":
+            name = "/".join(path)
+            path.pop()
+            opening, left_out = openings.pop()
+            # The sections left empty by the ignored keywords are left out as well.
+            if is_ignored(name) or (left_out and opening == len(lines) - 1):
+                if opening < len(lines):
+                    lines.pop()
+                if openings:
+                    openings[-1][1] = True
+                continue
+        elif words[0].startswith("&"):
+            path.append(words[0][1:])
+            openings.append([len(lines), False])
+            name = "/".join(path)
+        else:
+            name = "/".join(path + [words[0]])
+        if is_ignored(name):
+            if openings:
+                openings[-1][1] = True
+            continue
+        lines.append(" ".join(words))
+    return _get_hash(lines)
+
+
+def get_kinds_fingerprint(structure):
+    """Return a hash of the kinds of the structure and of the kind of each site in order, whatever the positions and cell.
+
+    The order of the sites is kept, as the wave function written by CP2K refers to the atoms in this order.
+    """
+    return _get_hash(
+        {
+            "pbc": list(structure.pbc),
+            "kinds": [
+                [
+                    kind.name,
+                    list(kind.symbols),
+                    np.round(kind.weights, 4).tolist(),
+                    round(kind.mass, 4),
+                ]
+                for kind in sorted(structure.kinds, key=lambda kind: kind.name)
+            ],
+            "sites": [site.kind_name for site in structure.sites],
+        }
+    )
+
+
+def get_positions_descriptor(structure):
+    """Return the mean cosine and sine of the fractional positions of the structure along each cell vector.
+
+    The distance between the descriptors of two structures with the same sites gives a lower bound of the RMSD
+    of their positions (see `find_similar_calculation`), so that the search of similar structures can discard
+    most of the candidates in the database query.
+    """
+    fractional = np.array(
+        [site.position for site in structure.sites], dtype=float
+    ) @ np.linalg.inv(np.array(structure.cell))
+    angles = 2 * np.pi * fractional
+    descriptor = {}
+    for axis, name in enumerate("abc"):
+        descriptor[f"cos_{name}"] = float(np.mean(np.cos(angles[:, axis])))
+        descriptor[f"sin_{name}"] = float(np.mean(np.sin(angles[:, axis])))
+    return descriptor
+
+
+def _flatten_inputs(inputs, prefix=""):
+    """Return the input nodes as a flat dictionary, with the namespaces joined by double underscores."""
+    from aiida import orm
+
+    flat = {}
+    for key, value in inputs.items():
+        if isinstance(value, orm.Node):
+            flat[prefix + key] = value
+        elif isinstance(value, Mapping):
+            flat.update(_flatten_inputs(value, f"{prefix}{key}__"))
+    return flat
+
+
+def _get_fingerprint(inputs, similar):
+    fingerprint = {}
+    for label, node in _flatten_inputs(inputs).items():
+        if label.split("__")[0] in _IGNORED_INPUTS:
+            continue
+        if label == "parent_calc_folder":
+            # A continuation depends on the calculation it continues, for similar calculations it is only the
+            # initial guess.
+            if not similar:
+                fingerprint[label] = (node.creator or node).uuid
+        elif label == "structure":
+            fingerprint[label] = (
+                get_kinds_fingerprint(node)
+                if similar
+                else get_structure_fingerprint(node)
+            )
+        elif label == "parameters":
+            fingerprint[label] = get_parameters_fingerprint(
+                node.get_dict(), geometry=not similar
+            )
+        elif label == "code":
+            fingerprint[label] = node.uuid
+        else:
+            fingerprint[label] = node.base.caching.get_hash()
+    return _get_hash(fingerprint)
+
+
+def get_inputs_fingerprint(inputs):
+    """Return a hash of the inputs of a CP2K calculation, to find identical calculations.
+
+    The structure and the parameters are compared with `get_structure_fingerprint` and
+    `get_parameters_fingerprint`, the code by its UUID and the other nodes (files, basis sets, k-points...) by
+    their AiiDA hash. The settings are ignored. The parent folder is compared by the UUID of the calculation that
+    created it, so that the continuations of different calculations do not match.
+
+    Two calculations with the same fingerprint may list the atoms in a different order, translated or rotated,
+    so only the results that do not depend on them, such as the energy, are safe to reuse. The forces, positions
+    and trajectories of the other calculation refer to its own atom order and orientation.
+
+    :param inputs: the inputs of a `Cp2kCalculation`, as a (nested) dictionary of nodes or as the flat
+        dictionary of the link labels of a calculation node.
+    """
+    return _get_fingerprint(inputs, similar=False)
+
+
+def get_similarity_fingerprint(inputs):
+    """Return a hash of the inputs of a CP2K calculation, to find calculations on similar structures.
+
+    As `get_inputs_fingerprint`, but the structure is only compared by its kinds and the kind of each site in
+    order (`get_kinds_fingerprint`) and the parameters without the geometry and the initial guess, and the parent
+    folder is ignored. The calculations with the same fingerprint differ only by the positions of the atoms,
+    by the cell and by their initial guess.
+    """
+    return _get_fingerprint(inputs, similar=True)
+
+
+def find_calculation_by_fingerprint(fingerprint):
+    """Return the most recent process that finished successfully with the given inputs fingerprint, or None.
+
+    The processes are indexed by the `FINGERPRINT_EXTRA` extra, set by `index_calculations` or by the work chains
+    that compute the fingerprint of their inputs. Only its order-independent scalar results, such as the energy,
+    are safe to reuse (see `get_inputs_fingerprint`).
+    """
+    from aiida import orm
+
+    query = orm.QueryBuilder()
+    query.append(
+        orm.ProcessNode,
+        filters={
+            f"extras.{FINGERPRINT_EXTRA}": fingerprint,
+            "attributes.exit_status": 0,
+        },
+        project=["*"],
+    )
+    query.order_by({orm.ProcessNode: {"ctime": "desc"}}).limit(1)
+    result = query.first()
+    return result[0] if result else None
+
+
+def index_calculations(filters=None, batch_size=1000):
+    """Store the fingerprints and the positions descriptor of the finished CP2K calculations that lack them.
+
+    Only the calculations of a single structure are indexed. The calculations are iterated in batches of
+    `batch_size` and the extras of each batch are stored in a single transaction, so that the query is not
+    invalidated by a commit while it is iterated.
+
+    :param filters: optional QueryBuilder filters on the calculation nodes, e.g. ``{"ctime": {">": date}}``.
+    :param batch_size: the number of calculations loaded and stored at once.
+    :returns: the number of indexed calculations.
+    """
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from aiida.manage import get_manager
+
+    storage = get_manager().get_profile_storage()
+    count = 0
+    while True:
+        # The indexed calculations no longer match the filters, so each query returns the next batch.
+        query = orm.QueryBuilder()
+        query.append(orm.StructureData, tag="structure")
+        query.append(
+            orm.CalcJobNode,
+            with_incoming="structure",
+            edge_filters={"label": "structure"},
+            filters={
+                "process_type": "aiida.calculations:cp2k",
+                "attributes.exit_status": 0,
+                "or": [
+                    {"extras": {"!has_key": FINGERPRINT_EXTRA}},
+                    {"extras": {"!has_key": SIMILARITY_EXTRA}},
+                    {"extras": {"!has_key": SIMILARITY_DESCRIPTOR_EXTRA}},
+                ],
+                **(filters or {}),
+            },
+            project=["*"],
+        )
+        query.limit(batch_size)
+
+        indexed = 0
+        with storage.transaction():
+            for (calculation,) in query.iterall(batch_size=batch_size):
+                inputs = {
+                    link.link_label: link.node
+                    for link in calculation.base.links.get_incoming(
+                        link_type=LinkType.INPUT_CALC
+                    ).all()
+                }
+                calculation.base.extras.set_many(
+                    {
+                        FINGERPRINT_EXTRA: get_inputs_fingerprint(inputs),
+                        SIMILARITY_EXTRA: get_similarity_fingerprint(inputs),
+                        SIMILARITY_DESCRIPTOR_EXTRA: get_positions_descriptor(
+                            inputs["structure"]
+                        ),
+                    }
+                )
+                indexed += 1
+        count += indexed
+        if indexed < batch_size:
+            return count
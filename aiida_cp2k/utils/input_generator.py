@@ -12,8 +12,6 @@ from copy import deepcopy
 from aiida.engine import calcfunction
 from aiida.orm import Dict
 
-from .workchains import merge_dict
-
 
 class Cp2kInput:
     """Transforms dictionary into CP2K input"""
@@ -183,26 +181,38 @@ class Cp2kInput:
                 output.append(f"{' ' * indent}{key} {val}")
 
 
+def _get_force_evals(params):
+    """Return the FORCE_EVAL sections, which are given as a list for mixed or multiple force evaluations."""
+    force_evals = params.setdefault("FORCE_EVAL", {})
+    if isinstance(force_evals, Mapping):
+        return [force_evals]
+    return list(force_evals)
+
+
+def _get_dft_sections(params, create=True):
+    """Return the DFT sections of the force evaluations.
+
+    If `create` is True and FORCE_EVAL is a single section, its DFT section is created if absent. In a list of
+    force evaluations, only the existing DFT sections are returned, as a MIXED force evaluation has none.
+    """
+    force_evals = _get_force_evals(params)
+    if create and isinstance(params["FORCE_EVAL"], Mapping):
+        return [force_evals[0].setdefault("DFT", {})]
+    return [force_eval["DFT"] for force_eval in force_evals if "DFT" in force_eval]
+
+
 @calcfunction
 def add_wfn_restart_section(input_dict, is_kpoints):
-    """Add wavefunction restart section to the input dictionary."""
+    """Add wavefunction restart section to the DFT sections of the input dictionary."""
     params = input_dict.get_dict()
     fname = (
         "./parent_calc/aiida-RESTART.kp"
         if is_kpoints
         else "./parent_calc/aiida-RESTART.wfn"
     )
-    restart_wfn_dict = {
-        "FORCE_EVAL": {
-            "DFT": {
-                "RESTART_FILE_NAME": fname,
-                "SCF": {
-                    "SCF_GUESS": "RESTART",
-                },
-            },
-        },
-    }
-    merge_dict(params, restart_wfn_dict)
+    for dft in _get_dft_sections(params):
+        dft["RESTART_FILE_NAME"] = fname
+        dft.setdefault("SCF", {})["SCF_GUESS"] = "RESTART"
     return Dict(params)
 
 
@@ -224,6 +234,57 @@ def add_ext_restart_section(input_dict):
     return Dict(params)
 
 
+@calcfunction
+def add_md_state_section(input_dict, md_state):
+    """Add the velocities and thermostat/barostat state stored by the parser to the input dictionary.
+
+    This allows continuing an MD run without the restart file of the parent calculation.
+    """
+    params = input_dict.get_dict()
+    arrays = md_state.get_arraynames()
+
+    # The parent calculation folder is not available.
+    params.pop("EXT_RESTART", None)
+    for dft in _get_dft_sections(params, create=False):
+        if str(dft.get("RESTART_FILE_NAME", "")).startswith("./parent_calc/"):
+            dft.pop("RESTART_FILE_NAME")
+            if dft.get("SCF", {}).get("SCF_GUESS") == "RESTART":
+                dft["SCF"].pop("SCF_GUESS")
+
+    if "velocities" in arrays:
+        velocities = [
+            "{:.16E} {:.16E} {:.16E}".format(*velocity)
+            for velocity in md_state.get_array("velocities")
+        ]
+        for force_eval in _get_force_evals(params):
+            force_eval.setdefault("SUBSYS", {})["VELOCITY"] = {" ": velocities}
+
+    md_section = params.setdefault("MOTION", {}).setdefault("MD", {})
+    for keyword in ("STEP_START_VAL", "TIME_START_VAL", "ECONS_START_VAL"):
+        if keyword.lower() in arrays:
+            md_section[keyword] = md_state.get_array(keyword.lower())[0].item()
+
+    def values_section(name):
+        return {" ": [f"{value:.16E}" for value in md_state.get_array(name)]}
+
+    for name in ("COORD", "VELOCITY", "MASS", "FORCE"):
+        if f"nose_{name.lower()}" in arrays:
+            md_section.setdefault("THERMOSTAT", {}).setdefault("NOSE", {})[name] = (
+                values_section(f"nose_{name.lower()}")
+            )
+    if "csvr_thermostat_energy" in arrays:
+        md_section.setdefault("THERMOSTAT", {}).setdefault("CSVR", {})[
+            "THERMOSTAT_ENERGY"
+        ] = values_section("csvr_thermostat_energy")
+    for name in ("VELOCITY", "MASS"):
+        if f"barostat_{name.lower()}" in arrays:
+            md_section.setdefault("BAROSTAT", {})[name] = values_section(
+                f"barostat_{name.lower()}"
+            )
+
+    return Dict(params)
+
+
 @calcfunction
 def add_first_snapshot_in_reftraj_section(input_dict, first_snapshot):
     """Add first_snapshot in REFTRAJ section to the input dictionary."""
@@ -246,7 +307,58 @@ def increase_geo_opt_max_iter_by_factor(input_dict, factor):
 def add_ignore_convergence_failure(input_dict):
     """Add IGNORE_CONVERGENCE_FAILURE for non converged SCF runs."""
     params = input_dict.get_dict()
-    params.setdefault("FORCE_EVAL", {}).setdefault("DFT", {}).setdefault("SCF", {})[
-        "IGNORE_CONVERGENCE_FAILURE"
-    ] = ".TRUE."
+    for dft in _get_dft_sections(params):
+        dft.setdefault("SCF", {})["IGNORE_CONVERGENCE_FAILURE"] = ".TRUE."
+    return Dict(params)
+
+
+@calcfunction
+def add_walltime_section(input_dict, walltime):
+    """Set GLOBAL/WALLTIME (in seconds) and make sure a restart file is written at the last step.
+
+    CP2K stops cleanly once the wall time is exceeded, so the restart file reflects the last completed step.
+    Unless set in the parameters, the restart file is also written at every step, so that a job killed before
+    CP2K stops loses as few steps as possible (CP2K writes it every 20 MD steps by default).
+    """
+    params = input_dict.get_dict()
+    params.setdefault("GLOBAL", {})["WALLTIME"] = int(walltime)
+    run_type = params["GLOBAL"].get("RUN_TYPE", "ENERGY").upper()
+    if run_type in ("MD", "GEO_OPT", "CELL_OPT"):
+        restart = (
+            params.setdefault("MOTION", {})
+            .setdefault("PRINT", {})
+            .setdefault("RESTART", {})
+        )
+        restart.setdefault("ADD_LAST", "NUMERIC")
+        restart.setdefault("EACH", {}).setdefault(run_type, 1)
+    return Dict(params)
+
+
+def get_walltime_seconds(params):
+    """Return GLOBAL/WALLTIME of the parameters dictionary in seconds, None if not set.
+
+    CP2K accepts the wall time in seconds or as HH:MM:SS.
+    """
+    walltime = params.get("GLOBAL", {}).get("WALLTIME")
+    if walltime is None:
+        return None
+    try:
+        return float(walltime)
+    except ValueError:
+        hours, minutes, seconds = (float(value) for value in str(walltime).split(":"))
+        return hours * 3600 + minutes * 60 + seconds
+
+
+@calcfunction
+def set_grid_cutoffs(input_dict, cutoffs):
+    """Set the MGRID cutoffs of an energy calculation printing the distribution of the Gaussians on the grids.
+
+    :param cutoffs: Dict with the CUTOFF and, optionally, REL_CUTOFF values.
+    """
+    params = input_dict.get_dict()
+    params.setdefault("GLOBAL", {}).update(
+        {"RUN_TYPE": "ENERGY", "PRINT_LEVEL": "MEDIUM"}
+    )
+    for dft in _get_dft_sections(params):
+        dft.setdefault("MGRID", {}).update(cutoffs.get_dict())
     return Dict(params)
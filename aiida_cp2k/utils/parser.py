@@ -6,11 +6,117 @@
 ###############################################################################
 """AiiDA-CP2K input plugin."""
 
+import collections
+import copy
+import io
+import itertools
 import math
 import re
 
 import numpy as np
 
+# One row of the SCF table, e.g. "  3 OT CG  0.11E+00  1.5  0.18341009  -13.2135556628 -7.11E-01".
+# Line-search steps have neither the convergence nor the change column.
+SCF_ITERATION_RE = re.compile(
+    r"^\s*(\d+)\s+(\S+(?: \S+)??)\s+([-+]?\d*\.\d+E[-+]\d+)\s+(\S+)"
+    r"\s+(?:(\S+)\s+)?([-+]?\d+\.\d+)(?:\s+(\S+))?\s*$"
+)
+
+# Lines of an eigenvalue block: only numbers (or blank).
+EIGENVALUES_LINE_RE = re.compile(r"^[\s\d.eE+-]*$")
+
+# Kind name at the beginning of a COORD line, split into element, tag and suffix (e.g. "Fe1a" -> "Fe", "1", "a").
+KIND_NAME_RE = re.compile(r"^[ \t]*([^\d\s]+?)(\d*)([^\d\s]*)[ \t]", re.MULTILINE)
+
+# Optional results of the advanced parser, see the `fields` argument of `parse_cp2k_output_advanced`.
+ADVANCED_PARSER_FIELDS = (
+    "energy_scf",
+    "kpoint_data",
+    "integrated_abs_spin_dens",
+    "spin_square",
+    "init_nel",
+    "natoms",
+    "smear_method",
+    "warnings",
+    "scf_history",
+    "eigen",
+    "motion_step_info",
+    "performance",
+    "grid_counts",
+)
+
+# Run types for which the advanced parser collects the `motion_step_info`.
+MOTION_RUN_TYPES = (
+    "ENERGY",
+    "ENERGY_FORCE",
+    "GEO_OPT",
+    "CELL_OPT",
+    "MD",
+    "MD-NVT",
+    "MD-NPT_F",
+)
+
+# Per-step results of the advanced parser at every GEO_OPT/CELL_OPT/MD step (`motion_step_info`).
+MOTION_STEP_INFO_KEYS = (
+    "step",  # MOTION step
+    "energy_au",  # total energy
+    "dispersion_energy_au",  # Dispersion energy (if dispersion correction activated)
+    "pressure_bar",  # Total pressure on the cell
+    "cell_vol_angs3",  # Cell Volume
+    "cell_a_angs",  # Cell dimension A
+    "cell_b_angs",  # Cell dimension B
+    "cell_c_angs",  # Cell dimension C
+    "cell_alp_deg",  # Cell angle Alpha
+    "cell_bet_deg",  # Cell angle Beta
+    "cell_gam_deg",  # Cell angle Gamma
+    "max_step_au",  # Max atomic displacement (in optimization)
+    "rms_step_au",  # RMS atomic displacement (in optimization)
+    "max_grad_au",  # Max atomic force (in optimization)
+    "rms_grad_au",  # RMS atomic force (in optimization)
+    "edens_rspace",  # Total charge density on r-space grids (should stay small)
+    "scf_converged",  # SCF converged in this motions step (bool)
+)
+
+# Numeric columns of the CP2K timing report after the number of calls.
+TIMING_REPORT_COLUMNS = (
+    "asd",
+    "self_time_average",
+    "self_time_maximum",
+    "total_time_average",
+    "total_time_maximum",
+)
+
+# Beginning of the lines of the DBCSR statistics parsed into the performance summary,
+# with the corresponding key, the index of the value in the line and its type.
+DBCSR_STATISTICS_LINES = (
+    (" flops total ", "dbcsr_flops_total", 2, float),
+    (" flops max/rank ", "dbcsr_flops_max_rank", 2, float),
+    (" marketing flops ", "dbcsr_marketing_flops", 2, float),
+    (" # multiplications ", "dbcsr_multiplications", 2, int),
+    (" max memory usage/rank ", "dbcsr_max_memory_usage_rank_bytes", 3, float),
+    (" # MPI messages exchanged ", "dbcsr_mpi_messages", 4, int),
+    ("  total size ", "dbcsr_mpi_messages_bytes", 2, float),
+)
+DBCSR_STATISTICS_PREFIXES = tuple(prefix for prefix, *_ in DBCSR_STATISTICS_LINES)
+
+# Rows of the timing report parsed into the performance summary (maximum total time).
+TIMING_REPORT_ROUTINES = {
+    "CP2K": "walltime_seconds",
+    "dbcsr_multiply_generic": "dbcsr_multiply_seconds",
+}
+TIMING_REPORT_PREFIXES = tuple(f" {routine} " for routine in TIMING_REPORT_ROUTINES)
+
+# Per-step lists of the advanced parser that can be stored as arrays instead of in the output Dict.
+PER_STEP_RESULT_KEYS = (
+    "eigen_spin1_au",
+    "eigen_spin2_au",
+    "integrated_abs_spin_dens",
+    "spin_square_expectation",
+    "eigen_spin1_blocks_au",
+    "eigen_spin2_blocks_au",
+    "step_peak_memory_mib",
+)
+
 
 def parse_cp2k_output(fstring):
     """Parse CP2K output into a dictionary."""
@@ -30,306 +136,786 @@ def parse_cp2k_output(fstring):
 
 def parse_cp2k_output_advanced(
     fstring,
+    eigen_blocks=1,
+    fields=None,
 ):
-    """Parse CP2K output into a dictionary (ADVANCED: more info parsed @ PRINT_LEVEL MEDIUM)."""
-    lines = fstring.splitlines()
+    """Parse CP2K output into a dictionary (ADVANCED: more info parsed @ PRINT_LEVEL MEDIUM).
 
-    result_dict = {"exceeded_walltime": False}
-    result_dict["warnings"] = []
-    line_is = None
-    energy = None
-    bohr2ang = 0.529177208590000
-
-    for i_line, line in enumerate(lines):
-        if line.startswith(" CP2K| version string:"):
-            cp2k_version = float(line.split()[5])
-            result_dict["cp2k_version"] = cp2k_version
-        if line.startswith(" ENERGY| "):
-            energy = float(line.split()[8])
-            result_dict["energy"] = energy
-            result_dict["energy_units"] = "a.u."
-        if line.strip().startswith("Total energy: "):
-            # In case of constrained geo opt, "ENERGY| ..." also contains the constraint energy
-            # This only contains the electronic SCF energy
-            energy_scf = float(line.split()[2])
-            result_dict["energy_scf"] = energy_scf
-        if "The number of warnings for this run is" in line:
-            result_dict["nwarnings"] = int(line.split()[-1])
-        if "KPOINTS| Band Structure Calculation" in line:
-            kpoints, labels, bands = _parse_bands(lines, i_line, cp2k_version)
+    See `Cp2kOutputParser` for the arguments, and for parsing the output incrementally.
+    """
+    parser = Cp2kOutputParser(eigen_blocks=eigen_blocks, fields=fields)
+    parser.feed(fstring)
+    parser.close()
+    return parser.result()
+
+
+class ScfTableTracker:
+    """Follow the SCF iteration tables of the CP2K output, one table per (outer) SCF cycle.
+
+    It is shared by `Cp2kOutputParser` and the monitors of the running calculations. The state is the index
+    of the current outer SCF cycle and whether the lines are inside a table.
+    """
+
+    def __init__(self, outer_step=-1, in_table=False):
+        self.outer_step = outer_step
+        self.in_table = in_table
+
+    def update(self, line):
+        """Return the values of the SCF table row in `line` (the groups of `SCF_ITERATION_RE`), or None."""
+        if "Step     Update method" in line:
+            self.outer_step += 1
+            self.in_table = True
+        elif self.in_table:
+            match = SCF_ITERATION_RE.match(line)
+            if match:
+                return match.groups()
+            if "SCF run" in line or "Leaving inner SCF loop" in line:
+                self.in_table = False
+        return None
+
+
+def validate_advanced_parser_fields(fields):
+    """Raise a ValueError if some of the `fields` are not optional results of the advanced parser."""
+    unknown = set(fields) - set(ADVANCED_PARSER_FIELDS)
+    if unknown:
+        raise ValueError(
+            f"Unknown fields of the advanced parser: {', '.join(sorted(unknown))}. "
+            f"Available fields: {', '.join(ADVANCED_PARSER_FIELDS)}."
+        )
+
+
+class Cp2kOutputParser:
+    """Incremental parser of the CP2K output (ADVANCED: more info parsed @ PRINT_LEVEL MEDIUM).
+
+    The output can be fed in chunks of any size, e.g. while it is being written, and the results of
+    the lines fed so far are available at any time::
+
+        parser = Cp2kOutputParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+        result_dict = parser.result()
+
+    The state is JSON-serializable (`get_state` and `from_state`), so that parsing can be paused and
+    continued later, e.g. with the output of the calculation restarted from this one.
+
+    :param eigen_blocks: number of eigenvalue blocks retained per spin (at least 1). The last one is returned
+        as ``eigen_spin<n>_au``, if more than one is retained, all of them are also returned as
+        a numpy array ``eigen_spin<n>_blocks_au`` with one row per block.
+    :param fields: optional results to parse (see ``ADVANCED_PARSER_FIELDS``), all if None. The lines
+        are not checked for the others. The version, energy, run type, DFT type and number of
+        warnings are always parsed, ``eigen`` implies ``init_nel``.
+    """
+
+    def __init__(self, eigen_blocks=1, fields=None):
+        if fields is None:
+            fields = ADVANCED_PARSER_FIELDS
+        validate_advanced_parser_fields(fields)
+        if eigen_blocks < 1:
+            raise ValueError(
+                f"At least one eigenvalue block must be retained, got {eigen_blocks}."
+            )
+        self.eigen_blocks = eigen_blocks
+        self.fields = list(fields)
+
+        self._partial_line = ""
+        self._closed = False
+        self._result_dict = {"exceeded_walltime": False}
+        if "warnings" in fields:
+            self._result_dict["warnings"] = []
+        self._cp2k_version = None
+        self._energy = None
+        self._band_lines = None
+        self._eigen_spin = None
+        self._eigen_lines = []
+        self._eigen_history = {
+            1: collections.deque(maxlen=eigen_blocks),
+            2: collections.deque(maxlen=eigen_blocks),
+        }
+        self._scf_iterations = []
+        self._scf_table = ScfTableTracker()
+        self._in_mpi_table = False
+        self._motion = None  # Values of the current motion step.
+
+    def feed(self, chunk):
+        """Parse a chunk of the output. An incomplete last line is kept until the next chunk."""
+        content = self._partial_line + chunk
+        end = content.rfind("\n") + 1
+        self._partial_line = content[end:]
+        self._process_lines(content[:end].splitlines())
+
+    def close(self):
+        """Parse the incomplete last line, if any (call this at the end of the output)."""
+        content, self._partial_line = self._partial_line, ""
+        self._process_lines(content.splitlines())
+        self._closed = True
+
+    def result(self):
+        """Return the results of the lines parsed so far."""
+        result_dict = {
+            key: _copy_containers(value) for key, value in self._result_dict.items()
+        }
+
+        if self._band_lines is not None:
+            # The block of the last k-point may still be being written.
+            kpoints, labels, bands = _parse_bands(
+                self._band_lines, 0, self._cp2k_version, closed=self._closed
+            )
             result_dict["kpoint_data"] = {
                 "kpoints": kpoints,
                 "labels": labels,
                 "bands": bands,
                 "bands_unit": "eV",
             }
-        if line.startswith(" GLOBAL| Run type"):
-            result_dict["run_type"] = line.split()[-1]
-
-        if line.startswith(" MD| Ensemble Type"):
-            result_dict["run_type"] += "-"
-            result_dict["run_type"] += line.split()[-1]  # e.g., 'MD-NPT_F'
-
-        if line.startswith(" DFT| ") and "dft_type" not in result_dict.keys():
-            result_dict["dft_type"] = line.split()[-1]  # RKS, UKS or ROKS
-
-        if line.strip().startswith("Integrated absolute spin density"):
-            if "integrated_abs_spin_dens" not in result_dict:
-                result_dict["integrated_abs_spin_dens"] = []
-            result_dict["integrated_abs_spin_dens"].append(float(line.split()[-1]))
-
-        if line.strip().startswith("Ideal and single determinant"):
-            s2_ideal, s2_expect = line.split()[-2:]
-            if "spin_square_ideal" not in result_dict:
-                result_dict["spin_square_ideal"] = float(s2_ideal)
-            if "spin_square_expectation" not in result_dict:
-                result_dict["spin_square_expectation"] = []
-            result_dict["spin_square_expectation"].append(float(s2_expect))
-
-        # Read the number of electrons in the first scf (NOTE: it may change but it is not updated!)
-        if re.search("Number of electrons: ", line):
-            if "init_nel_spin1" not in result_dict.keys():
-                result_dict["init_nel_spin1"] = int(line.split()[3])
-                if result_dict["dft_type"] == "RKS":
-                    result_dict["init_nel_spin1"] //= 2  # // returns an integer
-                    result_dict["init_nel_spin2"] = result_dict["init_nel_spin1"]
-            elif "init_nel_spin2" not in result_dict.keys():
-                result_dict["init_nel_spin2"] = int(line.split()[3])
-
-        if re.search("- Atoms: ", line):
-            result_dict["natoms"] = int(line.split()[-1])
-
-        if re.search("Smear method", line):
-            result_dict["smear_method"] = line.split()[-1]
-
-        # Parse warnings
-        if re.search(r"Using a non-square number of", line):
-            result_dict["warnings"].append("Using a non-square number of MPI ranks")
-        if re.search(r"SCF run NOT converged", line):
-            warn = "One or more SCF run did not converge"
-            if warn not in result_dict["warnings"]:
-                result_dict["warnings"].append(warn)
-        if re.search(r"Specific L-BFGS convergence criteria", line):
-            result_dict["warnings"].append("LBFGS converged with specific criteria")
-
-        # Parse eigenvalues.
-        if "subspace spin" in line and "owest" not in line:
-            if int(line.split()[-1]) == 1:
-                line_is = "eigen_spin1_au"
-                result_dict["eigen_spin1_au"] = []
-            elif int(line.split()[-1]) == 2:
-                line_is = "eigen_spin2_au"
-                result_dict["eigen_spin2_au"] = []
-            continue
 
-        # If a tag has been detected, now read the following line knowing what they are
-        if line_is in ["eigen_spin1_au", "eigen_spin2_au"]:
-            if "------" in line or "*** WARNING" in line:
+        for spin, history in self._eigen_history.items():
+            if spin == self._eigen_spin:
+                # The block being read ends here.
+                history = history.copy()
+                _store_eigen_block(history, self._eigen_lines)
+            if history:
+                result_dict[f"eigen_spin{spin}_au"] = history[-1].tolist()
+                if self.eigen_blocks > 1:
+                    result_dict[f"eigen_spin{spin}_blocks_au"] = np.array(history)
+
+        if self._scf_iterations:
+            result_dict["scf_history"] = _scf_iterations_to_arrays(self._scf_iterations)
+
+        performance = result_dict.get("performance", {})
+        if (
+            performance.get("dbcsr_multiply_seconds")
+            and "dbcsr_flops_total" in performance
+        ):
+            performance["dbcsr_flops_per_second"] = (
+                performance["dbcsr_flops_total"] / performance["dbcsr_multiply_seconds"]
+            )
+        if performance.get("mpi_volume_bytes"):
+            performance["mpi_total_volume_bytes"] = sum(
+                performance["mpi_volume_bytes"].values()
+            )
+
+        return result_dict
+
+    def get_state(self):
+        """Return the state of the parser as a JSON-serializable dictionary."""
+        return {
+            "eigen_blocks": self.eigen_blocks,
+            "fields": self.fields,
+            "partial_line": self._partial_line,
+            "closed": self._closed,
+            "result_dict": self._result_dict,
+            "cp2k_version": self._cp2k_version,
+            "energy": self._energy,
+            "band_lines": self._band_lines,
+            "eigen_spin": self._eigen_spin,
+            "eigen_lines": self._eigen_lines,
+            "eigen_history": [
+                [block.tolist() for block in self._eigen_history[spin]]
+                for spin in (1, 2)
+            ],
+            "scf_iterations": self._scf_iterations,
+            "scf_outer_step": self._scf_table.outer_step,
+            "in_scf_table": self._scf_table.in_table,
+            "in_mpi_table": self._in_mpi_table,
+            "motion": self._motion,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a parser from a state returned by `get_state`, to continue parsing where it stopped."""
+        parser = cls(eigen_blocks=state["eigen_blocks"], fields=state["fields"])
+        parser._partial_line = state["partial_line"]
+        parser._closed = state.get("closed", False)
+        parser._result_dict = copy.deepcopy(state["result_dict"])
+        parser._cp2k_version = state["cp2k_version"]
+        parser._energy = state["energy"]
+        parser._band_lines = copy.copy(state["band_lines"])
+        parser._eigen_spin = state["eigen_spin"]
+        parser._eigen_lines = list(state["eigen_lines"])
+        for spin, blocks in zip((1, 2), state["eigen_history"]):
+            parser._eigen_history[spin].extend(np.array(block) for block in blocks)
+        parser._scf_iterations = [tuple(row) for row in state["scf_iterations"]]
+        parser._scf_table = ScfTableTracker(
+            state["scf_outer_step"], state["in_scf_table"]
+        )
+        parser._in_mpi_table = state["in_mpi_table"]
+        parser._motion = copy.copy(state["motion"])
+        return parser
+
+    def _process_lines(self, lines):
+        """Parse complete lines of the output."""
+        fields = self.fields
+        parse_energy_scf = "energy_scf" in fields
+        parse_kpoint_data = "kpoint_data" in fields
+        parse_spin_dens = "integrated_abs_spin_dens" in fields
+        parse_spin_square = "spin_square" in fields
+        parse_eigen = "eigen" in fields
+        parse_init_nel = "init_nel" in fields or parse_eigen
+        parse_natoms = "natoms" in fields
+        parse_smear_method = "smear_method" in fields
+        parse_warnings = "warnings" in fields
+        parse_scf_history = "scf_history" in fields
+        parse_motion = "motion_step_info" in fields
+        parse_performance = "performance" in fields
+        parse_grid_counts = "grid_counts" in fields
+
+        result_dict = self._result_dict
+        energy = self._energy
+        band_lines = self._band_lines
+        eigen_spin = self._eigen_spin
+        eigen_lines = self._eigen_lines
+        eigen_history = self._eigen_history
+        scf_iterations = self._scf_iterations
+        scf_table = self._scf_table
+        in_mpi_table = self._in_mpi_table
+        motion = self._motion
+        bohr2ang = 0.529177208590000
+
+        for line in lines:
+            if band_lines is not None:
+                band_lines.append(line)
+            if line.startswith(" CP2K| version string:"):
+                self._cp2k_version = float(line.split()[5])
+                result_dict["cp2k_version"] = self._cp2k_version
+            if line.startswith(" ENERGY| "):
+                energy = float(line.split()[8])
+                result_dict["energy"] = energy
+                result_dict["energy_units"] = "a.u."
+            if parse_energy_scf and line.strip().startswith("Total energy: "):
+                # In case of constrained geo opt, "ENERGY| ..." also contains the constraint energy
+                # This only contains the electronic SCF energy
+                energy_scf = float(line.split()[2])
+                result_dict["energy_scf"] = energy_scf
+            if "The number of warnings for this run is" in line:
+                result_dict["nwarnings"] = int(line.split()[-1])
+            if parse_kpoint_data and "KPOINTS| Band Structure Calculation" in line:
+                # The band structure is parsed from here to the end of the output.
+                band_lines = [line]
+            if line.startswith(" GLOBAL| Run type"):
+                result_dict["run_type"] = line.split()[-1]
+
+            if line.startswith(" MD| Ensemble Type"):
+                result_dict["run_type"] += "-"
+                result_dict["run_type"] += line.split()[-1]  # e.g., 'MD-NPT_F'
+
+            if line.startswith(" DFT| ") and "dft_type" not in result_dict.keys():
+                result_dict["dft_type"] = line.split()[-1]  # RKS, UKS or ROKS
+
+            if parse_spin_dens and line.strip().startswith(
+                "Integrated absolute spin density"
+            ):
+                if "integrated_abs_spin_dens" not in result_dict:
+                    result_dict["integrated_abs_spin_dens"] = []
+                result_dict["integrated_abs_spin_dens"].append(float(line.split()[-1]))
+
+            if parse_spin_square and line.strip().startswith(
+                "Ideal and single determinant"
+            ):
+                s2_ideal, s2_expect = line.split()[-2:]
+                if "spin_square_ideal" not in result_dict:
+                    result_dict["spin_square_ideal"] = float(s2_ideal)
+                if "spin_square_expectation" not in result_dict:
+                    result_dict["spin_square_expectation"] = []
+                result_dict["spin_square_expectation"].append(float(s2_expect))
+
+            # Read the number of electrons in the first scf (NOTE: it may change but it is not updated!)
+            if parse_init_nel and "Number of electrons: " in line:
+                if "init_nel_spin1" not in result_dict.keys():
+                    result_dict["init_nel_spin1"] = int(line.split()[3])
+                    if result_dict["dft_type"] == "RKS":
+                        result_dict["init_nel_spin1"] //= 2  # // returns an integer
+                        result_dict["init_nel_spin2"] = result_dict["init_nel_spin1"]
+                elif "init_nel_spin2" not in result_dict.keys():
+                    result_dict["init_nel_spin2"] = int(line.split()[3])
+
+            if parse_natoms and "- Atoms: " in line:
+                result_dict["natoms"] = int(line.split()[-1])
+
+            if parse_smear_method and "Smear method" in line:
+                result_dict["smear_method"] = line.split()[-1]
+
+            # Parse warnings
+            if parse_warnings:
+                if "Using a non-square number of" in line:
+                    result_dict["warnings"].append(
+                        "Using a non-square number of MPI ranks"
+                    )
+                if "SCF run NOT converged" in line:
+                    warn = "One or more SCF run did not converge"
+                    if warn not in result_dict["warnings"]:
+                        result_dict["warnings"].append(warn)
+                if "Specific L-BFGS convergence criteria" in line:
+                    result_dict["warnings"].append(
+                        "LBFGS converged with specific criteria"
+                    )
+
+            # Parse the distribution of the Gaussians on the multigrids (PRINT_LEVEL MEDIUM), e.g.
+            # "Count for grid        1:          24064          cutoff [a.u.]           50.00"
+            if parse_grid_counts and "Count for grid" in line:
+                data = line.split()
+                if data[3] == "1:":
+                    result_dict["grid_counts"] = []
+                    result_dict["grid_cutoffs"] = []
+                result_dict["grid_counts"].append(int(data[4]))
+                result_dict["grid_cutoffs"].append(float(data[-1]))
+
+            # Parse the memory, DBCSR and MPI statistics.
+            if parse_performance:
+                if "Estimated peak process memory" in line:
+                    peak_memory = int(line.split()[-1])
+                    if line.startswith(" MEMORY|"):
+                        performance = result_dict.setdefault("performance", {})
+                        performance["peak_memory_mib"] = peak_memory
+                    else:  # Printed after every MOTION step, kept with the other per-step results.
+                        result_dict.setdefault("step_peak_memory_mib", []).append(
+                            peak_memory
+                        )
+                elif "MESSAGE PASSING PERFORMANCE" in line:
+                    # The DBCSR table only covers the DBCSR communication.
+                    in_mpi_table = "DBCSR" not in line
+                    if in_mpi_table:
+                        performance = result_dict.setdefault("performance", {})
+                        performance["mpi_calls"] = {}
+                        performance["mpi_volume_bytes"] = {}
+                elif in_mpi_table and line.startswith(" MP_"):
+                    performance = result_dict["performance"]
+                    data = line.split()
+                    performance["mpi_calls"][data[0]] = int(data[1])
+                    if len(data) > 2:
+                        performance["mpi_volume_bytes"][data[0]] = int(data[1]) * float(
+                            data[2]
+                        )
+                elif line.startswith(TIMING_REPORT_PREFIXES):
+                    data = line.split()
+                    if len(data) == 7 and data[1].isdigit():
+                        result_dict.setdefault("performance", {})[
+                            TIMING_REPORT_ROUTINES[data[0]]
+                        ] = float(data[6])
+                elif line.startswith(DBCSR_STATISTICS_PREFIXES):
+                    for prefix, key, index, dtype in DBCSR_STATISTICS_LINES:
+                        if line.startswith(prefix):
+                            result_dict.setdefault("performance", {})[key] = dtype(
+                                line.split()[index]
+                            )
+                            break
+
+            # Parse the SCF iteration table: one table per (outer) SCF cycle.
+            if parse_scf_history:
+                row = scf_table.update(line)
+                if row is not None:
+                    scf_iterations.append((scf_table.outer_step,) + row)
+
+            # Parse eigenvalues: collect the lines of a block and convert them at once.
+            if parse_eigen and "subspace spin" in line and "owest" not in line:
+                if eigen_spin is not None:
+                    _store_eigen_block(eigen_history[eigen_spin], eigen_lines)
+                eigen_spin = int(line.split()[-1])
+                eigen_lines = []
                 continue
-            splitted_line = line.split()
-            try:
-                result_dict[line_is] += [float(x) for x in splitted_line]
-            except ValueError:
-                line_is = None
-
-        ####################################################################
-        #  THIS SECTION PARSES THE PROPERTIES AT GOE_OPT/CELL_OPT/MD STEP  #
-        #  BC: it can be not robust!                                         #
-        ####################################################################
-        if "run_type" in result_dict.keys() and result_dict["run_type"] in [
-            "ENERGY",
-            "ENERGY_FORCE",
-            "GEO_OPT",
-            "CELL_OPT",
-            "MD",
-            "MD-NVT",
-            "MD-NPT_F",
-        ]:
-            # Initialization
-            if "motion_step_info" not in result_dict:
-                result_dict["motion_opt_converged"] = False
-                result_dict["motion_step_info"] = {
-                    "step": [],  # MOTION step
-                    "energy_au": [],  # total energy
-                    "dispersion_energy_au": [],  # Dispersion energy (if dispersion correction activated)
-                    "pressure_bar": [],  # Total pressure on the cell
-                    "cell_vol_angs3": [],  # Cell Volume
-                    "cell_a_angs": [],  # Cell dimension A
-                    "cell_b_angs": [],  # Cell dimension B
-                    "cell_c_angs": [],  # Cell dimension C
-                    "cell_alp_deg": [],  # Cell angle Alpha
-                    "cell_bet_deg": [],  # Cell angle Beta
-                    "cell_gam_deg": [],  # Cell angle Gamma
-                    "max_step_au": [],  # Max atomic displacement (in optimization)
-                    "rms_step_au": [],  # RMS atomic displacement (in optimization)
-                    "max_grad_au": [],  # Max atomic force (in optimization)
-                    "rms_grad_au": [],  # RMS atomic force (in optimization)
-                    "edens_rspace": [],  # Total charge density on r-space grids (should stay small)
-                    "scf_converged": [],  # SCF converged in this motions step (bool)
-                }
-                step = 0
-                energy = None
-                dispersion = None  # Needed if no dispersions are included
-                pressure = None
-                max_step = None
-                rms_step = None
-                max_grad = None
-                rms_grad = None
-                edens_rspace = None
-                scf_converged = True
-
-            dump_step_info = False
-            data = line.split()
-            # Parse general info
-            if line.startswith(" CELL|"):
-                if re.search(r"Volume", line):
-                    cell_vol = float(data[3])
-                if re.search(r"Vector a", line):
-                    cell_a = float(data[9])
-                if re.search(r"Vector b", line):
-                    cell_b = float(data[9])
-                if re.search(r"Vector c", line):
-                    cell_c = float(data[9])
-                if re.search(r"alpha", line):
-                    cell_alp = float(data[5])
-                if re.search(r"beta", line):
-                    cell_bet = float(data[5])
-                if re.search(r"gamma", line):
-                    cell_gam = float(data[5])
-
-            if re.search(r"Dispersion energy", line):
-                dispersion = float(data[2])
-            if re.search("Total charge density on r-space grids:", line):
-                # Printed at every outer OT, and needed for understanding if something is going wrong (if !=0)
-                edens_rspace = float(line.split()[-1])
-            if re.search(r"SCF run NOT converged", line):
-                scf_converged = False
-
-            # Parse specific info
-            if result_dict["run_type"] in ["ENERGY", "ENERGY_FORCE"]:
-                if energy is not None and not result_dict["motion_step_info"]["step"]:
-                    dump_step_info = True
-            if result_dict["run_type"] in ["GEO_OPT", "CELL_OPT"]:
-                # Note: with CELL_OPT/LBFGS there is no "STEP 0", while there is with CELL_OPT/BFGS
-
-                # Getting the step number.
-                if re.search(r"Informations at step", line):
-                    step = int(data[5])
-                elif re.search(
-                    r"OPT\| Step number ", line
-                ):  # Fix for new CP2K versions.
-                    step = int(data[-1])
-
-                # Getting the maximum step size.
-                if re.search(
-                    r"OPT\| Maximum step size\s*[-+]?\d*\.?\d+", line
-                ) or re.search(r"Max. step size\s+=", line):
-                    max_step = float(data[-1])
-
-                # Getting the RMS step size.
-                if re.search(
-                    r"OPT\| RMS step size\s*[-+]?\d*\.?\d+", line
-                ) or re.search(r"RMS step size\s+=", line):
-                    rms_step = float(data[-1])
-
-                # Getting the maximum gradient.
-                if re.search(
-                    r"OPT\| Maximum gradient\s*[-+]?\d*\.?\d+", line
-                ) or re.search(r"Max. gradient\s+=", line):
-                    max_grad = float(data[-1])
-
-                # Getting the RMS gradient.
-                if re.search(
-                    r"OPT\| RMS gradient\s*[-+]?\d*\.?\d+",
-                    line,
-                ) or re.search(r"RMS gradient\s{3,}=", line):
-                    rms_grad = float(data[-1])
-
-                if (
-                    len(data) == 1
-                    and data[0] == "---------------------------------------------------"
-                ) or re.search(r"OPT\| Estimated peak process memory", line):
-                    dump_step_info = True  # 51('-')
-                if re.search(
-                    r"Reevaluating energy at the minimum", line
-                ):  # not clear why it is doing a last one...
-                    result_dict["motion_opt_converged"] = True
-
-            if result_dict["run_type"] == "CELL_OPT":
-                if re.search(r"Internal Pressure", line):
-                    pressure = float(data[4])
-            if result_dict["run_type"] == "MD-NVT":
-                if re.search(r"STEP NUMBER", line):
-                    step = int(data[3])
-                if re.search(r"INITIAL PRESSURE\[bar\]", line):
-                    pressure = float(data[3])
-                    dump_step_info = True
-                if re.search(r"PRESSURE \[bar\]", line):
-                    pressure = float(data[3])
-                    dump_step_info = True
-            if result_dict["run_type"] == "MD-NPT_F":
-                if re.search(r"^ STEP NUMBER", line):
-                    step = int(data[3])
-                if re.search(r"^ INITIAL PRESSURE\[bar\]", line):
-                    pressure = float(data[3])
-                    dump_step_info = True
-                if re.search(r"^ PRESSURE \[bar\]", line):
-                    pressure = float(data[3])
-                if re.search(r"^ VOLUME\[bohr\^3\]", line):
-                    cell_vol = float(data[3]) * (bohr2ang**3)
-                if re.search(r"^ CELL LNTHS\[bohr\]", line):
-                    cell_a = float(data[3]) * bohr2ang
-                    cell_b = float(data[4]) * bohr2ang
-                    cell_c = float(data[5]) * bohr2ang
-                if re.search(r"^ CELL ANGLS\[deg\]", line):
-                    cell_alp = float(data[3])
-                    cell_bet = float(data[4])
-                    cell_gam = float(data[5])
-                    dump_step_info = True
-
-            if dump_step_info and energy is not None:
-                result_dict["motion_step_info"]["step"].append(step)
-                result_dict["motion_step_info"]["energy_au"].append(energy)
-                result_dict["motion_step_info"]["dispersion_energy_au"].append(
-                    dispersion
-                )
-                result_dict["motion_step_info"]["pressure_bar"].append(pressure)
-                result_dict["motion_step_info"]["cell_vol_angs3"].append(cell_vol)
-                result_dict["motion_step_info"]["cell_a_angs"].append(cell_a)
-                result_dict["motion_step_info"]["cell_b_angs"].append(cell_b)
-                result_dict["motion_step_info"]["cell_c_angs"].append(cell_c)
-                result_dict["motion_step_info"]["cell_alp_deg"].append(cell_alp)
-                result_dict["motion_step_info"]["cell_bet_deg"].append(cell_bet)
-                result_dict["motion_step_info"]["cell_gam_deg"].append(cell_gam)
-                result_dict["motion_step_info"]["max_step_au"].append(max_step)
-                result_dict["motion_step_info"]["rms_step_au"].append(rms_step)
-                result_dict["motion_step_info"]["max_grad_au"].append(max_grad)
-                result_dict["motion_step_info"]["rms_grad_au"].append(rms_grad)
-                result_dict["motion_step_info"]["edens_rspace"].append(edens_rspace)
-                result_dict["motion_step_info"]["scf_converged"].append(scf_converged)
-                scf_converged = True
-        ####################################################################
-        #  END PARSING GEO_OPT/CELL_OPT/MD STEP                            #
-        ####################################################################
 
+            # If a tag has been detected, now read the following line knowing what they are
+            if eigen_spin is not None:
+                if "------" in line or "*** WARNING" in line:
+                    continue
+                if EIGENVALUES_LINE_RE.match(line):
+                    eigen_lines.append(line)
+                else:
+                    _store_eigen_block(eigen_history[eigen_spin], eigen_lines)
+                    eigen_spin = None
+                    eigen_lines = []
+
+            ####################################################################
+            #  THIS SECTION PARSES THE PROPERTIES AT GOE_OPT/CELL_OPT/MD STEP  #
+            #  BC: it can be not robust!                                         #
+            ####################################################################
+            if parse_motion and result_dict.get("run_type") in MOTION_RUN_TYPES:
+                # Initialization
+                if "motion_step_info" not in result_dict:
+                    result_dict["motion_opt_converged"] = False
+                    result_dict["motion_step_info"] = {
+                        key: [] for key in MOTION_STEP_INFO_KEYS
+                    }
+                    # The values of the current step, under the same keys.
+                    motion = dict.fromkeys(result_dict["motion_step_info"])
+                    motion["step"] = 0
+                    motion["scf_converged"] = True
+                    energy = None
+
+                dump_step_info = False
+                data = line.split()
+                # Parse general info
+                if line.startswith(" CELL|"):
+                    if "Volume" in line:
+                        motion["cell_vol_angs3"] = float(data[3])
+                    if "Vector a" in line:
+                        motion["cell_a_angs"] = float(data[9])
+                    if "Vector b" in line:
+                        motion["cell_b_angs"] = float(data[9])
+                    if "Vector c" in line:
+                        motion["cell_c_angs"] = float(data[9])
+                    if "alpha" in line:
+                        motion["cell_alp_deg"] = float(data[5])
+                    if "beta" in line:
+                        motion["cell_bet_deg"] = float(data[5])
+                    if "gamma" in line:
+                        motion["cell_gam_deg"] = float(data[5])
+
+                if "Dispersion energy" in line:
+                    motion["dispersion_energy_au"] = float(data[2])
+                if "Total charge density on r-space grids:" in line:
+                    # Printed at every outer OT, and needed for understanding if something is going wrong (if !=0)
+                    motion["edens_rspace"] = float(line.split()[-1])
+                if "SCF run NOT converged" in line:
+                    motion["scf_converged"] = False
+
+                # Parse specific info
+                run_type = result_dict["run_type"]
+                if run_type in ["ENERGY", "ENERGY_FORCE"]:
+                    if (
+                        energy is not None
+                        and not result_dict["motion_step_info"]["step"]
+                    ):
+                        dump_step_info = True
+                if run_type in ["GEO_OPT", "CELL_OPT"]:
+                    # Note: with CELL_OPT/LBFGS there is no "STEP 0", while there is with CELL_OPT/BFGS
+
+                    # Getting the step number.
+                    if "Informations at step" in line:
+                        motion["step"] = int(data[5])
+                    elif "OPT| Step number " in line:  # Fix for new CP2K versions.
+                        motion["step"] = int(data[-1])
+
+                    # Getting the maximum step size.
+                    if "step size" in line and (
+                        re.search(r"OPT\| Maximum step size\s*[-+]?\d*\.?\d+", line)
+                        or re.search(r"Max. step size\s+=", line)
+                    ):
+                        motion["max_step_au"] = float(data[-1])
+
+                    # Getting the RMS step size.
+                    if "step size" in line and (
+                        re.search(r"OPT\| RMS step size\s*[-+]?\d*\.?\d+", line)
+                        or re.search(r"RMS step size\s+=", line)
+                    ):
+                        motion["rms_step_au"] = float(data[-1])
+
+                    # Getting the maximum gradient.
+                    if "gradient" in line and (
+                        re.search(r"OPT\| Maximum gradient\s*[-+]?\d*\.?\d+", line)
+                        or re.search(r"Max. gradient\s+=", line)
+                    ):
+                        motion["max_grad_au"] = float(data[-1])
+
+                    # Getting the RMS gradient.
+                    if "gradient" in line and (
+                        re.search(r"OPT\| RMS gradient\s*[-+]?\d*\.?\d+", line)
+                        or re.search(r"RMS gradient\s{3,}=", line)
+                    ):
+                        motion["rms_grad_au"] = float(data[-1])
+
+                    if (
+                        len(data) == 1
+                        and data[0]
+                        == "---------------------------------------------------"
+                    ) or "OPT| Estimated peak process memory" in line:
+                        dump_step_info = True  # 51('-')
+                    if (
+                        "Reevaluating energy at the minimum" in line
+                    ):  # not clear why it is doing a last one...
+                        result_dict["motion_opt_converged"] = True
+
+                if run_type == "CELL_OPT":
+                    if "Internal Pressure" in line:
+                        motion["pressure_bar"] = float(data[4])
+                if run_type == "MD-NVT":
+                    if "STEP NUMBER" in line:
+                        motion["step"] = int(data[3])
+                    if "INITIAL PRESSURE[bar]" in line:
+                        motion["pressure_bar"] = float(data[3])
+                        dump_step_info = True
+                    if "PRESSURE [bar]" in line:
+                        motion["pressure_bar"] = float(data[3])
+                        dump_step_info = True
+                if run_type == "MD-NPT_F":
+                    if line.startswith(" STEP NUMBER"):
+                        motion["step"] = int(data[3])
+                    if line.startswith(" INITIAL PRESSURE[bar]"):
+                        motion["pressure_bar"] = float(data[3])
+                        dump_step_info = True
+                    if line.startswith(" PRESSURE [bar]"):
+                        motion["pressure_bar"] = float(data[3])
+                    if line.startswith(" VOLUME[bohr^3]"):
+                        motion["cell_vol_angs3"] = float(data[3]) * (bohr2ang**3)
+                    if line.startswith(" CELL LNTHS[bohr]"):
+                        motion["cell_a_angs"] = float(data[3]) * bohr2ang
+                        motion["cell_b_angs"] = float(data[4]) * bohr2ang
+                        motion["cell_c_angs"] = float(data[5]) * bohr2ang
+                    if line.startswith(" CELL ANGLS[deg]"):
+                        motion["cell_alp_deg"] = float(data[3])
+                        motion["cell_bet_deg"] = float(data[4])
+                        motion["cell_gam_deg"] = float(data[5])
+                        dump_step_info = True
+
+                if dump_step_info and energy is not None:
+                    motion["energy_au"] = energy
+                    for key, values in result_dict["motion_step_info"].items():
+                        values.append(motion[key])
+                    motion["scf_converged"] = True
+            ####################################################################
+            #  END PARSING GEO_OPT/CELL_OPT/MD STEP                            #
+            ####################################################################
+
+        self._energy = energy
+        self._band_lines = band_lines
+        self._eigen_spin = eigen_spin
+        self._eigen_lines = eigen_lines
+        self._in_mpi_table = in_mpi_table
+        self._motion = motion
+
+
+def _copy_containers(value):
+    """Copy the (nested) lists and dictionaries of a result, so that the parser state is not shared."""
+    if isinstance(value, dict):
+        return {key: _copy_containers(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def _store_eigen_block(history, eigen_lines):
+    """Convert the lines of one eigenvalue block and append it to the retained blocks.
+
+    Blocks with a different number of eigenvalues than the retained ones replace the history.
+    """
+    block = np.fromstring(" ".join(eigen_lines), sep=" ")
+    if history and len(history[-1]) != len(block):
+        history.clear()
+    history.append(block)
+
+
+def _scf_iterations_to_arrays(scf_iterations):
+    """Convert the parsed SCF table rows into compact columnar arrays.
+
+    Missing values (e.g. convergence and change of line-search steps) are stored as NaN.
+    The total energy is kept in double precision, as float32 cannot resolve SCF energy changes.
+    """
+    outer_step, step, method, step_size, time, convergence, energy, change = zip(
+        *scf_iterations
+    )
+    method_names, method_idx = np.unique(method, return_inverse=True)
+
+    def to_float(values, dtype):
+        return np.array([np.nan if v is None else float(v) for v in values], dtype)
+
+    return {
+        "outer_step": np.array(outer_step, np.int32),
+        "step": np.array(step, np.int32),
+        "method": method_idx.astype(np.int32),
+        "method_names": method_names,
+        "step_size": to_float(step_size, np.float32),
+        "time": to_float(time, np.float32),
+        "convergence": to_float(convergence, np.float32),
+        "energy": to_float(energy, np.float64),
+        "energy_change": to_float(change, np.float32),
+    }
+
+
+def pop_per_step_arrays(result_dict):
+    """Remove the per-step data from the result dictionary and return them as numpy arrays.
+
+    The lists of ``motion_step_info`` are returned under their own name, missing values
+    (``None``) are stored as NaN.
+    """
+    arrays = {}
+    for key, values in result_dict.pop("motion_step_info", {}).items():
+        if key == "step":
+            arrays[key] = np.array(values, np.int32)
+        elif key == "scf_converged":
+            arrays[key] = np.array(values, bool)
+        else:
+            arrays[key] = np.array(
+                [np.nan if v is None else v for v in values], np.float64
+            )
+    for key in PER_STEP_RESULT_KEYS:
+        if key in result_dict:
+            arrays[key] = np.array(result_dict.pop(key), np.float64)
+    return arrays
+
+
+def parse_cp2k_timing_report(lines):
+    """Parse the "T I M I N G" report at the end of the CP2K output into columnar arrays.
+
+    :param lines: iterable over the lines of the output, e.g. an open file. If CP2K printed several
+        reports, the last one is returned.
+    :returns: dictionary with one row per subroutine (empty if there is no report): ``routine``, ``calls``
+        (maximum over the ranks), ``asd`` (average stack depth), ``self_time_average``, ``self_time_maximum``,
+        ``total_time_average`` and ``total_time_maximum`` in seconds.
+    """
+    rows = None
+    for line in lines:
+        if "T I M I N G" in line:
+            rows = []
+            continue
+        if rows is None:
+            continue
+        data = line.split()
+        if len(data) == 7 and data[1].isdigit():
+            rows.append(data)
+        elif rows and not data[1:]:
+            # The report ends with a separator line.
+            break
+
+    if not rows:
+        return {}
+
+    routine, calls, *times = zip(*rows)
+    return {
+        "routine": np.array(routine),
+        "calls": np.array(calls, np.int64),
+        **{
+            name: np.array(values, np.float64)
+            for name, values in zip(TIMING_REPORT_COLUMNS, times)
+        },
+    }
+
+
+def parse_cp2k_output_tools(fstring):
+    """Parse CP2K output into a dictionary with the block-based parser of cp2k-output-tools."""
+    from cp2k_output_tools import parse_iter
+
+    result_dict = {}
+
+    # the CP2K output parser is a block-based parser return blocks of data, each under a block key
+    # merge them into one dict
+    for match in parse_iter(fstring, key_mangling=True):
+        result_dict.update(match)
+
+    _add_tools_energy(result_dict)
     return result_dict
 
 
-def _parse_kpoint_cp2k_lower_81(lines, line_n):
+def _get_tools_matchers():
+    """Return the matchers of cp2k-output-tools by block name."""
+    from cp2k_output_tools.blocks import builtin_matchers
+
+    return {matcher.__name__[len("match_") :]: matcher for matcher in builtin_matchers}
+
+
+def validate_tools_stream_options(blocks=None, history=1):
+    """Raise a ValueError if the options of `parse_cp2k_output_tools_stream` are not valid."""
+    if blocks is not None:
+        available = _get_tools_matchers()
+        unknown = set(blocks) - set(available)
+        if unknown:
+            raise ValueError(
+                f"Unknown cp2k-output-tools blocks: {', '.join(sorted(unknown))}. "
+                f"Available blocks: {', '.join(available)}."
+            )
+    if history < 1:
+        raise ValueError(
+            f"At least one value must be retained per block key, got {history}."
+        )
+
+
+def parse_cp2k_output_tools_stream(lines, blocks=None, history=1):
+    """Parse CP2K output line by line with the block-based parser of cp2k-output-tools.
+
+    The output is split before every ``ENERGY| Total FORCE_EVAL`` line (no block spans it) and each
+    segment is parsed separately, so only one segment has to be kept in memory. Lists (e.g. the
+    warnings) are accumulated over the segments, the program info is taken from the first and the last one.
+
+    :param lines: iterable over the lines of the output, e.g. an open file.
+    :param blocks: names of the blocks to parse (e.g. ``["energies", "forces"]``), all if None.
+    :param history: number of values retained per block key. The last one is returned under its key,
+        if more than one is retained, all of them are also returned as list under ``<key>_history``.
+    """
+    from cp2k_output_tools import parse_iter
+    from cp2k_output_tools.blocks import match_program_info
+
+    validate_tools_stream_options(blocks, history)
+    available = _get_tools_matchers()
+    if blocks is None:
+        blocks = list(available)
+    matchers = [available[name] for name in blocks if name != "program_info"]
+
+    values = collections.defaultdict(lambda: collections.deque(maxlen=history))
+    accumulated = {}
+
+    def parse_segment(segment):
+        for match in parse_iter("".join(segment), matchers=matchers, key_mangling=True):
+            for key, value in match.items():
+                if isinstance(value, list):
+                    accumulated.setdefault(key, []).extend(value)
+                else:
+                    values[key].append(value)
+
+    first_segment = None
+    segment = []
+    for line in lines:
+        if line.startswith(" ENERGY| Total FORCE_EVAL") and segment:
+            parse_segment(segment)
+            if first_segment is None and "program_info" in blocks:
+                first_segment = segment
+            segment = []
+        segment.append(line)
+    parse_segment(segment)
+
+    result_dict = {}
+    for key, retained in values.items():
+        result_dict[key] = retained[-1]
+        if history > 1:
+            result_dict[f"{key}_history"] = list(retained)
+    result_dict.update(accumulated)
+
+    # The start and the end of the program info are printed at the beginning and at the end of the output.
+    if "program_info" in blocks:
+        content = "".join((first_segment or []) + segment)
+        for match in parse_iter(
+            content, matchers=[match_program_info], key_mangling=True
+        ):
+            result_dict.update(match)
+
+    _add_tools_energy(result_dict)
+    return result_dict
+
+
+def _add_tools_energy(result_dict):
+    """Add the total force eval energy of the cp2k-output-tools blocks as `energy`."""
+    try:
+        # the cp2k-output-tools parser is more hierarchical, be compatible with
+        # the basic parser here and provide the total force eval energy as energy
+        result_dict["energy"] = result_dict["energies"]["total_force_eval"]
+        result_dict["energy_units"] = "a.u."
+    except KeyError:
+        pass
+
+
+def _is_kpoint_header_cp2k_lower_81(line):
+    """Check if the line starts a k-point block in the output of CP2K <8.1"""
+    return line.lstrip().startswith("Nr.") and "K-Point" in line
+
+
+def _parse_kpoint_cp2k_lower_81(lines, line_n, nbands=None):
     """Parse one k-point in the output of CP2K <8.1"""
 
     splitted = lines[line_n].split()
     spin = int(splitted[3])
     kpoint = tuple(float(p) for p in splitted[-3:])
     nlines = int(math.ceil(int(lines[line_n + 1]) / 4))
-    bands = [
-        float(v) for v in " ".join(lines[line_n + 2 : line_n + 2 + nlines]).split()
-    ]
+    bands = np.fromstring(" ".join(lines[line_n + 2 : line_n + 2 + nlines]), sep=" ")
     return spin, kpoint, bands
 
 
-def _parse_bands_cp2k_greater_81(lines, line_n):
-    """Parse one k-point in the output of CP2K >=8.1"""
+def _is_kpoint_header_cp2k_greater_81(line):
+    """Check if the line starts a k-point block in the output of CP2K >=8.1"""
+    return line.startswith("#  Point")
+
+
+def _parse_bands_cp2k_greater_81(lines, line_n, nbands):
+    """Parse one k-point in the output of CP2K >=8.1
+
+    The block of ``nbands`` lines (band, energy, occupation) is converted with a single numpy call.
+    """
 
     splitted = lines[line_n].split()
     assert (
@@ -337,92 +923,153 @@ def _parse_bands_cp2k_greater_81(lines, line_n):
     ), "Did not find required keywords in kpoint line"
     spin = int(splitted[4][:-1])  # strip the ':'
     kpoint = tuple(float(p) for p in splitted[5:8])  # ignore optional weight
-    bands = []
-    for line in lines[line_n + 2 :]:
-        try:
-            bands.append(float(line.split()[1]))
-        except ValueError:
-            break
+    block = " ".join(lines[line_n + 2 : line_n + 2 + nbands])
+    bands = np.fromstring(block, sep=" ").reshape(nbands, -1)[:, 1]
     return spin, kpoint, bands
 
 
-def _parse_bands(lines, n_start, cp2k_version):
-    """Parse band structure from the CP2K output."""
+def _count_bands_cp2k_greater_81(lines, line_n):
+    """Count the band lines following the k-point header at ``line_n`` (CP2K >=8.1)"""
+
+    nbands = 0
+    for line in itertools.islice(lines, line_n + 2, None):
+        if not line.lstrip()[:1].isdigit():
+            break
+        nbands += 1
+    return nbands
+
+
+def _is_kpoint_block_complete(lines, line_n, cp2k_version, nbands, closed):
+    """Check if all the bands of the k-point block starting at ``line_n`` are in ``lines``.
+
+    In the output of CP2K >=8.1, the block has no length and only ends with the next line, or with the
+    output if it is ``closed``.
+    """
+    if cp2k_version < 8.1:
+        return len(lines) > line_n + 1 and len(lines) >= line_n + 2 + int(
+            math.ceil(int(lines[line_n + 1]) / 4)
+        )
+    count = _count_bands_cp2k_greater_81(lines, line_n)
+    return 0 < nbands <= count and (closed or line_n + 2 + count < len(lines))
+
+
+def _parse_bands(lines, n_start, cp2k_version, closed=True):
+    """Parse band structure from the CP2K output.
+
+    All k-point headers are located in a single pass, the bands of each k-point are then
+    converted block-wise into a preallocated ``(nspin, nkpts, nbands)`` array.
+
+    :param closed: whether ``lines`` go to the end of the output. The last k-point block is skipped if its
+        bands are incomplete, e.g. while the output is being written or if it was truncated.
+    """
 
-    kpoints = []
-    labels = []
-    bands_s1 = []
-    bands_s2 = []
     known_kpoints = {}
+    headers = []
 
     if cp2k_version < 8.1:
+        is_kpoint_header = _is_kpoint_header_cp2k_lower_81
         parse_one_kpoint = _parse_kpoint_cp2k_lower_81
-        pattern = re.compile(r".*?Nr.*?Spin.*?K-Point.*?", re.DOTALL)
         unspecified = ["not", "specified"]
     else:
+        is_kpoint_header = _is_kpoint_header_cp2k_greater_81
         parse_one_kpoint = _parse_bands_cp2k_greater_81
-        pattern = re.compile(r".*?Point.*?Spin.*?", re.DOTALL)
         unspecified = ["not", "specifi"]
 
-    selected_lines = lines[n_start:]
-    for line_n, line in enumerate(selected_lines):
+    for line_n in range(n_start, len(lines)):
+        line = lines[line_n]
         if "KPOINTS| Special" in line:
             splitted = line.split()
             kpoint = tuple(float(p) for p in splitted[-3:])
             if splitted[-5:-3] != unspecified:
                 label = splitted[-4]
                 known_kpoints[kpoint] = label
+        elif is_kpoint_header(line):
+            headers.append(line_n)
 
-        elif pattern.match(line):
-            spin, kpoint, bands = parse_one_kpoint(selected_lines, line_n)
+    if headers:
+        if cp2k_version >= 8.1:
+            nbands = _count_bands_cp2k_greater_81(lines, headers[0])
+        elif len(lines) > headers[0] + 1:
+            nbands = int(lines[headers[0] + 1])
+        else:
+            nbands = 0
+        if not _is_kpoint_block_complete(
+            lines, headers[-1], cp2k_version, nbands, closed
+        ):
+            headers.pop()
 
-            # When doing a path Γ-X-K, CP2K does Γ-X, X-K and we would
-            # end up with repeated points in the path. If we already have
-            # kpoints in the the list and we got exactly the same KP again,
-            # skip adding the kpoint, the label and the bands.
-            if kpoints and (kpoints[-1] == kpoint):
-                continue
+    if not headers:
+        return np.array([]), [], np.array([])
 
-            if spin == 1:
-                if kpoint in known_kpoints:
-                    labels.append((len(kpoints), known_kpoints[kpoint]))
-                kpoints.append(kpoint)
-                bands_s1.append(bands)
-            elif spin == 2:
-                bands_s2.append(bands)
+    # When doing a path Γ-X-K, CP2K does Γ-X, X-K and we would
+    # end up with repeated points in the path. If we got exactly the same KP
+    # again for the same spin, skip adding the kpoint, the label and the bands.
+    kpoints = {1: [], 2: []}
+    bands = {1: [], 2: []}
+    for line_n in headers:
+        spin, kpoint, kpoint_bands = parse_one_kpoint(lines, line_n, nbands)
+        if kpoints[spin] and (kpoints[spin][-1] == kpoint):
+            continue
+        kpoints[spin].append(kpoint)
+        bands[spin].append(kpoint_bands)
 
-    if bands_s2:
-        bands = [bands_s1, bands_s2]
-    else:
-        bands = bands_s1
+    nspin = 2 if bands[2] else 1
+    all_bands = np.empty((nspin, len(kpoints[1]), nbands))
+    for ispin in range(nspin):
+        for i_kpoint, kpoint_bands in enumerate(bands[ispin + 1]):
+            all_bands[ispin, i_kpoint] = kpoint_bands
+
+    labels = [
+        (i_kpoint, known_kpoints[kpoint])
+        for i_kpoint, kpoint in enumerate(kpoints[1])
+        if kpoint in known_kpoints
+    ]
+
+    return np.array(kpoints[1]), labels, all_bands if nspin == 2 else all_bands[0]
+
+
+def _get_restart_section(content, name, start=0):
+    """Return the body of the first ``&<name>`` section found after ``start`` (None if absent).
 
-    return np.array(kpoints), labels, np.array(bands)
+    The section is located with ``str.find``, which is much cheaper than a DOTALL regex on
+    large restart files.
+    """
+    header = content.find(f"&{name}\n", start)
+    if header == -1:
+        return None
+    body_start = header + len(name) + 2
+    end = content.find(f"&END {name}\n", body_start)
+    if end == -1:
+        return None
+    return content[body_start : content.rfind("\n", body_start, end) + 1]
 
 
-def parse_cp2k_trajectory(content):
-    """CP2K trajectory parser."""
+def parse_cp2k_trajectory(content, velocities=False):
+    """CP2K trajectory parser.
+
+    :param content: content of the CP2K restart file.
+    :param velocities: if True, also return the ``&VELOCITY`` section of the restart file (if present)
+        as ``velocities`` array, in atomic units as written by CP2K.
+    """
+    # Only look into the SUBSYS section, as the MOTION section (e.g. thermostats) may contain COORD too.
+    subsys = max(content.find("&SUBSYS\n"), 0)
+
     # Parse coordinate section
-    match = re.search(r"\n\s*&COORD\n(.*?)\n\s*&END COORD\n", content, re.DOTALL)
-    coord_lines = [line.strip().split() for line in match.group(1).splitlines()]
+    coord_section = _get_restart_section(content, "COORD", subsys)
+    positions = np.loadtxt(io.StringIO(coord_section), usecols=(1, 2, 3), ndmin=2)
 
     # splitting element name and the tag (if present)
-    symbols = []
-    tags = []
-    for atomic_kind in [line[0] for line in coord_lines]:
-        symbols.append("".join([s for s in atomic_kind if not s.isdigit()]))
-        try:
-            tag = int("".join([s for s in atomic_kind if s.isdigit()]))
-        except ValueError:
-            tag = 0
-        tags.append(tag)
-
-    # get positions
-    positions_str = [line[1:] for line in coord_lines]
-    positions = np.array(positions_str, np.float64)
-
-    # parse cell section
-    match = re.search(r"\n\s*&CELL\n(.*?)\n\s*&END CELL\n", content, re.DOTALL)
-    cell_lines = [line.strip().split() for line in match.group(1).splitlines()]
+    kind_names = KIND_NAME_RE.findall(coord_section)
+    if len(kind_names) != len(positions):
+        raise ValueError(
+            f"Found {len(kind_names)} kind names for {len(positions)} positions in the COORD section."
+        )
+    symbols = [element + suffix for element, _, suffix in kind_names]
+    tags = np.array([int(tag or 0) for _, tag, _ in kind_names])
+
+    # parse cell section (keywords only, they come before subsections like CELL_REF)
+    cell_section = _get_restart_section(content, "CELL", subsys).split("&", 1)[0]
+    cell_lines = [line.split() for line in cell_section.splitlines() if line.strip()]
     cell_str = [line[1:] for line in cell_lines if line[0] in "ABC"]
     cell = np.array(cell_str, np.float64)
 
@@ -433,10 +1080,110 @@ def parse_cp2k_trajectory(content):
             cell_pbc_str = line[-1]
             cell_pbc = [(dir in cell_pbc_str) for dir in ["X", "Y", "Z"]]
 
-    return {
-        "symbols": symbols,
+    result = {
+        "symbols": list(symbols),
         "positions": positions,
         "cell": cell,
-        "tags": tags,
+        "tags": tags.tolist(),
         "pbc": cell_pbc,
     }
+
+    if velocities:
+        velocity_section = _get_restart_section(content, "VELOCITY", subsys)
+        if velocity_section is not None:
+            result["velocities"] = np.fromstring(velocity_section, sep=" ").reshape(
+                -1, 3
+            )
+
+    return result
+
+
+def parse_cp2k_md_state(content):
+    """Extract the state of the MOTION/MD section needed to continue an MD run from a restart file.
+
+    Returns a dictionary of numpy arrays: the MD counters (``step_start_val``, ``time_start_val``,
+    ``econs_start_val``), the Nose-Hoover chains (``nose_coord``, ``nose_velocity``, ``nose_mass``,
+    ``nose_force``), the CSVR thermostat energies (``csvr_thermostat_energy``) and the barostat
+    (``barostat_velocity``, ``barostat_mass``). Sections that are not present are skipped.
+    """
+    state = {}
+    motion = content.find("&MOTION\n")
+    if motion == -1:
+        return state
+    md_section = _get_restart_section(content, "MD", motion)
+    if md_section is None:
+        return state
+
+    # The barostat has its own thermostat: look for it before the particle thermostat.
+    barostat = _get_restart_section(md_section, "BAROSTAT")
+    if barostat is not None:
+        for name in ("VELOCITY", "MASS"):
+            section = _get_restart_section(barostat, name)
+            if section is not None:
+                state[f"barostat_{name.lower()}"] = np.fromstring(section, sep=" ")
+        md_section = md_section.replace(barostat, "", 1)
+
+    # MD counters are keywords of the MD section itself, which come before its subsections.
+    for keyword, dtype in (
+        ("STEP_START_VAL", np.int64),
+        ("TIME_START_VAL", np.float64),
+        ("ECONS_START_VAL", np.float64),
+    ):
+        match = re.search(rf"^\s*{keyword}\s+(\S+)", md_section, re.MULTILINE)
+        if match:
+            state[keyword.lower()] = np.array([float(match.group(1))], dtype)
+
+    thermostat = _get_restart_section(md_section, "THERMOSTAT")
+    if thermostat is not None:
+        nose = _get_restart_section(thermostat, "NOSE")
+        if nose is not None:
+            for name in ("COORD", "VELOCITY", "MASS", "FORCE"):
+                section = _get_restart_section(nose, name)
+                if section is not None:
+                    state[f"nose_{name.lower()}"] = np.fromstring(section, sep=" ")
+        csvr = _get_restart_section(thermostat, "CSVR")
+        if csvr is not None:
+            section = _get_restart_section(csvr, "THERMOSTAT_ENERGY")
+            if section is not None:
+                state["csvr_thermostat_energy"] = np.fromstring(section, sep=" ")
+
+    return state
+
+
+def parse_cp2k_xyz_trajectory(content, frame_info=True):
+    """Parse an XYZ trajectory (positions or forces) written by CP2K.
+
+    :param frame_info: if True, also return the step ids and the energies from the comment lines.
+    :returns: a dictionary with the ``coords`` of all frames and, if requested, ``stepids`` and ``energies``.
+    """
+    from cp2k_output_tools.trajectories.xyz import parse
+
+    coords = []
+    stepids = []
+    energies = []
+    for frame in parse(content):
+        _, frame_coords = zip(*frame["atoms"])
+        coords.append(frame_coords)
+        if frame_info:
+            comment_split = frame["comment"].split(",")
+            stepids.append(int(comment_split[0].split()[-1]))
+            energy_index = next(
+                (i for i, s in enumerate(comment_split) if "E =" in s), None
+            )
+            energies.append(float(comment_split[energy_index].split()[-1]))
+
+    result = {"coords": np.array(coords)}
+    if frame_info:
+        result["stepids"] = np.array(stepids)
+        result["energies"] = np.array(energies)
+    return result
+
+
+def parse_cp2k_cell_trajectory(content):
+    """Parse the cell trajectory written by CP2K into an array of 3x3 cells."""
+    return np.array(
+        [
+            np.fromstring(line, sep=" ")[2:-1].reshape(3, 3)
+            for line in content.splitlines()[1:]
+        ]
+    )
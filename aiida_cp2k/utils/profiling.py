@@ -0,0 +1,159 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""AiiDA-CP2K timing and memory instrumentation."""
+
+import contextlib
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+def get_peak_rss():
+    """Return the peak resident set size of the current process over its lifetime in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageProfiler:
+    """Record the wall time and the memory of named stages.
+
+    As the operating system only reports the peak resident set size (RSS) of the whole process over its lifetime,
+    the memory of a stage is recorded as ``peak_rss_increase_bytes``, the amount by which the stage raised this peak.
+    It is zero for a stage that stayed below a peak reached earlier, e.g., by a previous calculation parsed by the
+    same daemon worker. A stage recorded more than once, e.g., for each of the packed structures, is accumulated:
+    its numbers are summed and ``calls`` counts the records.
+
+    Usage::
+
+        profiler = StageProfiler()
+        with profiler.stage("read") as record:
+            content = ...
+            profiler.count_content(record, content)
+
+    If the profiler is disabled, the stages are not recorded and cost (almost) nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager recording the stage `name`. It yields a dictionary to add custom data to."""
+        record = {}
+        if not self.enabled:
+            yield record
+            return
+
+        start = time.perf_counter()
+        start_peak_rss = get_peak_rss()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if start_peak_rss is not None:
+                record["peak_rss_increase_bytes"] = get_peak_rss() - start_peak_rss
+            self._add_record(name, record)
+
+    def _add_record(self, name, record):
+        """Add `record` to the stage `name`, summing its numbers with those of the previous records of the stage."""
+        total = self.stages.setdefault(name, {"calls": 0})
+        total["calls"] += 1
+        for key, value in record.items():
+            if isinstance(value, (int, float)) and key in total:
+                total[key] += value
+            else:
+                total[key] = value
+
+    def count_content(self, record, content):
+        """Add the size (`chars` for text, `bytes` otherwise) and the number of lines of `content` to a record."""
+        if not self.enabled or content is None:
+            return
+        if isinstance(content, str):
+            record["chars"] = len(content)
+            record["lines"] = content.count("\n")
+        else:
+            record["bytes"] = len(content)
+            record["lines"] = content.count(b"\n")
+
+    def wrap(self, name, function):
+        """Return `function` recording its calls as stage `name`, e.g., to time tasks run by an executor."""
+        if not self.enabled:
+            return function
+
+        def wrapped(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+
+        return wrapped
+
+    def report(self, node, extra_name, logger):
+        """Store the recorded stages as extra `extra_name` of `node` and emit them through `logger`."""
+        if not self.enabled:
+            return
+        node.base.extras.set(extra_name, self.stages)
+        for name, record in self.stages.items():
+            logger.info(
+                f"{extra_name}: {name} "
+                + ", ".join(f"{key}={value}" for key, value in record.items())
+            )
+
+
+def aggregate_timing_reports(filters=None):
+    """Sum the timing reports (`output_timing`) of many CP2K calculations per subroutine.
+
+    :param filters: optional QueryBuilder filters on the calculation nodes, e.g. ``{"ctime": {">": date}}``.
+    :returns: dictionary of arrays sorted by decreasing self time, with ``routine``, ``calculations``
+        (number of calculations calling it), ``calls``, ``self_time`` and ``total_time`` (sums of the
+        maxima over the ranks, in seconds).
+    """
+    from aiida import orm
+
+    query = orm.QueryBuilder()
+    query.append(
+        orm.CalcJobNode,
+        filters={"process_type": "aiida.calculations:cp2k", **(filters or {})},
+        tag="calculation",
+    )
+    query.append(
+        orm.ArrayData,
+        with_incoming="calculation",
+        edge_filters={"label": "output_timing"},
+    )
+
+    totals = {}
+    for (timing,) in query.iterall():
+        for routine, calls, self_time, total_time in zip(
+            timing.get_array("routine"),
+            timing.get_array("calls"),
+            timing.get_array("self_time_maximum"),
+            timing.get_array("total_time_maximum"),
+        ):
+            entry = totals.setdefault(str(routine), [0, 0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += int(calls)
+            entry[2] += float(self_time)
+            entry[3] += float(total_time)
+
+    routines = sorted(totals, key=lambda routine: totals[routine][2], reverse=True)
+    columns = list(zip(*(totals[routine] for routine in routines))) or [[], [], [], []]
+    return {
+        "routine": np.array(routines, str),
+        "calculations": np.array(columns[0], np.int64),
+        "calls": np.array(columns[1], np.int64),
+        "self_time": np.array(columns[2], np.float64),
+        "total_time": np.array(columns[3], np.float64),
+    }
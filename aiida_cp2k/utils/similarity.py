@@ -0,0 +1,107 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""AiiDA-CP2K search of finished calculations on similar structures."""
+
+import numpy as np
+
+from .fingerprint import (
+    SIMILARITY_DESCRIPTOR_EXTRA,
+    SIMILARITY_EXTRA,
+    get_positions_descriptor,
+    get_similarity_fingerprint,
+)
+
+
+def get_positions_rmsd(cell, positions, other_positions):
+    """Return the root mean square displacement between two sets of positions of the same atoms in `cell` [Angstrom].
+
+    The displacements are wrapped to the nearest periodic image, so that atoms crossing the cell boundaries do
+    not count.
+    """
+    inverse = np.linalg.inv(np.asarray(cell, dtype=float))
+    displacements = (
+        np.asarray(other_positions, dtype=float) - np.asarray(positions, dtype=float)
+    ) @ inverse
+    displacements -= np.round(displacements)
+    displacements = displacements @ cell
+    return float(np.sqrt(np.mean(np.sum(displacements**2, axis=1))))
+
+
+def _get_fractional_positions(attributes):
+    """Return the fractional positions of the sites from the attributes of a StructureData."""
+    positions = np.array([site["position"] for site in attributes["sites"]])
+    return positions @ np.linalg.inv(np.array(attributes["cell"]))
+
+
+def find_similar_calculation(inputs, max_rmsd, filters=None):
+    """Find the finished CP2K calculation on the structure most similar to the one of `inputs`.
+
+    The candidates are the calculations that finished successfully, whose remote folder was not cleaned, and with
+    the same `SIMILARITY_EXTRA` as `inputs`: the same code, kinds and kind of each site in the same order,
+    parameters (basis sets, charge, multiplicity...) apart from the geometry, and other inputs (see
+    `get_similarity_fingerprint`). The atoms must be in the same order, as the wave function of the candidate
+    refers to its atoms in their order. The candidate with the smallest RMSD of the fractional positions
+    (converted with the cell of the structure, so that strain scans match) is returned, e.g., to restart from
+    its wave function.
+
+    The candidates are first filtered in the query by their `SIMILARITY_DESCRIPTOR_EXTRA`: each component of the
+    difference of the descriptors (see `get_positions_descriptor`) is at most 2 pi times the RMSD of the
+    fractional positions, itself at most the RMSD divided by the smallest singular value of the cell. The
+    extras are set by `index_calculations` and by `Cp2kBaseWorkChain` with `guess_max_rmsd`.
+
+    :param inputs: the inputs of a `Cp2kCalculation` with a `structure`, as a (nested) dictionary of nodes.
+    :param max_rmsd: largest RMSD of the positions [Angstrom].
+    :param filters: optional QueryBuilder filters on the calculation nodes, e.g. ``{"ctime": {">": date}}``.
+    :returns: tuple with the calculation node and the RMSD, or None if no calculation is similar enough.
+    """
+    from aiida import orm
+
+    structure = inputs["structure"]
+    cell = np.array(structure.cell)
+    positions = _get_fractional_positions(structure.base.attributes.all) @ cell
+
+    bound = 2 * np.pi * max_rmsd / np.linalg.svd(cell, compute_uv=False).min()
+    descriptor_filters = []
+    for name, value in get_positions_descriptor(structure).items():
+        key = f"extras.{SIMILARITY_DESCRIPTOR_EXTRA}.{name}"
+        descriptor_filters.append({key: {">=": value - bound}})
+        descriptor_filters.append({key: {"<=": value + bound}})
+
+    query = orm.QueryBuilder()
+    query.append(
+        orm.CalcJobNode,
+        filters={
+            "process_type": "aiida.calculations:cp2k",
+            "attributes.exit_status": 0,
+            f"extras.{SIMILARITY_EXTRA}": get_similarity_fingerprint(inputs),
+            "and": descriptor_filters,
+            **(filters or {}),
+        },
+        project=["*"],
+        tag="calculation",
+    )
+    query.append(
+        orm.StructureData,
+        with_outgoing="calculation",
+        edge_filters={"label": "structure"},
+        project=["attributes"],
+    )
+    query.append(
+        orm.RemoteData,
+        with_incoming="calculation",
+        edge_filters={"label": "remote_folder"},
+        filters={"extras": {"!has_key": orm.RemoteData.KEY_EXTRA_CLEANED}},
+    )
+
+    best = None
+    for calculation, attributes in query.iterall():
+        rmsd = get_positions_rmsd(
+            cell, positions, _get_fractional_positions(attributes) @ cell
+        )
+        if rmsd <= max_rmsd and (best is None or rmsd < best[1]):
+            best = (calculation, rmsd)
+    return best
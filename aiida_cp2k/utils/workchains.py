@@ -6,6 +6,7 @@
 ###############################################################################
 """AiiDA-CP2K utilities for workchains"""
 
+import math
 import re
 
 from aiida.engine import calcfunction
@@ -203,3 +204,183 @@ def resize_unit_cell(struct, resize):
     """Resize the StructureData according to the resize Dict"""
     resize_tuple = tuple(resize[x] for x in ["nx", "ny", "nz"])
     return StructureData(ase=struct.get_ase().repeat(resize_tuple))
+
+
+def validate_max_concurrent(value, _):
+    """Validate that the number of calculations run at the same time is positive."""
+    if value is not None and value.value < 1:
+        return f"At least one calculation must run at a time, got `max_concurrent` {value.value}."
+    return None
+
+
+def has_remote_file(remote_folder, filename):
+    """Return whether a non-empty file is in a remote folder, or None if the remote computer can not be reached.
+
+    A folder cleaned by AiiDA has the `cleaned` extra, but a folder purged on the cluster, e.g. by a scratch
+    cleanup, is only detected by connecting to the computer.
+    """
+    import os
+
+    if remote_folder.base.extras.get(remote_folder.KEY_EXTRA_CLEANED, False):
+        return False
+    path = os.path.join(remote_folder.get_remote_path(), filename)
+    try:
+        with remote_folder.get_authinfo().get_transport() as transport:
+            return transport.isfile(path) and transport.get_attribute(path).st_size > 0
+    except Exception:  # The connection failed.
+        return None
+
+
+def scale_resources(
+    steps_done,
+    remaining_steps,
+    max_wallclock_seconds,
+    num_machines,
+    limits,
+    elapsed_seconds=None,
+):
+    """Choose the wall time and the number of machines needed to complete the remaining steps.
+
+    The progress rate of the previous calculation, which ran out of wall time, is assumed to scale linearly
+    with the number of machines. The wall time is increased first, the number of machines only if the
+    wall time limit is not enough. The resources are never decreased.
+
+    :param steps_done: number of (MD or optimization) steps done by the previous calculation.
+    :param remaining_steps: number of steps left.
+    :param max_wallclock_seconds: wall time of the previous calculation.
+    :param num_machines: number of machines of the previous calculation.
+    :param limits: dictionary with the upper limits `max_wallclock_seconds` and `max_num_machines`.
+    :param elapsed_seconds: time in which the steps were done, e.g., the CP2K WALLTIME, `max_wallclock_seconds`
+        if None. The difference to `max_wallclock_seconds` is kept as margin in the new wall time.
+    :returns: tuple with the new wall time and number of machines.
+    """
+    max_wallclock_limit = max(
+        limits.get("max_wallclock_seconds", max_wallclock_seconds),
+        max_wallclock_seconds,
+    )
+    num_machines_limit = max(limits.get("max_num_machines", num_machines), num_machines)
+
+    if steps_done <= 0:
+        # No progress rate: give the next calculation as much time as allowed.
+        return max_wallclock_limit, num_machines
+
+    if elapsed_seconds is None:
+        elapsed_seconds = max_wallclock_seconds
+    margin = max(max_wallclock_seconds - elapsed_seconds, 0)
+    needed = remaining_steps / steps_done * elapsed_seconds
+    new_num_machines = num_machines
+    if needed + margin > max_wallclock_limit:
+        available = max_wallclock_limit - margin
+        new_num_machines = (
+            min(num_machines_limit, math.ceil(num_machines * needed / available))
+            if available > 0
+            else num_machines_limit
+        )
+        needed *= num_machines / new_num_machines
+    new_wallclock = min(
+        max(max_wallclock_seconds, math.ceil(needed + margin)), max_wallclock_limit
+    )
+    return new_wallclock, new_num_machines
+
+
+def get_layout_calibration(calculations):
+    """Compute the cost of past CP2K calculations per number of OpenMP threads per MPI rank.
+
+    The cost is the wall time (from the `performance` summary of the advanced parser) times the number
+    of machines, per atom, averaged over the calculations run with the same number of threads.
+
+    :param calculations: iterable of finished `Cp2kCalculation` nodes.
+    :returns: dictionary mapping the number of threads to the average cost in machine-seconds per atom.
+    """
+    costs = {}
+    for calc in calculations:
+        if "output_parameters" not in calc.outputs:
+            continue
+        output = calc.outputs.output_parameters.get_dict()
+        walltime = output.get("performance", {}).get("walltime_seconds")
+        natoms = output.get("natoms")
+        if not walltime or not natoms:
+            continue
+        resources = calc.base.attributes.get("resources", {})
+        environment = calc.base.attributes.get("environment_variables", {})
+        threads = int(
+            resources.get("num_cores_per_mpiproc")
+            or environment.get("OMP_NUM_THREADS", 1)
+        )
+        costs.setdefault(threads, []).append(
+            walltime * resources.get("num_machines", 1) / natoms
+        )
+    return {threads: sum(values) / len(values) for threads, values in costs.items()}
+
+
+def propose_parallel_layout(
+    natoms,
+    cores_per_machine,
+    num_machines=None,
+    atoms_per_machine=64,
+    max_threads_per_rank=8,
+    calibration=None,
+    diag_library=None,
+    fftw_plan_type=None,
+):
+    """Propose the MPI/OpenMP layout of a CP2K calculation for the given system size and machine shape.
+
+    All the cores of the machines are used. Among the numbers of OpenMP threads per MPI rank that divide
+    the number of cores, the first one giving a square total number of (more than one) MPI ranks is chosen,
+    since CP2K distributes the matrices on a square process grid. The numbers of threads are tried from the
+    cheapest in `calibration` (see `get_layout_calibration`) or, without calibration, from the smallest.
+
+    :param natoms: number of atoms or the `StructureData`.
+    :param cores_per_machine: number of cores of a machine.
+    :param num_machines: number of machines, estimated from `atoms_per_machine` if not given.
+    :param atoms_per_machine: number of atoms per machine used to estimate the number of machines.
+    :param max_threads_per_rank: maximum number of OpenMP threads per MPI rank.
+    :param calibration: optional dictionary mapping numbers of threads to their cost.
+    :param diag_library: optional `PREFERRED_DIAG_LIBRARY`, e.g. "ELPA" if CP2K was built with it, set only
+        if more than one MPI rank is used.
+    :param fftw_plan_type: optional `FFTW_PLAN_TYPE`, e.g. "MEASURE", which pays off for long calculations.
+    :returns: dictionary with the `resources` and `environment_variables` options of the calculation
+        and the `GLOBAL` keywords to add to the parameters.
+    """
+    if not isinstance(natoms, int):
+        natoms = len(natoms.sites)
+    if num_machines is None:
+        num_machines = max(1, math.ceil(natoms / atoms_per_machine))
+
+    threads_options = [
+        threads
+        for threads in range(1, min(cores_per_machine, max_threads_per_rank) + 1)
+        if cores_per_machine % threads == 0
+    ]
+    if calibration:
+        threads_options.sort(key=lambda threads: calibration.get(threads, float("inf")))
+
+    def is_square(number):
+        return number > 1 and math.isqrt(number) ** 2 == number
+
+    num_threads = next(
+        (
+            threads
+            for threads in threads_options
+            if is_square(num_machines * cores_per_machine // threads)
+        ),
+        threads_options[0],
+    )
+    num_ranks = num_machines * cores_per_machine // num_threads
+
+    # The libraries depend on how CP2K was built, so they are only set on request.
+    global_keywords = {}
+    if diag_library is not None and num_ranks > 1:
+        global_keywords["PREFERRED_DIAG_LIBRARY"] = diag_library
+    if fftw_plan_type is not None:
+        global_keywords["FFTW_PLAN_TYPE"] = fftw_plan_type
+
+    return {
+        "resources": {
+            "num_machines": num_machines,
+            "num_mpiprocs_per_machine": cores_per_machine // num_threads,
+            "num_cores_per_mpiproc": num_threads,
+        },
+        "environment_variables": {"OMP_NUM_THREADS": str(num_threads)},
+        "GLOBAL": global_keywords,
+    }
@@ -7,5 +7,11 @@
 """AiiDA-CP2K workchains"""
 
 from .base import Cp2kBaseWorkChain
+from .batch import Cp2kBatchWorkChain
+from .cutoff import Cp2kCutoffConvergenceWorkChain
 
-__all__ = ["Cp2kBaseWorkChain"]
+__all__ = [
+    "Cp2kBaseWorkChain",
+    "Cp2kBatchWorkChain",
+    "Cp2kCutoffConvergenceWorkChain",
+]
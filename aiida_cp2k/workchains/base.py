@@ -19,6 +19,18 @@ class Cp2kBaseWorkChain(engine.BaseRestartWorkChain):
         # yapf: disable
         super().define(spec)
         spec.expose_inputs(Cp2kCalculation, namespace='cp2k')
+        spec.input('auto_walltime', valid_type=orm.Bool, default=lambda: orm.Bool(False),
+                   help='Set GLOBAL/WALLTIME from `metadata.options.max_wallclock_seconds` minus a safety margin, '
+                   'unless it is given in the parameters, so that CP2K stops cleanly and writes a restart file.')
+        spec.input('resource_limits', valid_type=orm.Dict, required=False,
+                   help='Upper limits `max_wallclock_seconds` and `max_num_machines` within which the resources '
+                   'are increased when a calculation runs out of wall time. Not increased if not given.')
+        spec.input('walltime_safety_margin', valid_type=orm.Int, required=False,
+                   help='Safety margin in seconds for `auto_walltime`. Default: 5% of the wall time, at least 5 minutes.')
+        spec.input('guess_max_rmsd', valid_type=orm.Float, required=False,
+                   help='If given, the wave function of the most similar finished calculation with the same inputs apart '
+                   'from the geometry, on the same atoms with positions within this RMSD [Angstrom], is used as initial '
+                   'guess. The calculations run by the work chain are indexed for the following searches.')
 
         spec.outline(
             cls.setup,
@@ -33,6 +45,8 @@ class Cp2kBaseWorkChain(engine.BaseRestartWorkChain):
         spec.expose_outputs(Cp2kCalculation)
         spec.output('final_input_parameters', valid_type=orm.Dict, required=False,
                     help='The input parameters used for the final calculation.')
+        spec.output('output_motion_step_info', valid_type=orm.ArrayData, required=False,
+                    help='The `motion_step_info` of all the calculations, merged without repeated steps.')
         spec.exit_code(400, 'NO_RESTART_DATA', message="The calculation didn't produce any data to restart from.")
         spec.exit_code(300, 'ERROR_UNRECOVERABLE_FAILURE',
                        message='The calculation failed with an unidentified unrecoverable error.')
@@ -47,6 +61,54 @@ class Cp2kBaseWorkChain(engine.BaseRestartWorkChain):
         """
         super().setup()
         self.ctx.inputs = common.AttributeDict(self.exposed_inputs(Cp2kCalculation, 'cp2k'))
+        self.ctx.auto_walltime = self.inputs.auto_walltime.value and \
+            'WALLTIME' not in self.ctx.inputs.parameters.get_dict().get('GLOBAL', {})
+        self._set_walltime()
+        self._set_similar_wfn_guess()
+
+    def _set_similar_wfn_guess(self):
+        """Restart from the wave function of the most similar finished calculation, if `guess_max_rmsd` is given."""
+        if 'guess_max_rmsd' not in self.inputs or 'parent_calc_folder' in self.ctx.inputs or 'structure' not in self.ctx.inputs:
+            return
+        similar = utils.find_similar_calculation(self.ctx.inputs, self.inputs.guess_max_rmsd.value)
+        if similar is None:
+            self.report('No similar finished calculation found, the initial guess is not changed.')
+            return
+        calc, rmsd = similar
+        self.report(f'Using the wave function of {calc.process_label}<{calc.pk}> as initial guess (RMSD {rmsd:.3f} A).')
+        self.ctx.inputs.parent_calc_folder = calc.outputs.remote_folder
+        self.ctx.inputs.parameters = utils.add_wfn_restart_section(self.ctx.inputs.parameters,
+                                                                   orm.Bool('kpoints' in self.ctx.inputs))
+
+    def run_process(self):
+        """Run the next calculation, indexed for the search of similar calculations if `guess_max_rmsd` is given."""
+        result = super().run_process()
+        if 'guess_max_rmsd' in self.inputs and 'structure' in self.ctx.inputs:
+            calculation = orm.load_node(result['children'].pk)
+            calculation.base.extras.set_many({
+                utils.SIMILARITY_EXTRA: utils.get_similarity_fingerprint(self.ctx.inputs),
+                utils.SIMILARITY_DESCRIPTOR_EXTRA: utils.get_positions_descriptor(self.ctx.inputs.structure),
+            })
+        return result
+
+    def _set_walltime(self):
+        """Set GLOBAL/WALLTIME below the wall time requested to the scheduler, if `auto_walltime` is enabled."""
+        if not self.ctx.auto_walltime:
+            return
+        max_wallclock_seconds = self.ctx.inputs.get('metadata', {}).get('options', {}).get('max_wallclock_seconds')
+        if max_wallclock_seconds is None:
+            return
+        if 'walltime_safety_margin' in self.inputs:
+            margin = self.inputs.walltime_safety_margin.value
+        else:
+            margin = max(300, 0.05 * max_wallclock_seconds)
+        walltime = int(max_wallclock_seconds - margin)
+        if walltime <= 0:
+            self.report(f"The wall time of {max_wallclock_seconds} s is shorter than the safety margin of {margin} s, "
+                        "GLOBAL/WALLTIME is not set.")
+            return
+        if self.ctx.inputs.parameters.get_dict().get('GLOBAL', {}).get('WALLTIME') != walltime:
+            self.ctx.inputs.parameters = utils.add_walltime_section(self.ctx.inputs.parameters, orm.Int(walltime))
 
     def _collect_all_trajetories(self):
         """Collect all trajectories from the children calculations."""
@@ -59,6 +121,21 @@ class Cp2kBaseWorkChain(engine.BaseRestartWorkChain):
                     pass
         return trajectories
 
+    def _collect_all_motion_step_info(self):
+        """Collect the nodes holding the `motion_step_info` of the children calculations.
+
+        The arrays stored by the parser are used if available, the output parameters otherwise.
+        """
+        nodes = []
+        for called in self.ctx.children:
+            if not isinstance(called, orm.CalcJobNode):
+                continue
+            if 'output_arrays' in called.outputs and 'step' in called.outputs.output_arrays.get_arraynames():
+                nodes.append(called.outputs.output_arrays)
+            elif 'output_parameters' in called.outputs and 'motion_step_info' in called.outputs.output_parameters.keys():
+                nodes.append(called.outputs.output_parameters)
+        return nodes
+
     def results(self):
         super().results()
         if self.inputs.cp2k.parameters != self.ctx.inputs.parameters:
@@ -73,10 +150,88 @@ class Cp2kBaseWorkChain(engine.BaseRestartWorkChain):
                 output_trajectory = utils.merge_trajectory_data_unique(*trajectories)
             self.out("output_trajectory", output_trajectory)
 
+        motion_step_info = self._collect_all_motion_step_info()
+        if motion_step_info:
+            try:
+                self.out('output_motion_step_info', utils.merge_motion_step_info(*motion_step_info))
+            except ValueError as exception:
+                self.report(f'The motion step info of the calculations is not merged: {exception}')
+
     def overwrite_input_structure(self):
         if "output_structure" in self.ctx.children[self.ctx.iteration-1].outputs:
             self.ctx.inputs.structure = self.ctx.children[self.ctx.iteration-1].outputs.output_structure
 
+    @engine.process_handler(priority=402, exit_codes=[
+        Cp2kCalculation.exit_codes.ERROR_OUT_OF_WALLTIME,
+    ])
+    def scale_resources(self, calc):
+        """Increase the wall time or the number of machines of the next calculation, within `resource_limits`.
+
+        The resources are estimated from the number of MD or optimization steps done by the calculation that ran
+        out of wall time, within its CP2K WALLTIME, and the number of steps left. This requires the steps reported
+        by the advanced parser (`motion_step_info`). The calculation is then restarted: from its restart files if
+        the `restart_incomplete_calculation` handler is enabled, which runs next, otherwise from scratch.
+        """
+        if 'resource_limits' not in self.inputs:
+            return None
+
+        params = calc.inputs.parameters.get_dict()
+        run_type = params.get('GLOBAL', {}).get('RUN_TYPE', 'ENERGY').upper()
+        section, keyword, default = {
+            'MD': ('MD', 'STEPS', 3),
+            'GEO_OPT': ('GEO_OPT', 'MAX_ITER', 200),
+            'CELL_OPT': ('CELL_OPT', 'MAX_ITER', 200),
+        }.get(run_type, (None, None, None))
+        if section is None or 'output_parameters' not in calc.outputs:
+            return None
+
+        if 'output_arrays' in calc.outputs and 'step' in calc.outputs.output_arrays.get_arraynames():
+            steps = utils.get_motion_step_arrays(calc.outputs.output_arrays).get('step', [])
+        else:
+            steps = utils.get_motion_step_arrays(calc.outputs.output_parameters).get('step', [])
+        if len(steps) < 2:
+            self.report('The calculation did not report the steps it completed (`motion_step_info` of the advanced '
+                        'parser), the resources are not increased.')
+            return None
+        steps_done = int(steps[-1] - steps[0])
+        total_steps = int(params.get('MOTION', {}).get(section, {}).get(keyword, default))
+        restart_enabled = any(
+            handler.__name__ == 'restart_incomplete_calculation' for _, handler in self.get_process_handlers_by_priority())
+        if restart_enabled:
+            remaining_steps = max(total_steps - int(steps[-1]), 1)
+        else:
+            self.report('The `restart_incomplete_calculation` handler is disabled, the calculation is restarted from scratch.')
+            remaining_steps = total_steps
+
+        options = self.ctx.inputs.metadata.options
+        max_wallclock_seconds = calc.base.attributes.get('max_wallclock_seconds', None)
+        num_machines = options['resources'].get('num_machines', None)
+        if max_wallclock_seconds is None or num_machines is None:
+            return None
+
+        # CP2K stopped at its WALLTIME, if it was set, before the scheduler wall time.
+        walltime = utils.get_walltime_seconds(params)
+        elapsed_seconds = min(walltime, max_wallclock_seconds) if walltime else max_wallclock_seconds
+
+        new_wallclock, new_num_machines = utils.scale_resources(
+            steps_done, remaining_steps, max_wallclock_seconds, num_machines, self.inputs.resource_limits.get_dict(),
+            elapsed_seconds=elapsed_seconds)
+        self.report(f"{steps_done} steps were done in {elapsed_seconds} s and {remaining_steps} are left, "
+                    f"the next calculation runs for {new_wallclock} s on {new_num_machines} machines "
+                    f"instead of {max_wallclock_seconds} s on {num_machines}.")
+        resources = options['resources']
+        if 'tot_num_mpiprocs' in resources:
+            resources['tot_num_mpiprocs'] = resources['tot_num_mpiprocs'] // num_machines * new_num_machines
+        resources['num_machines'] = new_num_machines
+        options['max_wallclock_seconds'] = new_wallclock
+        if self.ctx.auto_walltime:
+            self._set_walltime()
+        elif walltime:
+            # Keep the margin of the WALLTIME given in the parameters.
+            self.ctx.inputs.parameters = utils.add_walltime_section(
+                self.ctx.inputs.parameters, orm.Int(int(new_wallclock - max_wallclock_seconds + elapsed_seconds)))
+        return engine.ProcessHandlerReport(False)
+
     @engine.process_handler(priority=401, exit_codes=[
         Cp2kCalculation.exit_codes.ERROR_OUT_OF_WALLTIME,
         Cp2kCalculation.exit_codes.ERROR_OUTPUT_INCOMPLETE,
@@ -114,10 +269,19 @@ class Cp2kBaseWorkChain(engine.BaseRestartWorkChain):
             # Signaling to the base work chain that the problem could not be recovered.
             return engine.ProcessHandlerReport(True, self.exit_codes.NO_RESTART_DATA)
 
-        self.ctx.inputs.parent_calc_folder = calc.outputs.remote_folder
         params = self.ctx.inputs.parameters
 
-        params = utils.add_wfn_restart_section(params, orm.Bool('kpoints' in self.ctx.inputs))
+        # If the restart file is gone, e.g. the remote folder was cleaned or purged, continue MD from the state stored
+        # by the parser. If the remote computer can not be reached, the remote folder is used as usual.
+        if possible_geometry_restart and 'output_md_state' in calc.outputs and utils.has_remote_file(
+                calc.outputs.remote_folder, Cp2kCalculation._DEFAULT_RESTART_FILE_NAME) is False:
+            self.report("The restart file is not in the remote folder, restarting MD from the stored velocities and "
+                        "thermostat state.")
+            self.ctx.inputs.pop('parent_calc_folder', None)
+            params = utils.add_md_state_section(params, calc.outputs.output_md_state)
+        else:
+            self.ctx.inputs.parent_calc_folder = calc.outputs.remote_folder
+            params = utils.add_wfn_restart_section(params, orm.Bool('kpoints' in self.ctx.inputs))
 
         if possible_geometry_restart:
             # Check if we need to fix restart snapshot in REFTRAJ MD
@@ -129,7 +293,8 @@ class Cp2kBaseWorkChain(engine.BaseRestartWorkChain):
                     params = utils.add_first_snapshot_in_reftraj_section(params, first_snapshot)
             except KeyError:
                 pass
-            params = utils.add_ext_restart_section(params)
+            if 'parent_calc_folder' in self.ctx.inputs:
+                params = utils.add_ext_restart_section(params)
 
         is_geo_opt = params.get_dict().get("GLOBAL", {}).get("RUN_TYPE") in ["GEO_OPT", "CELL_OPT"]
         if is_geo_opt and good_scf_gradient:
@@ -0,0 +1,237 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Work chain to run the same CP2K calculation on many structures."""
+
+import numpy as np
+from aiida import common, engine, orm
+
+from ..utils import (
+    FINGERPRINT_EXTRA,
+    find_calculation_by_fingerprint,
+    get_inputs_fingerprint,
+)
+from ..utils.workchains import validate_max_concurrent
+from .base import Cp2kBaseWorkChain
+
+
+def validate_structures(inputs, _):
+    """Validate that the structures are given either as a namespace or as a group."""
+    if bool(inputs.get("structures")) == ("structure_group" in inputs):
+        return "Exactly one of the `structures` and `structure_group` inputs must be specified."
+    return None
+
+
+@engine.calcfunction
+def collect_energies(labels, **parameters):
+    """Collect the energies of the calculations into a columnar ArrayData.
+
+    :param labels: List with the labels of all the structures.
+    :param parameters: output parameters of the successful calculations, as `index_<i>` with `i` the position of
+        the structure in `labels`.
+    :returns: ArrayData with the `labels` and the `energies` (NaN for the failed calculations).
+    """
+    labels = labels.get_list()
+    energies = np.full(len(labels), np.nan)
+    for key, output in parameters.items():
+        energies[int(key.split("_")[1])] = output.get_dict().get("energy", np.nan)
+
+    result = orm.ArrayData()
+    result.set_array("labels", np.array(labels, dtype=str))
+    result.set_array("energies", energies)
+    return result
+
+
+class Cp2kBatchWorkChain(engine.WorkChain):
+    """Work chain to run a `Cp2kBaseWorkChain` with the same inputs on many structures.
+
+    The structures are given as a namespace or as a group of StructureData. At most `max_concurrent`
+    calculations run at the same time: the work chain waits for the oldest running calculation and, once it
+    finished, submits as many new calculations as have finished by then. The energies of all the structures are
+    collected in a single ArrayData, so that a screening campaign does not need to query thousands of nodes
+    afterwards.
+
+    A work chain step can only wait for all of the processes it awaits, not for the first one to finish. So a
+    slow calculation delays the submission of the next ones even if the others have finished, and a batch of
+    calculations of very different costs runs closer to one window at a time.
+
+    With `skip_duplicates`, the structures whose inputs have the same fingerprint as a finished calculation (see
+    `get_inputs_fingerprint`), or as another structure of the batch, are not computed again. Only their energy
+    is reused: the atoms of the other calculation may be permuted, translated or rotated.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.expose_inputs(Cp2kBaseWorkChain, namespace="base")
+        spec.input_namespace(
+            "structures",
+            valid_type=orm.StructureData,
+            dynamic=True,
+            required=False,
+            help="The structures, with their label as key.",
+        )
+        spec.input(
+            "structure_group",
+            valid_type=orm.Str,
+            required=False,
+            help="Label of a group of StructureData, to use instead of `structures`.",
+        )
+        spec.input(
+            "max_concurrent",
+            valid_type=orm.Int,
+            default=lambda: orm.Int(50),
+            validator=validate_max_concurrent,
+            help="Number of calculations run at the same time.",
+        )
+        spec.input(
+            "skip_duplicates",
+            valid_type=orm.Bool,
+            default=lambda: orm.Bool(False),
+            help="Reuse the results of the finished calculations with identical inputs.",
+        )
+        spec.inputs.validator = validate_structures
+
+        spec.outline(
+            cls.setup,
+            engine.while_(cls.should_run_calculations)(
+                cls.run_calculations,
+                cls.inspect_calculations,
+            ),
+            cls.results,
+        )
+
+        spec.output(
+            "energies",
+            valid_type=orm.ArrayData,
+            help="The `labels` of the structures and their `energies` (NaN for the failed calculations).",
+        )
+        spec.exit_code(
+            401,
+            "ERROR_ALL_SUB_PROCESSES_FAILED",
+            message="All the calculations failed.",
+        )
+
+    def setup(self):
+        """Collect the labels and the pks of the structures."""
+        self.ctx.inputs = common.AttributeDict(
+            self.exposed_inputs(Cp2kBaseWorkChain, "base")
+        )
+        self.ctx.inputs.cp2k = common.AttributeDict(self.ctx.inputs.cp2k)
+
+        if "structure_group" in self.inputs:
+            group = orm.load_group(self.inputs.structure_group.value)
+            structures = (
+                orm.QueryBuilder()
+                .append(orm.Group, filters={"id": group.pk}, tag="group")
+                .append(
+                    orm.StructureData,
+                    with_group="group",
+                    project=["id", "label", "uuid"],
+                )
+                .order_by({orm.StructureData: {"id": "asc"}})
+                .all()
+            )
+            self.ctx.labels = [label or uuid for _, label, uuid in structures]
+            self.ctx.structures = [pk for pk, _, _ in structures]
+        else:
+            self.ctx.labels = sorted(self.inputs.structures)
+            self.ctx.structures = [
+                self.inputs.structures[label].pk for label in self.ctx.labels
+            ]
+
+        # Pks of the output parameters of the calculations, None for the failed ones, and the pks of the running
+        # work chains by the index of their structure.
+        self.ctx.parameters = [None] * len(self.ctx.structures)
+        self.ctx.running = {}
+        self.ctx.index = 0
+        self.ctx.finished = 0
+
+        # Fingerprints of the submitted calculations, and the indices of the structures identical to another one
+        # of the batch, which are not computed again.
+        self.ctx.fingerprints = {}
+        self.ctx.duplicates = {}
+
+    def should_run_calculations(self):
+        return self.ctx.index < len(self.ctx.structures) or bool(self.ctx.running)
+
+    def run_calculations(self):
+        """Submit calculations until `max_concurrent` are running, and wait for the oldest one."""
+        while (
+            self.ctx.index < len(self.ctx.structures)
+            and len(self.ctx.running) < self.inputs.max_concurrent.value
+        ):
+            index = self.ctx.index
+            self.ctx.index += 1
+
+            inputs = common.AttributeDict(self.ctx.inputs)
+            inputs.cp2k = common.AttributeDict(self.ctx.inputs.cp2k)
+            inputs.cp2k.structure = orm.load_node(self.ctx.structures[index])
+            inputs.metadata = {
+                **inputs.get("metadata", {}),
+                "label": self.ctx.labels[index],
+                "call_link_label": f"structure_{index}",
+            }
+
+            fingerprint = None
+            if self.inputs.skip_duplicates:
+                fingerprint = get_inputs_fingerprint(inputs.cp2k)
+                if fingerprint in self.ctx.fingerprints:
+                    self.ctx.duplicates[str(index)] = self.ctx.fingerprints[fingerprint]
+                    continue
+                previous = find_calculation_by_fingerprint(fingerprint)
+                if previous is not None:
+                    self.report(
+                        f"Reusing the results of {self.ctx.labels[index]} from process {previous.pk}."
+                    )
+                    self.ctx.parameters[index] = previous.outputs.output_parameters.pk
+                    self.ctx.finished += 1
+                    continue
+                self.ctx.fingerprints[fingerprint] = index
+
+            workchain = self.submit(Cp2kBaseWorkChain, **inputs)
+            if fingerprint is not None:
+                workchain.base.extras.set(FINGERPRINT_EXTRA, fingerprint)
+            self.ctx.running[str(index)] = workchain.pk
+
+        # Only the reference to the awaited work chain is kept in the context, to keep the checkpoints small.
+        if self.ctx.running:
+            oldest = min(self.ctx.running, key=int)
+            return engine.ToContext(awaited=orm.load_node(self.ctx.running[oldest]))
+        return None
+
+    def inspect_calculations(self):
+        """Keep the output parameters of the calculations that finished, to free their place in the window."""
+        self.ctx.pop("awaited", None)
+        for index, pk in list(self.ctx.running.items()):
+            workchain = orm.load_node(pk)
+            if not workchain.is_terminated:
+                continue
+            del self.ctx.running[index]
+            self.ctx.finished += 1
+            if workchain.is_finished_ok:
+                self.ctx.parameters[int(index)] = workchain.outputs.output_parameters.pk
+            else:
+                self.report(
+                    f"The calculation of {self.ctx.labels[int(index)]} failed (work chain {workchain.pk})."
+                )
+        self.report(
+            f"{self.ctx.finished} calculations finished and {len(self.ctx.running)} are running, out of "
+            f"{len(self.ctx.structures)} structures."
+        )
+
+    def results(self):
+        for index, original in self.ctx.duplicates.items():
+            self.ctx.parameters[int(index)] = self.ctx.parameters[original]
+        parameters = {
+            f"index_{index}": orm.load_node(pk)
+            for index, pk in enumerate(self.ctx.parameters)
+            if pk is not None
+        }
+        self.out("energies", collect_energies(orm.List(self.ctx.labels), **parameters))
+        if not parameters:
+            return self.exit_codes.ERROR_ALL_SUB_PROCESSES_FAILED
+        return None
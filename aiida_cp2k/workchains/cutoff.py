@@ -0,0 +1,290 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Work chain to converge the multigrid cutoffs of CP2K."""
+
+from aiida import common, engine, orm
+
+from .. import utils
+from ..calculations import Cp2kCalculation
+from ..utils.workchains import validate_max_concurrent
+from .base import Cp2kBaseWorkChain
+
+# The number of Gaussians per grid is only read by the advanced parser.
+PARSER_NAME = "cp2k_advanced_parser"
+
+# Number of larger values a value must agree with to be converged, so that a noisy scan does not stop at a
+# false plateau of two values.
+CONVERGENCE_AGREEMENTS = 2
+
+
+def _grid_change(first, second):
+    """Return the largest change of the fraction of Gaussians on a grid between two calculations."""
+    if len(first["grid_counts"]) != len(second["grid_counts"]):
+        return 1.0
+    first_total = sum(first["grid_counts"])
+    second_total = sum(second["grid_counts"])
+    return max(
+        abs(a / first_total - b / second_total)
+        for a, b in zip(first["grid_counts"], second["grid_counts"])
+    )
+
+
+def find_converged_value(
+    results, energy_tolerance, grid_tolerance, agreements=CONVERGENCE_AGREEMENTS
+):
+    """Return the smallest value whose energy and grid distribution agree with those of the next `agreements` ones.
+
+    :param results: list of dictionaries with the `value`, `energy` and `grid_counts` of the calculations,
+        sorted by increasing value.
+    :returns: the converged value or None.
+    """
+    for index, first in enumerate(results[: len(results) - agreements]):
+        if all(
+            abs(first["energy"] - second["energy"]) < energy_tolerance
+            and _grid_change(first, second) < grid_tolerance
+            for second in results[index + 1 : index + 1 + agreements]
+        ):
+            return first["value"]
+    return None
+
+
+def validate_parser_name(inputs, _):
+    """Validate that the calculations are not given a parser other than the advanced one."""
+    parser_name = (
+        inputs.get("base", {})
+        .get("cp2k", {})
+        .get("metadata", {})
+        .get("options", {})
+        .get("parser_name")
+    )
+    if parser_name not in (None, Cp2kCalculation._DEFAULT_PARSER, PARSER_NAME):
+        return (
+            f"The calculations of the scan are parsed by `{PARSER_NAME}` to read the number of Gaussians per "
+            f"grid, `{parser_name}` can not be used."
+        )
+    return None
+
+
+@engine.calcfunction
+def get_converged_cutoffs(scan, energy_tolerance, grid_tolerance):
+    """Return the converged CUTOFF and REL_CUTOFF of a scan as a Dict to merge into the MGRID section."""
+    scan = scan.get_dict()
+    return orm.Dict(
+        {
+            phase: find_converged_value(
+                scan[phase], energy_tolerance.value, grid_tolerance.value
+            )
+            for phase in ("CUTOFF", "REL_CUTOFF")
+        }
+    )
+
+
+class Cp2kCutoffConvergenceWorkChain(engine.WorkChain):
+    """Work chain to find the cheapest converged CUTOFF and REL_CUTOFF of the multigrids.
+
+    The CUTOFF is converged first, then the REL_CUTOFF with the converged CUTOFF. The energy calculations are
+    run in batches of `max_concurrent` values in increasing order, and the scan stops as soon as the energy
+    and the distribution of the Gaussians on the grids of a value agree with those of the next two values
+    within the tolerances.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.expose_inputs(Cp2kBaseWorkChain, namespace="base")
+        spec.input(
+            "cutoffs",
+            valid_type=orm.List,
+            default=lambda: orm.List(list(range(200, 1001, 100))),
+            help="CUTOFF values to scan [Ry].",
+        )
+        spec.input(
+            "rel_cutoffs",
+            valid_type=orm.List,
+            default=lambda: orm.List(list(range(30, 81, 10))),
+            help="REL_CUTOFF values to scan [Ry].",
+        )
+        spec.input(
+            "energy_tolerance",
+            valid_type=orm.Float,
+            default=lambda: orm.Float(1.0e-4),
+            help="Tolerance on the total energy [Hartree].",
+        )
+        spec.input(
+            "grid_tolerance",
+            valid_type=orm.Float,
+            default=lambda: orm.Float(0.01),
+            help="Tolerance on the fraction of Gaussians mapped on each grid.",
+        )
+        spec.input(
+            "max_concurrent",
+            valid_type=orm.Int,
+            default=lambda: orm.Int(4),
+            validator=validate_max_concurrent,
+            help="Number of calculations run at the same time.",
+        )
+        spec.inputs.validator = validate_parser_name
+
+        spec.outline(
+            cls.setup,
+            engine.while_(cls.should_run_batch)(
+                cls.run_batch,
+                cls.inspect_batch,
+            ),
+            cls.results,
+        )
+
+        spec.output(
+            "cutoffs",
+            valid_type=orm.Dict,
+            help="The converged CUTOFF and REL_CUTOFF.",
+        )
+        spec.output(
+            "scan",
+            valid_type=orm.Dict,
+            help="Energy and number of Gaussians per grid of the scanned values.",
+        )
+        spec.exit_code(
+            401,
+            "ERROR_SUB_PROCESS_FAILED",
+            message="A calculation of the scan failed.",
+        )
+        spec.exit_code(
+            402,
+            "ERROR_NOT_CONVERGED",
+            message="The {phase} did not converge within the scanned values.",
+        )
+        spec.exit_code(
+            403,
+            "ERROR_MISSING_GRID_COUNTS",
+            message="The number of Gaussians per grid was not parsed for the {phase} calculation {pk}.",
+        )
+
+    def setup(self):
+        """Prepare the inputs of the energy calculations, to be parsed by the advanced parser."""
+        self.ctx.inputs = common.AttributeDict(
+            self.exposed_inputs(Cp2kBaseWorkChain, "base")
+        )
+        self.ctx.inputs.cp2k = common.AttributeDict(self.ctx.inputs.cp2k)
+
+        settings = (
+            self.ctx.inputs.cp2k.settings.get_dict()
+            if "settings" in self.ctx.inputs.cp2k
+            else {}
+        )
+        # The number of Gaussians per grid is added to the fields requested for the calculations.
+        fields = list(settings.get("parser_fields") or [])
+        if "grid_counts" not in fields:
+            fields.append("grid_counts")
+        settings["parser_fields"] = fields
+        self.ctx.inputs.cp2k.settings = orm.Dict(settings)
+
+        metadata = dict(self.ctx.inputs.cp2k.get("metadata", {}))
+        metadata["options"] = {
+            **metadata.get("options", {}),
+            "parser_name": PARSER_NAME,
+        }
+        self.ctx.inputs.cp2k.metadata = metadata
+
+        self.ctx.scan = {"CUTOFF": [], "REL_CUTOFF": []}
+        self.ctx.cutoff = None
+        self._start_phase("CUTOFF", self.inputs.cutoffs.get_list())
+
+    def _start_phase(self, phase, values):
+        self.ctx.phase = phase
+        self.ctx.scan_values = sorted(values)
+        self.ctx.index = 0
+
+    def should_run_batch(self):
+        return self.ctx.phase is not None
+
+    def run_batch(self):
+        """Submit the calculations of the next `max_concurrent` values."""
+        phase = self.ctx.phase
+        batch = self.ctx.scan_values[
+            self.ctx.index : self.ctx.index + self.inputs.max_concurrent.value
+        ]
+        for index, value in enumerate(batch, start=self.ctx.index):
+            cutoffs = {phase: value}
+            if phase == "REL_CUTOFF":
+                cutoffs["CUTOFF"] = self.ctx.cutoff
+
+            inputs = common.AttributeDict(self.ctx.inputs)
+            inputs.cp2k = common.AttributeDict(self.ctx.inputs.cp2k)
+            inputs.cp2k.parameters = utils.set_grid_cutoffs(
+                self.ctx.inputs.cp2k.parameters, orm.Dict(cutoffs)
+            )
+            inputs.metadata = {
+                **inputs.get("metadata", {}),
+                "call_link_label": f"{phase.lower()}_{index}",
+            }
+            self.to_context(
+                **{f"{phase}_{index}": self.submit(Cp2kBaseWorkChain, **inputs)}
+            )
+        self.report(f"Submitted the {phase} calculations for {batch}.")
+
+    def inspect_batch(self):
+        """Collect the results of the batch and stop the scan of the current phase once converged."""
+        phase = self.ctx.phase
+        batch_size = min(
+            self.inputs.max_concurrent.value, len(self.ctx.scan_values) - self.ctx.index
+        )
+        for index in range(self.ctx.index, self.ctx.index + batch_size):
+            workchain = self.ctx[f"{phase}_{index}"]
+            if not workchain.is_finished_ok:
+                self.report(f"The {phase} calculation {workchain.pk} failed.")
+                self._out_scan()
+                return self.exit_codes.ERROR_SUB_PROCESS_FAILED
+            output = workchain.outputs.output_parameters
+            # Without the grids, a scan could converge on the energy alone.
+            if not output.get("grid_counts"):
+                self._out_scan()
+                return self.exit_codes.ERROR_MISSING_GRID_COUNTS.format(
+                    phase=phase, pk=workchain.pk
+                )
+            self.ctx.scan[phase].append(
+                {
+                    "value": self.ctx.scan_values[index],
+                    "energy": output["energy"],
+                    "grid_counts": output["grid_counts"],
+                }
+            )
+        self.ctx.index += batch_size
+
+        converged = find_converged_value(
+            self.ctx.scan[phase],
+            self.inputs.energy_tolerance.value,
+            self.inputs.grid_tolerance.value,
+        )
+        if converged is None:
+            if self.ctx.index >= len(self.ctx.scan_values):
+                self._out_scan()
+                return self.exit_codes.ERROR_NOT_CONVERGED.format(phase=phase)
+            return None
+
+        self.report(f"{phase} converged at {converged}.")
+        if phase == "CUTOFF":
+            self.ctx.cutoff = converged
+            self._start_phase("REL_CUTOFF", self.inputs.rel_cutoffs.get_list())
+        else:
+            self.ctx.phase = None
+        return None
+
+    def _out_scan(self):
+        """Output the values scanned so far, also when the scan stops without converging."""
+        scan = orm.Dict(self.ctx.scan).store()
+        self.out("scan", scan)
+        return scan
+
+    def results(self):
+        scan = self._out_scan()
+        self.out(
+            "cutoffs",
+            get_converged_cutoffs(
+                scan, self.inputs.energy_tolerance, self.inputs.grid_tolerance
+            ),
+        )
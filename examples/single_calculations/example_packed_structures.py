@@ -0,0 +1,138 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Run DFT calculations of several structures packed in the same job."""
+
+import os
+import sys
+
+import ase.io
+import click
+from aiida.common import NotExistent
+from aiida.engine import run_get_node
+from aiida.orm import Dict, SinglefileData, load_code
+from aiida.plugins import DataFactory
+
+StructureData = DataFactory("core.structure")
+
+
+def example_packed_structures(cp2k_code):
+    """Run DFT calculations of H2O with stretched bonds in the same job."""
+
+    print("Testing CP2K ENERGY on packed H2O structures (DFT)...")
+
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+
+    # Structures.
+    atoms = ase.io.read(os.path.join(thisdir, "..", "files", "h2o.xyz"))
+    structures = {}
+    for index, scale in enumerate((0.95, 1.0, 1.05)):
+        stretched = atoms.copy()
+        stretched.positions = atoms.positions[0] + scale * (
+            atoms.positions - atoms.positions[0]
+        )
+        structures[f"h2o_{index}"] = StructureData(ase=stretched)
+
+    # Basis set.
+    basis_file = SinglefileData(
+        file=os.path.join(thisdir, "..", "files", "BASIS_MOLOPT")
+    )
+
+    # Pseudopotentials.
+    pseudo_file = SinglefileData(
+        file=os.path.join(thisdir, "..", "files", "GTH_POTENTIALS")
+    )
+
+    # Parameters.
+    parameters = Dict(
+        {
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "BASIS_SET_FILE_NAME": "BASIS_MOLOPT",
+                    "POTENTIAL_FILE_NAME": "GTH_POTENTIALS",
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-12,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {
+                        "NGRIDS": 4,
+                        "CUTOFF": 280,
+                        "REL_CUTOFF": 30,
+                    },
+                    "XC": {
+                        "XC_FUNCTIONAL": {
+                            "_": "LDA",
+                        },
+                    },
+                    "POISSON": {
+                        "PERIODIC": "none",
+                        "PSOLVER": "MT",
+                    },
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q6",
+                        },
+                        {
+                            "_": "H",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q1",
+                        },
+                    ],
+                },
+            }
+        }
+    )
+
+    # Construct process builder.
+    builder = cp2k_code.get_builder()
+    builder.structures = structures
+    builder.parameters = parameters
+    builder.code = cp2k_code
+    builder.file = {
+        "basis": basis_file,
+        "pseudo": pseudo_file,
+    }
+    builder.metadata.options.resources = {
+        "num_machines": 1,
+        "num_mpiprocs_per_machine": 1,
+    }
+    builder.metadata.options.max_wallclock_seconds = 1 * 3 * 60
+
+    print("Submitted calculation...")
+    outputs, calc = run_get_node(builder)
+
+    if not calc.is_finished_ok:
+        print(f"ERROR! Calculation failed with exit status {calc.exit_status}.")
+        sys.exit(3)
+
+    for key, summary in outputs["output_parameters"]["structures"].items():
+        energy = outputs["structures"][key]["output_parameters"]["energy"]
+        if summary["energy"] != energy:
+            print(f"ERROR! The energy of {key} is not split correctly.")
+            sys.exit(3)
+        print(f"{key}: {energy}")
+
+
+@click.command("cli")
+@click.argument("codelabel")
+def cli(codelabel):
+    """Click interface."""
+    try:
+        code = load_code(codelabel)
+    except NotExistent:
+        print(f"The code '{codelabel}' does not exist.")
+        sys.exit(1)
+    example_packed_structures(code)
+
+
+if __name__ == "__main__":
+    cli()
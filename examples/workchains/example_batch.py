@@ -0,0 +1,146 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""An example computing the energies of H2O with different bond lengths."""
+
+import os
+import sys
+
+import ase.io
+import click
+from aiida.common import NotExistent
+from aiida.engine import run_get_node
+from aiida.orm import Bool, Dict, Int, SinglefileData, load_code
+from aiida.plugins import DataFactory, WorkflowFactory
+
+Cp2kBatchWorkChain = WorkflowFactory("cp2k.batch")
+StructureData = DataFactory("core.structure")
+
+
+def example_batch(cp2k_code):
+    """Compute the energies of H2O with stretched bonds."""
+
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+
+    print("Testing the batch of H2O structures (DFT)...")
+
+    # Basis set.
+    basis_file = SinglefileData(
+        file=os.path.join(thisdir, "..", "files", "BASIS_MOLOPT")
+    )
+
+    # Pseudopotentials.
+    pseudo_file = SinglefileData(
+        file=os.path.join(thisdir, "..", "files", "GTH_POTENTIALS")
+    )
+
+    # Structures.
+    atoms = ase.io.read(os.path.join(thisdir, "..", "files", "h2o.xyz"))
+    structures = {}
+    for index, scale in enumerate((0.95, 1.0, 1.05, 1.1)):
+        stretched = atoms.copy()
+        stretched.positions = atoms.positions[0] + scale * (
+            atoms.positions - atoms.positions[0]
+        )
+        structures[f"h2o_{index}"] = StructureData(ase=stretched)
+
+    # Parameters.
+    parameters = Dict(
+        {
+            "GLOBAL": {
+                "RUN_TYPE": "ENERGY",
+            },
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "BASIS_SET_FILE_NAME": "BASIS_MOLOPT",
+                    "POTENTIAL_FILE_NAME": "GTH_POTENTIALS",
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-16,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {
+                        "NGRIDS": 4,
+                        "CUTOFF": 280,
+                        "REL_CUTOFF": 30,
+                    },
+                    "XC": {
+                        "XC_FUNCTIONAL": {
+                            "_": "LDA",
+                        },
+                    },
+                    "POISSON": {
+                        "PERIODIC": "none",
+                        "PSOLVER": "MT",
+                    },
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q6",
+                        },
+                        {
+                            "_": "H",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q1",
+                        },
+                    ],
+                },
+            },
+        }
+    )
+
+    # Construct process builder.
+    builder = Cp2kBatchWorkChain.get_builder()
+    builder.structures = structures
+    builder.max_concurrent = Int(2)
+    builder.skip_duplicates = Bool(True)
+
+    builder.base.cp2k.parameters = parameters
+    builder.base.cp2k.code = cp2k_code
+    builder.base.cp2k.file = {
+        "basis": basis_file,
+        "pseudo": pseudo_file,
+    }
+    builder.base.cp2k.metadata.options = {
+        "resources": {
+            "num_machines": 1,
+            "num_mpiprocs_per_machine": 1,
+        },
+        "max_wallclock_seconds": 1 * 3 * 60,
+    }
+
+    print("Submitted calculation...")
+    _, process_node = run_get_node(builder)
+
+    if process_node.exit_status == 0:
+        energies = process_node.outputs.energies
+        for label, energy in zip(
+            energies.get_array("labels"), energies.get_array("energies")
+        ):
+            print(f"{label}: {energy}")
+    else:
+        print("ERROR! Work chain failed.")
+        sys.exit(3)
+
+
+@click.command("cli")
+@click.argument("codelabel")
+def cli(codelabel):
+    """Click interface."""
+    try:
+        code = load_code(codelabel)
+    except NotExistent:
+        print(f"The code '{codelabel}' does not exist")
+        sys.exit(1)
+    example_batch(code)
+
+
+if __name__ == "__main__":
+    cli()
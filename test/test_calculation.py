@@ -0,0 +1,176 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the preparation of the CP2K calculations."""
+import numpy as np
+import pytest
+from aiida import orm
+from aiida.common import InputValidationError
+from aiida.common.folders import Folder
+from aiida.engine.runners import Runner
+from aiida.engine.utils import instantiate_process
+from aiida.plugins import CalculationFactory
+
+PARAMETERS = {
+    "GLOBAL": {"RUN_TYPE": "ENERGY", "WALLTIME": "01:00:00"},
+    "FORCE_EVAL": {"METHOD": "Quickstep", "DFT": {"MGRID": {"CUTOFF": 300}}},
+}
+
+
+@pytest.fixture
+def prepare_calculation(aiida_localhost, tmp_path):
+    """Return a function running `prepare_for_submission` of a `Cp2kCalculation` with the given inputs.
+
+    It returns the `CalcInfo` and the folder with the input files.
+    """
+
+    def _prepare_calculation(**inputs):
+        code = orm.InstalledCode(
+            computer=aiida_localhost,
+            filepath_executable="/bin/true",
+            default_calc_job_plugin="cp2k",
+        )
+        inputs = {
+            "code": code,
+            "parameters": orm.Dict(PARAMETERS),
+            "metadata": {
+                "options": {
+                    "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 1}
+                }
+            },
+            **inputs,
+        }
+        process = instantiate_process(
+            Runner(poll_interval=0), CalculationFactory("cp2k"), **inputs
+        )
+        folder = Folder(str(tmp_path))
+        return process.prepare_for_submission(folder), folder
+
+    return _prepare_calculation
+
+
+@pytest.mark.parametrize(
+    "settings",
+    (
+        {"parser_fields": ["eigen", "unknown"]},
+        {"parser_tools_blocks": ["energies", "unknown"]},
+        {"parser_tools_blocks": ["energies"], "parser_tools_history": 0},
+    ),
+)
+def test_invalid_parser_settings(prepare_calculation, settings):
+    """Test that invalid settings for the parsers are rejected before the job is submitted."""
+    with pytest.raises(InputValidationError):
+        prepare_calculation(settings=orm.Dict(settings))
+
+
+def get_structures(keys):
+    """Return a hydrogen atom structure for each of the `keys`."""
+    structures = {}
+    for key in keys:
+        structure = orm.StructureData(cell=np.eye(3) * 5.0)
+        structure.append_atom(position=(0.0, 0.0, 0.0), symbols="H")
+        structures[key] = structure
+    return structures
+
+
+def test_packed_structures(prepare_calculation):
+    """Test that the packed structures get their own prefixed files and run one after the other."""
+    calcinfo, folder = prepare_calculation(structures=get_structures(["h1", "h2"]))
+
+    assert {
+        "h1_aiida.inp",
+        "h1_aiida.coords.xyz",
+        "h2_aiida.inp",
+        "h2_aiida.coords.xyz",
+    } <= set(folder.get_content_list())
+    assert [codeinfo.cmdline_params for codeinfo in calcinfo.codes_info] == [
+        ["-i", "h1_aiida.inp"],
+        ["-i", "h2_aiida.inp"],
+    ]
+    assert [codeinfo.stdout_name for codeinfo in calcinfo.codes_info] == [
+        "h1_aiida.out",
+        "h2_aiida.out",
+    ]
+    assert calcinfo.retrieve_list == [
+        f"{key}_aiida{suffix}"
+        for key in ("h1", "h2")
+        for suffix in (
+            ".out",
+            "-1.restart",
+            "-pos-1.dcd",
+            "-pos-1.xyz",
+            "-frc-1.xyz",
+            "-1.cell",
+        )
+    ]
+
+    with folder.open("h1_aiida.inp") as handle:
+        content = handle.read()
+    assert "PROJECT h1_aiida" in content
+    assert "COORD_FILE_NAME h1_aiida.coords.xyz" in content
+    # The jobs share the wall time of the whole calculation.
+    assert "WALLTIME 1800" in content
+
+
+def test_packed_structures_invalid(prepare_calculation):
+    """Test that the `structure` and `structures` inputs can not be given together."""
+    structures = get_structures(["h1", "h2"])
+    with pytest.raises(InputValidationError):
+        prepare_calculation(structure=structures.pop("h1"), structures=structures)
+
+
+def test_farming(prepare_calculation):
+    """Test the FARMING input running the packed structures, with their own parameters."""
+    calcinfo, folder = prepare_calculation(
+        structures=get_structures(["h1", "h2", "h3"]),
+        structure_parameters={
+            "h2": orm.Dict({"FORCE_EVAL": {"DFT": {"CHARGE": 1, "MULTIPLICITY": 1}}})
+        },
+        settings=orm.Dict({"farming_groups": 2}),
+    )
+
+    assert len(calcinfo.codes_info) == 1
+    assert calcinfo.codes_info[0].cmdline_params == ["-i", "aiida.inp"]
+    assert calcinfo.codes_info[0].stdout_name == "aiida.out"
+    assert calcinfo.retrieve_list[-1] == "aiida.out"
+
+    with folder.open("aiida.inp") as handle:
+        farming = handle.read()
+    assert "RUN_TYPE FARMING" in farming
+    assert "NGROUPS 2" in farming
+    assert "WALLTIME 01:00:00" in farming
+    for job_id, key in enumerate(("h1", "h2", "h3"), start=1):
+        assert f"INPUT_FILE_NAME {key}_aiida.inp" in farming
+        assert f"OUTPUT_FILE_NAME {key}_aiida.out" in farming
+        assert f"JOB_ID {job_id}" in farming
+
+    inputs = {}
+    for key in ("h1", "h2", "h3"):
+        with folder.open(f"{key}_aiida.inp") as handle:
+            inputs[key] = handle.read()
+        # Two of the jobs run one after the other in the same group.
+        assert "WALLTIME 1800" in inputs[key]
+        assert "CUTOFF 300" in inputs[key]
+    assert "CHARGE 1" in inputs["h2"]
+    assert "CHARGE" not in inputs["h1"]
+
+
+@pytest.mark.parametrize("farming_groups", (0, 3, "2", True))
+def test_invalid_farming_groups(prepare_calculation, farming_groups):
+    """Test that the number of FARMING groups is a positive integer not larger than the number of structures."""
+    with pytest.raises(InputValidationError):
+        prepare_calculation(
+            structures=get_structures(["h1", "h2"]),
+            settings=orm.Dict({"farming_groups": farming_groups}),
+        )
+
+
+def test_structure_parameters_without_structures(prepare_calculation):
+    """Test that the parameters of packed structures require the packed structures."""
+    with pytest.raises(InputValidationError):
+        prepare_calculation(
+            structure_parameters={"h1": orm.Dict({"GLOBAL": {"PRINT_LEVEL": "LOW"}})}
+        )
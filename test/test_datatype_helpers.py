@@ -3,6 +3,7 @@ import pytest
 from aiida import orm
 
 from aiida_cp2k.utils import (
+    merge_motion_step_info,
     merge_trajectory_data_non_unique,
     merge_trajectory_data_unique,
 )
@@ -58,3 +59,74 @@ def test_merge_trajectory_data(step_ranges):
     assert (
         len(merged_trajectory_unique.get_stepids()) == total_lenght_unique
     ), "The merged trajectory with unique stepids has the wrong length."
+
+
+def test_merge_motion_step_info():
+    """Test that the steps repeated by a restart are replaced, and that runs starting over are appended."""
+    first = orm.Dict(
+        {
+            "motion_step_info": {
+                "step": [0, 1, 2],
+                "energy_au": [-1.0, -1.1, -1.2],
+                "scf_converged": [True, True, False],
+            }
+        }
+    )
+    second = orm.ArrayData()
+    second.set_array("step", np.array([2, 3], np.int32))
+    second.set_array("energy_au", np.array([-1.25, -1.3]))
+    second.set_array("scf_converged", np.array([True, True]))
+    second.set_array("eigen_spin1_au", np.array([0.1, 0.2]))
+
+    merged = merge_motion_step_info(first, second)
+    assert merged.get_array("step").tolist() == [0, 1, 2, 3]
+    assert merged.get_array("energy_au").tolist() == [-1.0, -1.1, -1.25, -1.3]
+    assert merged.get_array("scf_converged").tolist() == [True, True, True, True]
+    assert "eigen_spin1_au" not in merged.get_arraynames()
+
+    # A restart from scratch, then a continuation of it.
+    third = orm.Dict(
+        {
+            "motion_step_info": {
+                "step": [0, 1],
+                "energy_au": [-2.0, -2.1],
+                "scf_converged": [True, False],
+            }
+        }
+    )
+    fourth = orm.Dict(
+        {
+            "motion_step_info": {
+                "step": [1, 2],
+                "energy_au": [-2.15, -2.2],
+                "scf_converged": [True, True],
+            }
+        }
+    )
+    merged = merge_motion_step_info(first, second, third, fourth)
+    assert merged.get_array("step").tolist() == [0, 1, 2, 3, 0, 1, 2]
+    assert merged.get_array("energy_au").tolist() == [
+        -1.0,
+        -1.1,
+        -1.25,
+        -1.3,
+        -2.0,
+        -2.15,
+        -2.2,
+    ]
+
+    # ENERGY runs are all at step 0.
+    energy = orm.Dict(
+        {
+            "motion_step_info": {
+                "step": [0],
+                "energy_au": [-1.0],
+                "scf_converged": [True],
+            }
+        }
+    )
+    merged = merge_motion_step_info(energy, energy)
+    assert merged.get_array("step").tolist() == [0, 0]
+
+    with pytest.raises(ValueError):
+        merge_motion_step_info(first, orm.Dict({"motion_step_info": {"step": [3]}}))
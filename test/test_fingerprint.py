@@ -0,0 +1,323 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the fingerprints of the calculation inputs."""
+import numpy as np
+import pytest
+from aiida import orm
+from aiida.common.links import LinkType
+
+from aiida_cp2k.utils import (
+    FINGERPRINT_EXTRA,
+    SIMILARITY_DESCRIPTOR_EXTRA,
+    SIMILARITY_EXTRA,
+    find_similar_calculation,
+    get_inputs_fingerprint,
+    get_parameters_fingerprint,
+    get_positions_descriptor,
+    get_positions_rmsd,
+    get_similarity_fingerprint,
+    get_structure_fingerprint,
+    index_calculations,
+)
+
+PARAMETERS = {
+    "GLOBAL": {"RUN_TYPE": "ENERGY", "WALLTIME": 3600},
+    "FORCE_EVAL": {
+        "METHOD": "Quickstep",
+        "DFT": {"MGRID": {"CUTOFF": 400, "REL_CUTOFF": 50}},
+        "SUBSYS": {"KIND": [{"_": "O", "BASIS_SET": "DZVP-MOLOPT-SR-GTH"}]},
+    },
+}
+
+
+def get_structure(cell, positions, symbols):
+    structure = orm.StructureData(cell=cell)
+    for symbol, position in zip(symbols, positions):
+        structure.append_atom(position=position, symbols=symbol)
+    return structure
+
+
+def test_parameters_fingerprint():
+    """Test that the walltime and the case of the keywords do not change the fingerprint of the parameters."""
+    other = {
+        "global": {"run_type": "ENERGY", "walltime": 7200},
+        "force_eval": {
+            "Method": "Quickstep",
+            "DFT": {"MGRID": {"REL_CUTOFF": 50, "CUTOFF": 400}},
+            "SUBSYS": {"KIND": [{"_": "O", "BASIS_SET": "DZVP-MOLOPT-SR-GTH"}]},
+        },
+    }
+    assert get_parameters_fingerprint(other) == get_parameters_fingerprint(PARAMETERS)
+
+    other["force_eval"]["DFT"]["MGRID"]["CUTOFF"] = 500
+    assert get_parameters_fingerprint(other) != get_parameters_fingerprint(PARAMETERS)
+
+    # A section left empty by the ignored keywords does not count, unlike an empty section given explicitly.
+    other = {key: value for key, value in PARAMETERS.items() if key != "GLOBAL"}
+    other["GLOBAL"] = {"RUN_TYPE": "ENERGY"}
+    without_walltime = get_parameters_fingerprint(other)
+    other["GLOBAL"] = {"WALLTIME": 3600, "RUN_TYPE": "ENERGY"}
+    assert get_parameters_fingerprint(other) == without_walltime
+    other["EXT_RESTART"] = {}
+    assert get_parameters_fingerprint(other) != without_walltime
+
+
+def test_parameters_fingerprint_geometry():
+    """Test that the cell and the initial guess are left out of the fingerprint of the parameters on request."""
+    other = {
+        **PARAMETERS,
+        "FORCE_EVAL": {
+            **PARAMETERS["FORCE_EVAL"],
+            "DFT": {
+                "MGRID": {"CUTOFF": 400, "REL_CUTOFF": 50},
+                "RESTART_FILE_NAME": "./parent_calc/aiida-RESTART.wfn",
+                "SCF": {"SCF_GUESS": "RESTART"},
+            },
+            "SUBSYS": {
+                **PARAMETERS["FORCE_EVAL"]["SUBSYS"],
+                "CELL": {"ABC": "5.0 5.0 5.0"},
+            },
+        },
+    }
+    assert get_parameters_fingerprint(other) != get_parameters_fingerprint(PARAMETERS)
+    assert get_parameters_fingerprint(
+        other, geometry=False
+    ) == get_parameters_fingerprint(PARAMETERS, geometry=False)
+
+    other["FORCE_EVAL"]["DFT"]["CHARGE"] = 1
+    assert get_parameters_fingerprint(
+        other, geometry=False
+    ) != get_parameters_fingerprint(PARAMETERS, geometry=False)
+
+
+def test_structure_fingerprint():
+    """Test that the order of the atoms, the origin and the orientation of the cell do not change the fingerprint."""
+    cell = np.array([[6.0, 0.0, 0.0], [1.0, 7.0, 0.0], [0.0, 0.0, 8.0]])
+    fractional = np.array(
+        [[0.1, 0.2, 0.3], [0.15, 0.25, 0.3], [0.05, 0.2, 0.35], [0.6, 0.7, 0.8]]
+    )
+    symbols = ["O", "H", "H", "O"]
+    reference = get_structure_fingerprint(
+        get_structure(cell, fractional @ cell, symbols)
+    )
+
+    # Permuted atoms, translated across the cell boundaries.
+    order = [3, 1, 0, 2]
+    shifted = (fractional[order] + [0.5, 0.9, 0.25]) % 1.0
+    assert (
+        get_structure_fingerprint(
+            get_structure(cell, shifted @ cell, [symbols[i] for i in order])
+        )
+        == reference
+    )
+
+    # Rotated cell.
+    rotation = np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+    rotated = cell @ rotation.T
+    assert (
+        get_structure_fingerprint(get_structure(rotated, fractional @ rotated, symbols))
+        == reference
+    )
+
+    # Displaced atom.
+    displaced = fractional + [[0, 0, 0], [0, 0, 0], [0, 0, 0], [0.01, 0, 0]]
+    assert (
+        get_structure_fingerprint(get_structure(cell, displaced @ cell, symbols))
+        != reference
+    )
+
+
+def test_similarity_fingerprint():
+    """Test that only the kinds of the sites, in order, change the similarity fingerprint of the structure."""
+    cell = np.eye(3) * 5.0
+    positions = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    parameters = orm.Dict(PARAMETERS)
+    reference = get_similarity_fingerprint(
+        {
+            "structure": get_structure(cell, positions, ["O", "H", "H"]),
+            "parameters": parameters,
+        }
+    )
+
+    # Strained cell and displaced atoms.
+    assert (
+        get_similarity_fingerprint(
+            {
+                "structure": get_structure(
+                    cell * 1.02, positions + 0.1, ["O", "H", "H"]
+                ),
+                "parameters": parameters,
+            }
+        )
+        == reference
+    )
+
+    # Permuted atoms: the wave function refers to the atoms in their order.
+    assert (
+        get_similarity_fingerprint(
+            {
+                "structure": get_structure(cell, positions[[1, 0, 2]], ["H", "O", "H"]),
+                "parameters": parameters,
+            }
+        )
+        != reference
+    )
+
+    # Other kinds.
+    assert (
+        get_similarity_fingerprint(
+            {
+                "structure": get_structure(cell, positions, ["O", "H", "O"]),
+                "parameters": parameters,
+            }
+        )
+        != reference
+    )
+
+
+def test_index_calculations(aiida_localhost):
+    """Test that the finished calculations are indexed in batches, and only once."""
+    calculations = []
+    for shift in (0.0, 0.1, 0.2):
+        inputs = {
+            "structure": get_structure(
+                np.eye(3) * 5.0, [[shift, 0.0, 0.0], [1.0, 0.0, 0.0]], ["H", "H"]
+            ),
+            "parameters": orm.Dict(PARAMETERS),
+        }
+        node = orm.CalcJobNode(
+            computer=aiida_localhost, process_type="aiida.calculations:cp2k"
+        )
+        node.set_option("resources", {"num_machines": 1})
+        for label, input_node in inputs.items():
+            node.base.links.add_incoming(
+                input_node.store(), link_type=LinkType.INPUT_CALC, link_label=label
+            )
+        node.set_exit_status(0)
+        node.store()
+        calculations.append((node, inputs))
+
+    filters = {"id": {"in": [node.pk for node, _ in calculations]}}
+    assert index_calculations(filters, batch_size=2) == 3
+    assert index_calculations(filters, batch_size=2) == 0
+    for node, inputs in calculations:
+        assert node.base.extras.get(FINGERPRINT_EXTRA) == get_inputs_fingerprint(inputs)
+        assert node.base.extras.get(SIMILARITY_EXTRA) == get_similarity_fingerprint(
+            inputs
+        )
+        assert node.base.extras.get(SIMILARITY_DESCRIPTOR_EXTRA) == pytest.approx(
+            get_positions_descriptor(inputs["structure"])
+        )
+
+
+def test_positions_descriptor():
+    """Test that the distance between the positions descriptors is a lower bound of the RMSD."""
+    rng = np.random.default_rng(0)
+    cell = np.array([[5.0, 0.0, 0.0], [1.0, 6.0, 0.0], [0.0, 0.5, 4.0]])
+    smallest = np.linalg.svd(cell, compute_uv=False).min()
+    positions = rng.random((8, 3)) @ cell
+    reference = get_positions_descriptor(get_structure(cell, positions, ["H"] * 8))
+    for scale in (0.01, 0.1, 1.0):
+        moved = positions + rng.normal(scale=scale, size=positions.shape)
+        descriptor = get_positions_descriptor(get_structure(cell, moved, ["H"] * 8))
+        distance = np.sqrt(sum((descriptor[k] - reference[k]) ** 2 for k in reference))
+        assert distance <= 2 * np.pi * get_positions_rmsd(cell, positions, moved) / (
+            smallest
+        )
+
+    # Periodic images have the same descriptor.
+    shifted = get_positions_descriptor(
+        get_structure(cell, positions + cell[0] - cell[2], ["H"] * 8)
+    )
+    assert shifted == pytest.approx(reference)
+
+
+def test_find_similar_calculation(aiida_localhost):
+    """Test that the calculations on the same atoms, in the same order, are found by their RMSD."""
+    code = orm.InstalledCode(
+        computer=aiida_localhost, filepath_executable="/bin/true"
+    ).store()
+    parameters = orm.Dict(PARAMETERS).store()
+    cell = np.eye(3) * 5.0
+    positions = np.array([[0.0, 0.0, 0.0], [4.9, 0.0, 0.0], [0.0, 1.0, 0.0]])
+
+    def get_inputs(positions, symbols=("O", "H", "H")):
+        return {
+            "code": code,
+            "parameters": parameters,
+            "structure": get_structure(cell, positions, symbols),
+        }
+
+    inputs = get_inputs(positions)
+    node = orm.CalcJobNode(
+        computer=aiida_localhost, process_type="aiida.calculations:cp2k"
+    )
+    node.set_option("resources", {"num_machines": 1})
+    for label, input_node in inputs.items():
+        node.base.links.add_incoming(
+            input_node.store(), link_type=LinkType.INPUT_CALC, link_label=label
+        )
+    node.set_exit_status(0)
+    node.store()
+    remote = orm.RemoteData(computer=aiida_localhost, remote_path="/tmp")
+    remote.base.links.add_incoming(
+        node, link_type=LinkType.CREATE, link_label="remote_folder"
+    )
+    remote.store()
+    node.base.extras.set_many(
+        {
+            SIMILARITY_EXTRA: get_similarity_fingerprint(inputs),
+            SIMILARITY_DESCRIPTOR_EXTRA: get_positions_descriptor(inputs["structure"]),
+        }
+    )
+
+    # Across the cell boundary.
+    moved = positions + [[0.0, 0.0, 0.0], [0.2, 0.0, 0.0], [0.0, 0.0, 0.0]]
+    similar = find_similar_calculation(get_inputs(moved), 0.5)
+    assert similar[0].pk == node.pk
+    assert similar[1] == pytest.approx(np.sqrt(0.04 / 3))
+
+    assert find_similar_calculation(get_inputs(moved), 0.1) is None
+    assert find_similar_calculation(get_inputs(positions + 1.0), 0.5) is None
+
+    # The same positions with the atoms in another order, also of the same kind.
+    assert (
+        find_similar_calculation(get_inputs(positions[[1, 0, 2]], ("H", "O", "H")), 0.5)
+        is None
+    )
+    assert find_similar_calculation(get_inputs(positions[[0, 2, 1]]), 0.5) is None
+
+
+def test_inputs_fingerprint_parent_calc_folder(aiida_localhost):
+    """Test that the continuations of different calculations have different fingerprints."""
+    remote_folders = []
+    for _ in range(2):
+        node = orm.CalcJobNode(
+            computer=aiida_localhost, process_type="aiida.calculations:cp2k"
+        )
+        node.set_option("resources", {"num_machines": 1})
+        node.store()
+        remote_folder = orm.RemoteData(computer=aiida_localhost, remote_path="/tmp")
+        remote_folder.base.links.add_incoming(
+            node, link_type=LinkType.CREATE, link_label="remote_folder"
+        )
+        remote_folders.append(remote_folder.store())
+
+    inputs = {
+        "structure": get_structure(np.eye(3) * 5.0, [[0.0, 0.0, 0.0]], ["H"]),
+        "parameters": orm.Dict(PARAMETERS),
+    }
+    first = {**inputs, "parent_calc_folder": remote_folders[0]}
+    second = {**inputs, "parent_calc_folder": remote_folders[1]}
+
+    assert get_inputs_fingerprint(first) != get_inputs_fingerprint(second)
+    assert get_inputs_fingerprint(first) != get_inputs_fingerprint(inputs)
+    assert get_inputs_fingerprint(first) == get_inputs_fingerprint(
+        {**inputs, "parent_calc_folder": remote_folders[0]}
+    )
+    # The parent folder is only the initial guess of similar calculations.
+    assert get_similarity_fingerprint(first) == get_similarity_fingerprint(second)
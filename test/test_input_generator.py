@@ -6,9 +6,18 @@
 ###############################################################################
 """Test Cp2k input generator"""
 
+import numpy as np
 import pytest
+from aiida import orm
 
-from aiida_cp2k.utils import Cp2kInput
+from aiida_cp2k.utils import (
+    Cp2kInput,
+    add_ignore_convergence_failure,
+    add_md_state_section,
+    add_walltime_section,
+    add_wfn_restart_section,
+    set_grid_cutoffs,
+)
 
 
 def test_render_empty():
@@ -223,3 +232,110 @@ def test_invalid_preprocessor():
     inp = Cp2kInput({"@SET": "bar"})
     with pytest.raises(ValueError):
         inp.render()
+
+
+def test_add_walltime_section():
+    """Test that the wall time is set and the restart file is written at every step and at the last one."""
+    params = orm.Dict({"GLOBAL": {"RUN_TYPE": "MD", "WALLTIME": 100}})
+    result = add_walltime_section(params, orm.Int(3300)).get_dict()
+    assert result["GLOBAL"]["WALLTIME"] == 3300
+    assert result["MOTION"]["PRINT"]["RESTART"]["ADD_LAST"] == "NUMERIC"
+    assert result["MOTION"]["PRINT"]["RESTART"]["EACH"] == {"MD": 1}
+
+    # The frequency given in the parameters is kept.
+    params = orm.Dict(
+        {
+            "GLOBAL": {"RUN_TYPE": "GEO_OPT"},
+            "MOTION": {"PRINT": {"RESTART": {"EACH": {"GEO_OPT": 10}}}},
+        }
+    )
+    result = add_walltime_section(params, orm.Int(3300)).get_dict()
+    assert result["MOTION"]["PRINT"]["RESTART"]["EACH"] == {"GEO_OPT": 10}
+
+    result = add_walltime_section(orm.Dict({}), orm.Int(3300)).get_dict()
+    assert result == {"GLOBAL": {"WALLTIME": 3300}}
+
+
+def test_dft_sections_of_multiple_force_evals():
+    """Test that the DFT sections of all the force evaluations are modified, and no other is created."""
+    params = orm.Dict(
+        {
+            "FORCE_EVAL": [
+                {"METHOD": "MIXED", "MIXED": {"MIXING_TYPE": "GENMIX"}},
+                {"METHOD": "Quickstep", "DFT": {"MGRID": {"CUTOFF": 300}}},
+                {"METHOD": "Quickstep", "DFT": {}},
+            ]
+        }
+    )
+    result = add_ignore_convergence_failure(params).get_dict()
+    assert "DFT" not in result["FORCE_EVAL"][0]
+    for force_eval in result["FORCE_EVAL"][1:]:
+        assert force_eval["DFT"]["SCF"]["IGNORE_CONVERGENCE_FAILURE"] == ".TRUE."
+
+    result = set_grid_cutoffs(params, orm.Dict({"CUTOFF": 400})).get_dict()
+    assert [
+        force_eval.get("DFT", {}).get("MGRID") for force_eval in result["FORCE_EVAL"]
+    ] == [None, {"CUTOFF": 400}, {"CUTOFF": 400}]
+
+    result = add_ignore_convergence_failure(orm.Dict({})).get_dict()
+    assert result == {
+        "FORCE_EVAL": {"DFT": {"SCF": {"IGNORE_CONVERGENCE_FAILURE": ".TRUE."}}}
+    }
+
+    result = add_wfn_restart_section(params, orm.Bool(False)).get_dict()
+    assert "DFT" not in result["FORCE_EVAL"][0]
+    for force_eval in result["FORCE_EVAL"][1:]:
+        assert (
+            force_eval["DFT"]["RESTART_FILE_NAME"] == "./parent_calc/aiida-RESTART.wfn"
+        )
+        assert force_eval["DFT"]["SCF"]["SCF_GUESS"] == "RESTART"
+
+    result = add_wfn_restart_section(orm.Dict({}), orm.Bool(True)).get_dict()
+    assert result == {
+        "FORCE_EVAL": {
+            "DFT": {
+                "RESTART_FILE_NAME": "./parent_calc/aiida-RESTART.kp",
+                "SCF": {"SCF_GUESS": "RESTART"},
+            }
+        }
+    }
+
+
+def test_add_md_state_section():
+    """Test that an MD run is continued from the stored state, without the files of the parent calculation."""
+    params = orm.Dict(
+        {
+            "EXT_RESTART": {"RESTART_FILE_NAME": "./parent_calc/aiida-1.restart"},
+            "FORCE_EVAL": {
+                "DFT": {
+                    "RESTART_FILE_NAME": "./parent_calc/aiida-RESTART.wfn",
+                    "SCF": {"SCF_GUESS": "RESTART", "EPS_SCF": 1e-6},
+                },
+            },
+            "MOTION": {"MD": {"ENSEMBLE": "NVT", "STEPS": 10}},
+        }
+    )
+    md_state = orm.ArrayData()
+    md_state.set_array("velocities", np.array([[0.1, 0.0, 0.0], [0.0, -0.1, 0.0]]))
+    md_state.set_array("step_start_val", np.array([10]))
+    md_state.set_array("time_start_val", np.array([5.0]))
+    md_state.set_array("nose_coord", np.array([0.5, 0.25]))
+
+    result = add_md_state_section(params, md_state).get_dict()
+    assert "EXT_RESTART" not in result
+    assert result["FORCE_EVAL"]["DFT"] == {"SCF": {"EPS_SCF": 1e-6}}
+    assert result["FORCE_EVAL"]["SUBSYS"]["VELOCITY"][" "] == [
+        "1.0000000000000001E-01 0.0000000000000000E+00 0.0000000000000000E+00",
+        "0.0000000000000000E+00 -1.0000000000000001E-01 0.0000000000000000E+00",
+    ]
+    md_section = result["MOTION"]["MD"]
+    assert md_section["STEP_START_VAL"] == 10
+    assert md_section["TIME_START_VAL"] == 5.0
+    assert md_section["THERMOSTAT"]["NOSE"]["COORD"][" "] == [
+        "5.0000000000000000E-01",
+        "2.5000000000000000E-01",
+    ]
+    assert "BAROSTAT" not in md_section
+
+    # The input is rendered with the velocities as lines of the VELOCITY section.
+    assert "&VELOCITY\n" in Cp2kInput(result).render()
@@ -0,0 +1,105 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the monitors of running CP2K calculations."""
+import re
+from pathlib import Path
+
+import pytest
+from aiida import orm
+
+from aiida_cp2k.calculations.monitors import (
+    MONITOR_STATE_EXTRA,
+    _initial_monitor_state,
+    _update_monitor_state,
+    monitor_output,
+)
+from aiida_cp2k.utils.parser import parse_cp2k_output_advanced
+
+OUTPUTS_DIR = Path(__file__).parent.resolve() / "outputs"
+
+
+def test_monitor_state_incremental():
+    """Test that feeding the output in pieces gives the same state as feeding it at once."""
+    lines = (OUTPUTS_DIR / "GEO_OPT_v9.1.out").read_text().splitlines()
+
+    state = _initial_monitor_state()
+    _update_monitor_state(state, lines)
+
+    state_pieces = _initial_monitor_state()
+    for start in range(0, len(lines), 100):
+        _update_monitor_state(state_pieces, lines[start : start + 100])
+
+    assert state == state_pieces
+    assert state["last_scf_convergence"] == 8.6e-07
+    assert state["unconverged_scf"] == 0
+    assert state["lowest_energy"] == -13.726193434870883
+    assert state["steps_without_lower_energy"] == 1
+
+    # The SCF tables are followed as by the parser.
+    scf_history = parse_cp2k_output_advanced("\n".join(lines))["scf_history"]
+    assert state["scf_outer_step"] == scf_history["outer_step"][-1]
+
+
+class FakeTransport:
+    """Transport running the `tail -c +<offset> <file> | head -n <lines>` command of the monitor on a given content."""
+
+    def __init__(self, content):
+        self.content = content
+        self.commands = []
+
+    def exec_command_wait_bytes(self, command):
+        self.commands.append(command)
+        match = re.fullmatch(r"tail -c \+(\d+) '(.+)' \| head -n (\d+)", command)
+        lines = self.content[int(match.group(1)) - 1 :].splitlines(keepends=True)
+        return 0, b"".join(lines[: int(match.group(3))]), b""
+
+
+def test_monitor_output(aiida_localhost):
+    """Test that the output is followed in pieces, with the offset counted in bytes of the file."""
+    content = (OUTPUTS_DIR / "GEO_OPT_v9.1.out").read_bytes()
+    # Non-ASCII characters, as in the names of the users or directories, and an invalid UTF-8 byte.
+    content = b" PROGRAM STARTED BY \xc3\xa9l\xc3\xa8ve \xff\n" + content
+
+    node = orm.CalcJobNode(
+        computer=aiida_localhost, process_type="aiida.calculations:cp2k"
+    )
+    node.set_option("resources", {"num_machines": 1})
+    node.set_option("output_filename", "aiida.out")
+    node.store()
+    node.set_remote_workdir("/scratch/run")
+
+    # The output is being written: the last line is not complete yet.
+    transport = FakeTransport(content[:-10])
+    assert monitor_output(node, transport, max_lines_per_poll=100) is None
+    assert transport.commands == ["tail -c +1 '/scratch/run/aiida.out' | head -n 100"]
+    offset = len(b"".join(content.splitlines(keepends=True)[:100]))
+    assert node.base.extras.get(MONITOR_STATE_EXTRA)["offset"] == offset
+
+    # The following polls read 100 lines each, up to the incomplete last line.
+    for _ in range(content.count(b"\n") // 100 + 1):
+        monitor_output(node, transport, max_lines_per_poll=100)
+    offset = content[:-10].rfind(b"\n") + 1
+    assert node.base.extras.get(MONITOR_STATE_EXTRA)["offset"] == offset
+
+    transport.content = content
+    monitor_output(node, transport, max_lines_per_poll=100)
+    assert transport.commands[-1].startswith(f"tail -c +{offset + 1} ")
+
+    state = node.base.extras.get(MONITOR_STATE_EXTRA)
+    assert state["offset"] == len(content)
+    expected = _initial_monitor_state()
+    _update_monitor_state(expected, content.decode(errors="replace").splitlines())
+    expected["offset"] = len(content)
+    # The energy is rounded when stored in the extra.
+    assert state.pop("lowest_energy") == pytest.approx(expected.pop("lowest_energy"))
+    assert state == expected
+
+    # The calculation is killed once the energy stopped decreasing.
+    assert (
+        monitor_output(node, transport, max_steps_without_lower_energy=1)
+        == "The energy did not decrease below -13.726193434871 a.u. for 1 steps."
+    )
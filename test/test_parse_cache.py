@@ -0,0 +1,101 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the parse-result cache."""
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from aiida_cp2k.parsers.cache import (
+    DiskParseResultCache,
+    ParseResultCache,
+    cached_parse,
+    set_parse_cache,
+)
+from aiida_cp2k.utils.parser import parse_cp2k_output_advanced
+
+OUTPUTS_DIR = Path(__file__).parent.resolve() / "outputs"
+
+
+def test_disk_cache(tmp_path):
+    """Test that results are returned from the cache and keyed by content and options."""
+    with open(OUTPUTS_DIR / "GEO_OPT_v9.1.out") as fobj:
+        content = fobj.read()
+
+    calls = []
+
+    def parse(fstring, eigen_blocks=1):
+        calls.append(eigen_blocks)
+        return parse_cp2k_output_advanced(fstring, eigen_blocks=eigen_blocks)
+
+    set_parse_cache(DiskParseResultCache(tmp_path))
+    try:
+        first = cached_parse(parse, content)
+        second = cached_parse(parse, content)
+        cached_parse(parse, content, eigen_blocks=2)
+    finally:
+        set_parse_cache(None)
+
+    assert calls == [1, 2]
+    assert second["motion_step_info"] == first["motion_step_info"]
+    assert np.array_equal(
+        second["scf_history"]["energy"], first["scf_history"]["energy"]
+    )
+    assert len(list(tmp_path.glob("*.pickle"))) == 2
+
+
+def test_disk_cache_eviction(tmp_path):
+    """Test that the least recently used entries are evicted."""
+    cache = DiskParseResultCache(tmp_path, max_bytes=3000)
+    for key in "abc":
+        cache.set(key, {"data": key * 1000})
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.get("c") == {"data": "c" * 1000}
+
+
+def test_disk_cache_stale_entries(tmp_path):
+    """Test that entries referring to classes that no longer exist are cache misses."""
+    cache = DiskParseResultCache(tmp_path)
+    (tmp_path / "module.pickle").write_bytes(b"cno_such_module_for_cp2k\nResult\n.")
+    (tmp_path / "attribute.pickle").write_bytes(b"cbuiltins\nNoSuchResult\n.")
+
+    assert cache.get("module") is None
+    assert cache.get("attribute") is None
+    with pytest.raises(TypeError):
+        ParseResultCache()
+
+
+def test_disk_cache_failures(tmp_path):
+    """Test that the entries that can not be stored or read do not fail the parse."""
+
+    class Unpicklable:
+        def __reduce__(self):
+            raise TypeError("not picklable")
+
+    def parse(fstring):
+        return {"content": fstring, "object": Unpicklable()}
+
+    cache = DiskParseResultCache(tmp_path)
+    with pytest.raises(TypeError):
+        cache.set("key", parse("a"))
+    assert not list(tmp_path.iterdir())  # The temporary file is removed.
+
+    class BrokenCache(ParseResultCache):
+        def get(self, key):
+            raise OSError("read-only file system")
+
+        def set(self, key, result):
+            raise OSError("no space left on device")
+
+    for failing_cache in (cache, BrokenCache()):
+        set_parse_cache(failing_cache)
+        try:
+            assert cached_parse(parse, "content")["content"] == "content"
+        finally:
+            set_parse_cache(None)
@@ -5,15 +5,27 @@
 # For further information on the license, see the LICENSE.txt file.           #
 ###############################################################################
 """Test output parser."""
+import json
 from pathlib import Path
 
+import numpy as np
 import pytest
+from aiida import orm
+from aiida.common.links import LinkType
+from aiida.plugins import ParserFactory
 
 from aiida_cp2k.utils.parser import (
+    Cp2kOutputParser,
     _parse_bands,
+    parse_cp2k_md_state,
     parse_cp2k_output,
     parse_cp2k_output_advanced,
+    parse_cp2k_output_tools,
+    parse_cp2k_output_tools_stream,
+    parse_cp2k_timing_report,
     parse_cp2k_trajectory,
+    parse_cp2k_xyz_trajectory,
+    pop_per_step_arrays,
 )
 
 THIS_DIR = Path(__file__).parent.resolve()
@@ -54,6 +66,25 @@ def test_bands_parser(output_file, cp2k_version):
         ).all()
 
 
+def test_bands_parser_spin_resolved():
+    """Test that both spins of the CP2K >=8.1 output end up in one array."""
+    lines = [" KPOINTS| Band Structure Calculation"]
+    for i_kpoint, kpoint in enumerate(["0.0 0.0 0.0", "0.5 0.0 0.5", "0.5 0.0 0.5"]):
+        for spin in (1, 2):
+            lines += [
+                f"#  Point {i_kpoint + 1}      Spin {spin}:     {kpoint}       0.5",
+                "#   Band    Energy [eV]     Occupation",
+                f"       1    {-spin - i_kpoint}.0     1.00000000",
+                f"       2    {spin + i_kpoint}.0     0.00000000",
+            ]
+    lines.append(" KPOINTS| Time for k-point line     0.027")
+
+    kpoints, _, bands = _parse_bands(lines, 0, 8.1)
+    assert kpoints.shape == (2, 3)
+    assert bands.shape == (2, 2, 2)
+    assert (bands[1, 1] == [-3.0, 3.0]).all()
+
+
 cdft_dos_cp2k_6_0_out_result = {
     "exceeded_walltime": False,
     "energy": -1544.4756023218408,
@@ -359,6 +390,60 @@ def test_cp2k_output_advanced(output_file, reference_dict):
         assert dict_is_subset(reference_dict, parsed_dict)
 
 
+def test_scf_history():
+    """Test parsing of the SCF iteration table into columnar arrays."""
+    with open(OUTPUTS_DIR / "GEO_OPT_v9.1.out") as fobj:
+        parsed_dict = parse_cp2k_output_advanced(fobj.read())
+
+    scf_history = parsed_dict["scf_history"]
+    assert len(scf_history["step"]) == 87
+    assert scf_history["step"].dtype == np.int32
+    assert scf_history["convergence"].dtype == np.float32
+    assert list(np.unique(scf_history["outer_step"])) == [0, 1, 2, 3, 4, 5]
+    assert list(scf_history["method_names"]) == ["OT CG", "OT LS"]
+    assert list(scf_history["method"][:2]) == [0, 1]
+    assert scf_history["energy"][0] == -12.5028932274
+    assert scf_history["convergence"][0] == np.float32(0.17512196)
+    # Line-search steps have no convergence and no energy change.
+    assert np.isnan(scf_history["convergence"][1])
+    assert np.isnan(scf_history["energy_change"][1])
+
+
+def test_eigenvalue_blocks():
+    """Test that only the requested number of eigenvalue blocks is retained."""
+    output = ""
+    for i_block in range(3):
+        output += f"""
+  Eigenvalues of the occupied subspace spin            1
+ ---------------------------------------------
+      -0.{i_block}0000000      -0.{i_block}5000000
+      -0.{i_block}8000000
+ Fermi Energy [eV] :   -1.849495
+"""
+    parsed_dict = parse_cp2k_output_advanced(output, eigen_blocks=2)
+    assert parsed_dict["eigen_spin1_au"] == [-0.2, -0.25, -0.28]
+    assert parsed_dict["eigen_spin1_blocks_au"].shape == (2, 3)
+    assert parsed_dict["eigen_spin1_blocks_au"][0, 0] == -0.1
+    assert "eigen_spin1_blocks_au" not in parse_cp2k_output_advanced(output)
+
+    with pytest.raises(ValueError):
+        parse_cp2k_output_advanced(output, eigen_blocks=0)
+
+
+def test_pop_per_step_arrays():
+    """Test moving the per-step data out of the result dictionary."""
+    with open(OUTPUTS_DIR / "GEO_OPT_v9.1.out") as fobj:
+        parsed_dict = parse_cp2k_output_advanced(fobj.read())
+
+    arrays = pop_per_step_arrays(parsed_dict)
+    assert "motion_step_info" not in parsed_dict
+    assert parsed_dict["motion_opt_converged"]
+    assert list(arrays["step"]) == [0, 1, 2, 3]
+    assert arrays["scf_converged"].dtype == bool
+    assert np.isnan(arrays["max_step_au"][0])
+    assert arrays["max_step_au"][1] == 0.0376199092
+
+
 def test_trajectory_parser_pbc():
     """Test parsing of boundary conditions from the restart-file"""
     files = [
@@ -377,3 +462,313 @@ def test_trajectory_parser_pbc():
             content = fobj.read()
             structure_data = parse_cp2k_trajectory(content)
             assert structure_data["pbc"] == boundary_cond
+
+
+def test_trajectory_parser_velocities():
+    """Test that only the SUBSYS section is parsed and that velocities can be extracted."""
+    with open(OUTPUTS_DIR / "PBC_output_xz.restart") as fobj:
+        content = fobj.read()
+
+    # A thermostat section with its own COORD and VELOCITY comes before FORCE_EVAL.
+    thermostat = " &MOTION\n   &NOSE\n     &COORD\n 1.0 2.0\n     &END COORD\n"
+    thermostat += (
+        "     &VELOCITY\n 3.0 4.0\n     &END VELOCITY\n   &END NOSE\n &END MOTION\n"
+    )
+    velocities = (
+        "     &VELOCITY\n  1.0E-04  2.0E-04  3.0E-04\n  4.0E-04  5.0E-04  6.0E-04\n"
+    )
+    velocities += "     &END VELOCITY\n"
+    content = content.replace(" &FORCE_EVAL\n", thermostat + " &FORCE_EVAL\n")
+    content = content.replace("     &END COORD\n", "     &END COORD\n" + velocities)
+    content = content.replace("H1    2.0000000000000697", "O    2.0000000000000697")
+
+    structure_data = parse_cp2k_trajectory(content, velocities=True)
+    assert structure_data["symbols"] == ["H", "O"]
+    assert structure_data["tags"] == [1, 0]
+    assert structure_data["positions"].shape == (2, 3)
+    assert structure_data["velocities"][1, 2] == 6.0e-04
+    assert "velocities" not in parse_cp2k_trajectory(content)
+
+
+def test_trajectory_parser_kind_names():
+    """Test that kind names with letters after the tag are parsed."""
+    with open(OUTPUTS_DIR / "PBC_output_xz.restart") as fobj:
+        content = fobj.read()
+
+    content = content.replace("H1    2.0000000000000697", "Fe1a    2.0000000000000697")
+    structure_data = parse_cp2k_trajectory(content)
+    assert structure_data["symbols"] == ["H", "Fea"]
+    assert structure_data["tags"] == [1, 1]
+
+    content = content.replace(
+        "Fe1a    2.0000000000000697", "Fe1a2    2.0000000000000697"
+    )
+    with pytest.raises(ValueError):
+        parse_cp2k_trajectory(content)
+
+
+def test_md_state_parser():
+    """Test parsing of the MD state (counters, thermostat and barostat) from the restart-file"""
+    with open(OUTPUTS_DIR / "MD_NPT_output.restart") as fobj:
+        md_state = parse_cp2k_md_state(fobj.read())
+
+    assert md_state["step_start_val"][0] == 10
+    assert md_state["econs_start_val"][0] == -1.7165003237569012e01
+    # The thermostat of the barostat must not be taken for the particle thermostat.
+    assert md_state["nose_coord"].shape == (3,)
+    assert (md_state["nose_mass"] == 50.0).all()
+    assert md_state["barostat_velocity"][0] == 2.0e-05
+
+
+def test_xyz_trajectory_parser():
+    """Test parsing of the XYZ trajectories written by CP2K."""
+    content = "".join(
+        f"2\n i = {step}, time = {0.5 * step}, E = {-1.1 * step}\n"
+        f" H {0.1 * step} 0.0 0.0\n H 0.0 0.0 0.74\n"
+        for step in range(3)
+    )
+    parsed = parse_cp2k_xyz_trajectory(content)
+    assert parsed["coords"].shape == (3, 2, 3)
+    assert list(parsed["stepids"]) == [0, 1, 2]
+    assert parsed["energies"][2] == pytest.approx(-2.2)
+    assert parsed["coords"][2, 0, 0] == pytest.approx(0.2)
+
+    assert list(parse_cp2k_xyz_trajectory(content, frame_info=False)) == ["coords"]
+
+
+def test_cp2k_output_tools_stream():
+    """Test the segment-wise parsing with cp2k-output-tools."""
+    content = (OUTPUTS_DIR / "OT_v9.1.out").read_text()
+    assert parse_cp2k_output_tools_stream(
+        content.splitlines(keepends=True)
+    ) == parse_cp2k_output_tools(content)
+
+    with open(OUTPUTS_DIR / "GEO_OPT_v9.1.out") as fobj:
+        parsed = parse_cp2k_output_tools_stream(fobj, blocks=["energies"], history=3)
+    assert sorted(parsed) == ["energies", "energies_history", "energy", "energy_units"]
+    assert len(parsed["energies_history"]) == 3
+    assert (
+        parsed["energy"]
+        == parse_cp2k_output((OUTPUTS_DIR / "GEO_OPT_v9.1.out").read_text())["energy"]
+    )
+
+    with pytest.raises(ValueError):
+        parse_cp2k_output_tools_stream([], blocks=["unknown"])
+
+
+def test_cp2k_output_advanced_fields():
+    """Test that only the requested optional results are parsed."""
+    content = (OUTPUTS_DIR / "GEO_OPT_v9.1.out").read_text()
+    full = parse_cp2k_output_advanced(content)
+    parsed = parse_cp2k_output_advanced(content, fields=["motion_step_info"])
+
+    assert parsed["motion_step_info"] == full["motion_step_info"]
+    assert parsed["energy"] == full["energy"]
+    for key in (
+        "warnings",
+        "scf_history",
+        "eigen_spin1_au",
+        "natoms",
+        "init_nel_spin1",
+    ):
+        assert key in full
+        assert key not in parsed
+
+    # The eigenvalues need the number of electrons to compute the band gap.
+    assert "init_nel_spin1" in parse_cp2k_output_advanced(content, fields=["eigen"])
+
+    with pytest.raises(ValueError):
+        parse_cp2k_output_advanced(content, fields=["unknown"])
+
+
+def test_cp2k_output_parser_incremental():
+    """Test that parsing the output in chunks, with the state saved in between, gives the same results."""
+    content = (OUTPUTS_DIR / "GEO_OPT_v9.1.out").read_text()
+    full = parse_cp2k_output_advanced(content, eigen_blocks=2)
+
+    parser = Cp2kOutputParser(eigen_blocks=2)
+    for start in range(0, len(content), 1000):
+        parser.feed(content[start : start + 1000])
+        if start == 20000:
+            partial = parser.result()
+        parser = Cp2kOutputParser.from_state(json.loads(json.dumps(parser.get_state())))
+    parser.close()
+    result = parser.result()
+
+    assert len(partial["motion_step_info"]["step"]) < len(
+        result["motion_step_info"]["step"]
+    )
+    assert result["motion_step_info"] == full["motion_step_info"]
+    assert result["eigen_spin1_au"] == full["eigen_spin1_au"]
+    assert np.array_equal(
+        result["eigen_spin1_blocks_au"], full["eigen_spin1_blocks_au"]
+    )
+    assert np.array_equal(
+        result["scf_history"]["energy"], full["scf_history"]["energy"]
+    )
+    assert result["warnings"] == full["warnings"]
+
+
+@pytest.mark.parametrize(
+    "output_file", ["BANDS_output_v5.1.out", "BANDS_output_v8.1.out"]
+)
+def test_cp2k_output_parser_incremental_bands(output_file):
+    """Test that the results are available while a k-point block of the bands is being written."""
+    content = (OUTPUTS_DIR / output_file).read_text()
+    full = parse_cp2k_output_advanced(content)["kpoint_data"]
+
+    parser = Cp2kOutputParser()
+    nkpoints = 0
+    for line in content.splitlines(True):
+        parser.feed(line)
+        kpoint_data = parser.result().get("kpoint_data")
+        if kpoint_data is not None and len(kpoint_data["kpoints"]):
+            # Only the complete k-point blocks are returned.
+            assert len(kpoint_data["kpoints"]) >= nkpoints
+            nkpoints = len(kpoint_data["kpoints"])
+            assert np.array_equal(
+                kpoint_data["bands"], full["bands"][..., :nkpoints, :]
+            )
+    parser.close()
+    assert np.array_equal(parser.result()["kpoint_data"]["bands"], full["bands"])
+
+    # A truncated output ends in the middle of a k-point block.
+    lines = content.splitlines(True)
+    last_header = max(
+        i
+        for i, line in enumerate(lines)
+        if line.lstrip().startswith("Nr.") or line.startswith("#  Point")
+    )
+    truncated = "".join(lines[: last_header + 3])
+    kpoint_data = parse_cp2k_output_advanced(truncated)["kpoint_data"]
+    assert np.array_equal(kpoint_data["bands"], full["bands"][..., :-1, :])
+
+
+def test_timing_report_parser():
+    """Test parsing the timing report at the end of the output."""
+    with open(OUTPUTS_DIR / "GEO_OPT_v9.1.out") as fobj:
+        timing = parse_cp2k_timing_report(fobj)
+
+    assert len(timing["routine"]) == 39
+    assert timing["routine"][0] == "CP2K"
+    assert timing["total_time_maximum"][0] == pytest.approx(110.060)
+    index = list(timing["routine"]).index("fft3d_ps")
+    assert timing["calls"][index] == 1342
+    assert timing["self_time_average"][index] == pytest.approx(26.437)
+    assert timing["self_time_maximum"][index] == pytest.approx(27.328)
+
+    assert parse_cp2k_timing_report(["no report"]) == {}
+
+
+def test_cp2k_output_advanced_performance():
+    """Test parsing the memory, DBCSR and MPI statistics."""
+    content = (OUTPUTS_DIR / "GEO_OPT_v2024.3.out").read_text()
+    result_dict = parse_cp2k_output_advanced(content)
+    performance = result_dict["performance"]
+
+    assert result_dict["step_peak_memory_mib"] == [1079, 1079, 1079, 1081]
+    assert "step_peak_memory_mib" in pop_per_step_arrays(result_dict)
+    assert performance["peak_memory_mib"] == 1092
+    assert performance["dbcsr_flops_total"] == pytest.approx(27.212008e6)
+    assert performance["dbcsr_multiplications"] == 2012
+    assert performance["dbcsr_mpi_messages_bytes"] == pytest.approx(24.055240e6)
+    assert performance["dbcsr_flops_per_second"] == pytest.approx(27.212008e6 / 6.084)
+    assert performance["walltime_seconds"] == pytest.approx(48.425)
+    assert performance["mpi_calls"]["MP_Alltoall"] == 1342
+    assert performance["mpi_volume_bytes"]["MP_Alltoall"] == pytest.approx(
+        1342 * 47249250.0
+    )
+    assert "MP_Wait" not in performance["mpi_volume_bytes"]
+
+
+@pytest.fixture
+def generate_retrieved_calculation(aiida_localhost):
+    """Return a function creating a stored `Cp2kCalculation` node with the given inputs and retrieved files."""
+
+    def _generate_retrieved_calculation(inputs, files):
+        node = orm.CalcJobNode(
+            computer=aiida_localhost, process_type="aiida.calculations:cp2k"
+        )
+        node.set_option("resources", {"num_machines": 1})
+        node.set_option("output_filename", "aiida.out")
+        for label, input_node in inputs.items():
+            input_node.store()
+            node.base.links.add_incoming(
+                input_node, link_type=LinkType.INPUT_CALC, link_label=label
+            )
+        node.store()
+
+        retrieved = orm.FolderData()
+        for name, content in files.items():
+            retrieved.base.repository.put_object_from_bytes(content.encode(), name)
+        retrieved.base.links.add_incoming(
+            node, link_type=LinkType.CREATE, link_label="retrieved"
+        )
+        retrieved.store()
+        return node
+
+    return _generate_retrieved_calculation
+
+
+def test_packed_jobs_parser(generate_retrieved_calculation):
+    """Test that the outputs of the packed structures are parsed into their own namespace and summarized."""
+    output = (OUTPUTS_DIR / "OT_v9.1.out").read_text()
+    structures = {}
+    for key in ("complete", "incomplete"):
+        structures[f"structures__{key}"] = orm.StructureData(cell=np.eye(3) * 5.0)
+        structures[f"structures__{key}"].append_atom(
+            position=(0.0, 0.0, 0.0), symbols="H"
+        )
+    node = generate_retrieved_calculation(
+        structures,
+        {
+            "complete_aiida.out": output,
+            "incomplete_aiida.out": "".join(output.splitlines(True)[:100]),
+        },
+    )
+
+    parser = ParserFactory("cp2k_base_parser")(node)
+    exit_code = parser.parse()
+
+    assert (
+        exit_code.status == node.process_class.exit_codes.ERROR_OUTPUT_INCOMPLETE.status
+    )
+    outputs = parser.outputs
+    assert outputs["structures.complete.output_parameters"]["energy"] == pytest.approx(
+        -26352.215747926548
+    )
+    assert "structures.incomplete.output_parameters" in outputs
+    assert outputs["output_parameters"].get_dict() == {
+        "structures": {
+            "complete": {
+                "energy": pytest.approx(-26352.215747926548),
+                "exit_status": 0,
+            },
+            "incomplete": {"energy": None, "exit_status": exit_code.status},
+        }
+    }
+
+
+def test_farming_parser(generate_retrieved_calculation):
+    """Test that a FARMING run that ran out of wall time is reported, even if some of its jobs finished."""
+    output = (OUTPUTS_DIR / "OT_v9.1.out").read_text()
+    structure = orm.StructureData(cell=np.eye(3) * 5.0)
+    structure.append_atom(position=(0.0, 0.0, 0.0), symbols="H")
+    node = generate_retrieved_calculation(
+        {
+            "structures__h1": structure,
+            "settings": orm.Dict({"farming_groups": 1}),
+        },
+        {
+            "aiida.out": " *** WARNING in farming.F:123 :: exceeded requested execution time ***\n",
+            "h1_aiida.out": output,
+        },
+    )
+
+    parser = ParserFactory("cp2k_base_parser")(node)
+    exit_code = parser.parse()
+
+    assert (
+        exit_code.status == node.process_class.exit_codes.ERROR_OUT_OF_WALLTIME.status
+    )
+    assert parser.outputs["output_parameters"]["structures"]["h1"]["exit_status"] == 0
@@ -0,0 +1,48 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the stage profiler."""
+
+from aiida_cp2k.utils import StageProfiler
+
+
+def test_stage_profiler():
+    """Test that the stages are recorded only if the profiler is enabled."""
+    profiler = StageProfiler()
+    with profiler.stage("read") as record:
+        profiler.count_content(record, "a\nb\nc\n")
+    assert profiler.stages["read"]["chars"] == 6
+    assert profiler.stages["read"]["lines"] == 3
+    assert profiler.stages["read"]["seconds"] >= 0
+
+    with profiler.stage("read_bytes") as record:
+        profiler.count_content(record, "é\n".encode())
+    assert profiler.stages["read_bytes"]["bytes"] == 3
+    assert profiler.stages["read_bytes"]["lines"] == 1
+
+    assert profiler.wrap("parse", len)("abc") == 3
+    assert profiler.stages["parse"]["seconds"] >= 0
+
+    disabled = StageProfiler(enabled=False)
+    with disabled.stage("read") as record:
+        disabled.count_content(record, "a\nb\nc\n")
+    assert disabled.wrap("parse", len)("abc") == 3
+    assert disabled.stages == {}
+    assert record == {}
+
+
+def test_stage_profiler_accumulate():
+    """Test that a stage recorded twice is accumulated and that its memory is the increase of the peak RSS."""
+    profiler = StageProfiler()
+    for content in ("a\n", "bc\nd\n"):
+        with profiler.stage("write_input") as record:
+            profiler.count_content(record, content)
+    record = profiler.stages["write_input"]
+    assert record["calls"] == 2
+    assert record["chars"] == 7
+    assert record["lines"] == 3
+    assert record["peak_rss_increase_bytes"] >= 0
+    assert "peak_rss_bytes" not in record
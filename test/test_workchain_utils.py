@@ -0,0 +1,384 @@
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the utilities of the work chains."""
+import numpy as np
+import pytest
+from aiida import common, orm
+from aiida.common.links import LinkType
+from aiida.engine import ProcessState
+
+from aiida_cp2k.utils import (
+    FINGERPRINT_EXTRA,
+    get_inputs_fingerprint,
+    get_positions_rmsd,
+    has_remote_file,
+    propose_parallel_layout,
+    scale_resources,
+)
+from aiida_cp2k.workchains.base import Cp2kBaseWorkChain
+from aiida_cp2k.workchains.batch import (
+    Cp2kBatchWorkChain,
+    collect_energies,
+    validate_structures,
+)
+from aiida_cp2k.workchains.cutoff import (
+    Cp2kCutoffConvergenceWorkChain,
+    _grid_change,
+    find_converged_value,
+    validate_parser_name,
+)
+
+LIMITS = {"max_wallclock_seconds": 86400, "max_num_machines": 4}
+
+
+@pytest.mark.parametrize(
+    "steps_done,remaining_steps,expected",
+    (
+        (100, 50, (3600, 1)),  # Enough time left.
+        (100, 400, (14400, 1)),  # Longer wall time.
+        (100, 4000, (72000, 2)),  # More machines.
+        (100, 40000, (86400, 4)),  # Limits reached.
+        (0, 100, (86400, 1)),  # No progress rate.
+    ),
+)
+def test_scale_resources(steps_done, remaining_steps, expected):
+    """Test that the wall time is increased first, then the number of machines, within the limits."""
+    assert scale_resources(steps_done, remaining_steps, 3600, 1, LIMITS) == expected
+    assert scale_resources(steps_done, remaining_steps, 3600, 1, {}) == (3600, 1)
+
+
+def test_scale_resources_elapsed_seconds():
+    """Test that the progress rate is computed from the time the steps were done in, keeping the margin."""
+    # 100 steps in 3000 s, the remaining 200 take 6000 s, plus the margin of 600 s.
+    assert scale_resources(100, 200, 3600, 1, LIMITS, elapsed_seconds=3000) == (
+        6600,
+        1,
+    )
+    assert scale_resources(100, 200, 3600, 1, LIMITS) == (7200, 1)
+
+
+@pytest.mark.parametrize(
+    "cores_per_machine,num_machines,expected_threads",
+    (
+        (128, 2, 1),  # 256 ranks.
+        (128, 1, 2),  # 64 ranks.
+        (36, 3, 3),  # 36 ranks.
+        (6, 1, 1),  # No square number of ranks.
+    ),
+)
+def test_propose_parallel_layout(cores_per_machine, num_machines, expected_threads):
+    """Test that a square number of MPI ranks is preferred."""
+    layout = propose_parallel_layout(100, cores_per_machine, num_machines=num_machines)
+    assert layout["resources"] == {
+        "num_machines": num_machines,
+        "num_mpiprocs_per_machine": cores_per_machine // expected_threads,
+        "num_cores_per_mpiproc": expected_threads,
+    }
+    assert layout["environment_variables"] == {"OMP_NUM_THREADS": str(expected_threads)}
+
+
+def test_propose_parallel_layout_calibration():
+    """Test that the cheapest number of threads is tried first."""
+    layout = propose_parallel_layout(100, 128, calibration={4: 1.0, 1: 2.0})
+    assert layout["resources"]["num_machines"] == 2
+    assert layout["resources"]["num_cores_per_mpiproc"] == 4  # 64 ranks.
+    assert layout["GLOBAL"] == {}
+
+
+def test_propose_parallel_layout_libraries():
+    """Test that the diagonalization library and the FFTW plan type are only set on request."""
+    layout = propose_parallel_layout(
+        100, 128, diag_library="ELPA", fftw_plan_type="MEASURE"
+    )
+    assert layout["GLOBAL"] == {
+        "PREFERRED_DIAG_LIBRARY": "ELPA",
+        "FFTW_PLAN_TYPE": "MEASURE",
+    }
+
+    # A single MPI rank does not use a distributed diagonalization.
+    layout = propose_parallel_layout(
+        1, 1, diag_library="ELPA", fftw_plan_type="MEASURE"
+    )
+    assert layout["GLOBAL"] == {"FFTW_PLAN_TYPE": "MEASURE"}
+
+
+def test_find_converged_cutoff():
+    """Test that the smallest value agreeing with the next two in energy and grid distribution is returned."""
+    results = [
+        {"value": 200, "energy": -17.10, "grid_counts": [100, 50, 20, 10]},
+        {"value": 300, "energy": -17.15, "grid_counts": [80, 60, 30, 10]},
+        {"value": 400, "energy": -17.15002, "grid_counts": [60, 70, 40, 10]},
+        {"value": 500, "energy": -17.15003, "grid_counts": [60, 70, 41, 10]},
+        {"value": 600, "energy": -17.15004, "grid_counts": [60, 70, 41, 10]},
+    ]
+    assert find_converged_value(results, 1e-4, 0.01) == 400
+    assert find_converged_value(results, 1e-4, 0.2) == 300
+    assert find_converged_value(results[:4], 1e-4, 0.01) is None
+    assert find_converged_value(results[:4], 1e-4, 0.01, agreements=1) == 400
+
+    # The energies of 300 and 400 agree, but those of the larger values drop further.
+    results[3]["energy"] = -17.16
+    results[4]["energy"] = -17.16001
+    assert find_converged_value(results, 1e-4, 0.01) is None
+
+
+def test_grid_change():
+    """Test the largest change of the fraction of Gaussians on a grid."""
+    first = {"grid_counts": [50, 30, 20]}
+    assert _grid_change(first, {"grid_counts": [100, 60, 40]}) == 0.0
+    assert _grid_change(first, {"grid_counts": [40, 40, 20]}) == pytest.approx(0.1)
+    assert _grid_change(first, {"grid_counts": [50, 30, 10, 10]}) == 1.0
+
+
+@pytest.mark.parametrize(
+    "parser_name,valid",
+    (
+        (None, True),
+        ("cp2k_base_parser", True),
+        ("cp2k_advanced_parser", True),
+        ("cp2k_tools_parser", False),
+    ),
+)
+def test_validate_parser_name(parser_name, valid):
+    """Test that the calculations of the cutoff scan can only be parsed by the advanced parser."""
+    options = {} if parser_name is None else {"parser_name": parser_name}
+    inputs = {"base": {"cp2k": {"metadata": {"options": options}}}}
+    assert (validate_parser_name(inputs, None) is None) == valid
+
+
+@pytest.mark.parametrize(
+    "inputs,valid",
+    (
+        ({"structures": {"h2o": None}}, True),
+        ({"structure_group": "screening"}, True),
+        ({}, False),
+        ({"structures": {}}, False),
+        ({"structures": {"h2o": None}, "structure_group": "screening"}, False),
+    ),
+)
+def test_validate_batch_structures(inputs, valid):
+    """Test that the structures of the batch work chain come either from a namespace or from a group."""
+    assert (validate_structures(inputs, None) is None) == valid
+
+
+def test_collect_energies():
+    """Test that the failed calculations give NaN and that duplicate structures share the same results."""
+    first = orm.Dict({"energy": -17.1})
+    second = orm.Dict({"energy": -34.2})
+    result = collect_energies(
+        orm.List(["h2o", "h2o_copy", "failed", "h2o2"]),
+        index_0=first,
+        index_1=first,
+        index_3=second,
+    )
+    assert result.get_array("labels").tolist() == ["h2o", "h2o_copy", "failed", "h2o2"]
+    np.testing.assert_array_equal(
+        result.get_array("energies"), [-17.1, -17.1, np.nan, -34.2]
+    )
+
+
+def test_validate_max_concurrent():
+    """Test that at least one calculation of a batch or of a scan must run at a time."""
+    for workchain in (Cp2kBatchWorkChain, Cp2kCutoffConvergenceWorkChain):
+        validator = workchain.spec().inputs["max_concurrent"].validator
+        assert validator(orm.Int(1), None) is None
+        assert validator(orm.Int(0), None) is not None
+        assert validator(orm.Int(-2), None) is not None
+
+
+def finish_workflow(node, energy=None):
+    """Terminate a work chain node, successfully with the `energy` as output parameters if given."""
+    if energy is not None:
+        output = orm.Dict({"energy": energy}).store()
+        output.base.links.add_incoming(
+            node, link_type=LinkType.RETURN, link_label="output_parameters"
+        )
+    node.set_process_state(ProcessState.FINISHED)
+    node.set_exit_status(300 if energy is None else 0)
+
+
+def test_batch_window(aiida_localhost):
+    """Test that the window is refilled as the calculations finish, and that duplicates are not computed again."""
+    code = orm.InstalledCode(
+        computer=aiida_localhost, filepath_executable="/bin/true"
+    ).store()
+    # A cutoff of its own, so that no calculation of another test has the same fingerprint.
+    parameters = orm.Dict(
+        {"FORCE_EVAL": {"DFT": {"MGRID": {"CUTOFF": float(np.random.random())}}}}
+    ).store()
+
+    def get_structure(distance):
+        structure = orm.StructureData(cell=np.eye(3) * 5.0)
+        structure.append_atom(position=(0.0, 0.0, 0.0), symbols="H")
+        structure.append_atom(position=(distance, 0.0, 0.0), symbols="H")
+        return structure.store()
+
+    structures = {
+        "a": get_structure(1.0),
+        "b": get_structure(1.5),
+        "c": get_structure(1.5),  # Identical to b.
+        "d": get_structure(2.0),  # Computed before.
+        "e": get_structure(2.5),
+    }
+    previous = orm.WorkflowNode().store()
+    previous.base.extras.set(
+        FINGERPRINT_EXTRA,
+        get_inputs_fingerprint(
+            {"code": code, "parameters": parameters, "structure": structures["d"]}
+        ),
+    )
+    finish_workflow(previous, -4.0)
+
+    submitted = []
+
+    def submit(_, **inputs):
+        submitted.append(orm.WorkflowNode(label=inputs["metadata"]["label"]).store())
+        return submitted[-1]
+
+    outputs = {}
+    workchain = common.AttributeDict(
+        {
+            "ctx": common.AttributeDict(),
+            "inputs": common.AttributeDict(
+                {
+                    "structures": structures,
+                    "max_concurrent": orm.Int(2),
+                    "skip_duplicates": orm.Bool(True),
+                }
+            ),
+            "exposed_inputs": lambda *_: {
+                "cp2k": {"code": code, "parameters": parameters}
+            },
+            "submit": submit,
+            "report": lambda message: None,
+            "out": outputs.__setitem__,
+        }
+    )
+
+    Cp2kBatchWorkChain.setup(workchain)
+    awaited = Cp2kBatchWorkChain.run_calculations(workchain)["awaited"]
+    assert [node.label for node in submitted] == ["a", "b"]
+    assert awaited.pk == submitted[0].pk
+
+    # The second calculation finished first: its place is taken by the next calculation actually run.
+    finish_workflow(submitted[1], -2.0)
+    Cp2kBatchWorkChain.inspect_calculations(workchain)
+    assert Cp2kBatchWorkChain.should_run_calculations(workchain)
+    awaited = Cp2kBatchWorkChain.run_calculations(workchain)["awaited"]
+    assert [node.label for node in submitted] == ["a", "b", "e"]
+    assert awaited.pk == submitted[0].pk
+
+    finish_workflow(submitted[0], -1.0)
+    finish_workflow(submitted[2])
+    Cp2kBatchWorkChain.inspect_calculations(workchain)
+    assert not Cp2kBatchWorkChain.should_run_calculations(workchain)
+
+    assert Cp2kBatchWorkChain.results(workchain) is None
+    np.testing.assert_array_equal(
+        outputs["energies"].get_array("energies"), [-1.0, -2.0, -2.0, -4.0, np.nan]
+    )
+
+
+def test_get_positions_rmsd():
+    """Test the RMSD of the positions, with atoms crossing the cell boundaries."""
+    cell = np.diag([5.0, 5.0, 10.0])
+    positions = np.array(
+        [[0.0, 0.0, 0.0], [4.9, 0.0, 0.0], [0.0, 1.0, 9.9], [1.0, 1.0, 1.0]]
+    )
+
+    # Periodic images of the same positions.
+    assert get_positions_rmsd(
+        cell,
+        positions,
+        positions + [[5.0, 0, 0], [-5.0, 0, 0], [0, 0, 10.0], [0, 0, 0]],
+    ) == pytest.approx(0.0)
+
+    # Displacements across the boundaries.
+    moved = positions + [[0, 0, 0], [0.2, 0, 0], [0, 0, 0.2], [0, 0, 0]]
+    assert get_positions_rmsd(cell, positions, moved) == pytest.approx(
+        np.sqrt(0.08 / 4)
+    )
+
+
+def get_md_calculation(computer, remote_path):
+    """Return a stored MD calculation that ran out of wall time, with its remote folder and MD state."""
+    node = orm.CalcJobNode(computer=computer, process_type="aiida.calculations:cp2k")
+    node.set_option("resources", {"num_machines": 1})
+    node.set_option("output_filename", "aiida.out")
+    node.set_exit_status(400)
+    node.store()
+
+    retrieved = orm.FolderData()
+    retrieved.base.repository.put_object_from_bytes(
+        b" MD| Step number                                                        10\n",
+        "aiida.out",
+    )
+    md_state = orm.ArrayData()
+    md_state.set_array("velocities", np.array([[0.1, 0.0, 0.0]]))
+    md_state.set_array("step_start_val", np.array([10]))
+    remote_folder = orm.RemoteData(computer=computer, remote_path=str(remote_path))
+    for label, output in (
+        ("retrieved", retrieved),
+        ("output_md_state", md_state),
+        ("remote_folder", remote_folder),
+    ):
+        output.base.links.add_incoming(
+            node, link_type=LinkType.CREATE, link_label=label
+        )
+        output.store()
+    return node
+
+
+def test_has_remote_file(aiida_localhost, tmp_path):
+    """Test that the files missing, empty or in a cleaned remote folder are not available."""
+    remote_folder = orm.RemoteData(computer=aiida_localhost, remote_path=str(tmp_path))
+    (tmp_path / "aiida-1.restart").write_text("&GLOBAL\n")
+    (tmp_path / "empty.restart").write_text("")
+    assert has_remote_file(remote_folder, "aiida-1.restart") is True
+    assert has_remote_file(remote_folder, "empty.restart") is False
+    assert has_remote_file(remote_folder, "missing.restart") is False
+
+    remote_folder.store()
+    remote_folder.base.extras.set(remote_folder.KEY_EXTRA_CLEANED, True)
+    assert has_remote_file(remote_folder, "aiida-1.restart") is False
+
+
+def test_restart_incomplete_md_calculation(aiida_localhost, tmp_path):
+    """Test that an MD run continues from the stored MD state once the restart file was purged on the cluster."""
+    restart_incomplete_calculation = (
+        Cp2kBaseWorkChain.restart_incomplete_calculation.__wrapped__
+    )
+    params = orm.Dict({"GLOBAL": {"RUN_TYPE": "MD"}, "MOTION": {"MD": {"STEPS": 100}}})
+    calc = get_md_calculation(aiida_localhost, tmp_path)
+
+    def restart():
+        workchain = common.AttributeDict(
+            {
+                "ctx": common.AttributeDict(
+                    {"inputs": common.AttributeDict({"parameters": params})}
+                ),
+                "report": lambda message: None,
+            }
+        )
+        report = restart_incomplete_calculation(workchain, calc)
+        assert not report.do_break
+        return workchain.ctx.inputs
+
+    # The restart file is in the remote folder.
+    (tmp_path / "aiida-1.restart").write_text("&GLOBAL\n")
+    inputs = restart()
+    assert inputs.parent_calc_folder.pk == calc.outputs.remote_folder.pk
+    assert "EXT_RESTART" in inputs.parameters.get_dict()
+
+    # The scratch folder was purged.
+    (tmp_path / "aiida-1.restart").unlink()
+    inputs = restart()
+    assert "parent_calc_folder" not in inputs
+    parameters = inputs.parameters.get_dict()
+    assert "EXT_RESTART" not in parameters
+    assert parameters["MOTION"]["MD"]["STEP_START_VAL"] == 10
+    assert "VELOCITY" in parameters["FORCE_EVAL"]["SUBSYS"]